@@ -0,0 +1,181 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Agent health and throughput counters served over HTTP in the Prometheus text format.
+
+Everything is recorded outside of the measurement itself (after a run or as part of the
+upload) and the server thread only wakes up when it is scraped."""
+import BaseHTTPServer
+import logging
+import threading
+
+# Address the metrics are served on unless one is given (local scrapes only)
+METRICS_ADDRESS = '127.0.0.1'
+# Port the metrics are served on if only an address (or nothing) is given
+METRICS_PORT = 9440
+# Histogram buckets (in seconds)
+METRICS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0]
+# Everything that is exported: name -> (type, help)
+METRICS = {
+    'wptagent_runs_total':
+        ('counter', 'Test runs uploaded by the agent (by result).'),
+    'wptagent_tests_completed_total':
+        ('counter', 'Tests where the final run was uploaded.'),
+    'wptagent_run_duration_seconds':
+        ('histogram', 'Time from starting a run to the end of its upload.'),
+    'wptagent_stage_duration_seconds':
+        ('histogram', 'Time spent in each stage of a run (see agent_timing.json).'),
+    'wptagent_queue_wait_seconds':
+        ('histogram', 'Time the agent was idle waiting for the server to hand out a job.'),
+    'wptagent_upload_bytes_total':
+        ('counter', 'Bytes sent to the server (after compression) by endpoint.'),
+    'wptagent_upload_failures_total':
+        ('counter', 'Failed uploads by endpoint.'),
+    'wptagent_devtools_messages_total':
+        ('counter', 'Dev tools messages processed.'),
+    'wptagent_shaping_reconfigurations_total':
+        ('counter', 'Traffic-shaping configurations applied (by result).')}
+
+def format_labels(labels, extra=None):
+    """Prometheus label set ('' if there are no labels)"""
+    pairs = list(labels)
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    values = []
+    for key, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        values.append('{0}="{1}"'.format(key, value))
+    return '{' + ','.join(values) + '}'
+
+def format_value(value):
+    """Sample value (whole numbers without the trailing .0)"""
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class AgentMetrics(object):
+    """Counters and histograms for the agent along with the HTTP server that exports them"""
+    def __init__(self, address=METRICS_ADDRESS, port=METRICS_PORT):
+        self.address = address
+        self.port = port
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        """Start serving /metrics in a background thread"""
+        ret = False
+        metrics = self
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            """Request handler for the scrapes"""
+            def do_GET(self):
+                """Serve the current metrics"""
+                if self.path.split('?')[0] in ['/', '/metrics']:
+                    body = metrics.render()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                else:
+                    self.send_error(404)
+
+            def log_message(self, *_):
+                """Keep the scrapes out of the agent's console output"""
+                pass
+        try:
+            self.server = BaseHTTPServer.HTTPServer((self.address, self.port), MetricsHandler)
+            self.port = self.server.server_address[1]
+            self.thread = threading.Thread(target=self.server.serve_forever)
+            self.thread.daemon = True
+            self.thread.start()
+            logging.debug("Serving metrics on %s:%d", self.address, self.port)
+            ret = True
+        except BaseException as err:
+            logging.critical("Error starting the metrics server on %s:%d: %s", self.address,
+                             self.port, err.__str__())
+            self.server = None
+        return ret
+
+    def stop(self):
+        """Stop the server"""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add a sample (in seconds) to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * len(METRICS_BUCKETS),
+                                        'sum': 0.0, 'count': 0}
+            histogram = self.histograms[key]
+            for index, bound in enumerate(METRICS_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def record_run(self, task):
+        """Fold a finished (and uploaded) run into the metrics"""
+        self.inc('wptagent_runs_total', result='error' if task['error'] is not None else 'ok')
+        if task['done']:
+            self.inc('wptagent_tests_completed_total')
+        if 'devtools_messages' in task:
+            self.inc('wptagent_devtools_messages_total', task['devtools_messages'])
+        if 'timing' in task and task['timing'] is not None:
+            self.observe('wptagent_run_duration_seconds', task['timing'].elapsed())
+            for name, duration in task['timing'].stages():
+                self.observe('wptagent_stage_duration_seconds', duration, stage=name)
+
+    def render(self):
+        """All of the metrics in the text exposition format"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = dict((key, {'buckets': list(value['buckets']), 'sum': value['sum'],
+                                     'count': value['count']})
+                              for key, value in self.histograms.iteritems())
+        lines = []
+        for name in sorted(METRICS.keys()):
+            metric_type, description = METRICS[name]
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, metric_type))
+            if metric_type == 'counter':
+                samples = sorted((key[1], value) for key, value in counters.iteritems()
+                                 if key[0] == name)
+                if not samples:
+                    samples = [((), 0)]
+                for labels, value in samples:
+                    lines.append('{0}{1} {2}'.format(name, format_labels(labels),
+                                                     format_value(value)))
+            else:
+                samples = sorted((key[1], value) for key, value in histograms.iteritems()
+                                 if key[0] == name)
+                for labels, histogram in samples:
+                    for index, bound in enumerate(METRICS_BUCKETS):
+                        lines.append('{0}_bucket{1} {2:d}'.format(
+                            name, format_labels(labels, ('le', format_value(bound))),
+                            histogram['buckets'][index]))
+                    lines.append('{0}_bucket{1} {2:d}'.format(
+                        name, format_labels(labels, ('le', '+Inf')), histogram['count']))
+                    lines.append('{0}_sum{1} {2}'.format(name, format_labels(labels),
+                                                         format_value(histogram['sum'])))
+                    lines.append('{0}_count{1} {2:d}'.format(name, format_labels(labels),
+                                                             histogram['count']))
+        return '\n'.join(lines) + '\n'
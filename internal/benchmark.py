@@ -0,0 +1,235 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Benchmark for the post-processing pipeline, replaying recorded test runs without a browser.
+
+Each fixture is a directory laid out like a task directory before post-processing:
+    1_devtools.json.gz  dev tools events (for rebuilding the requests)
+    1_trace.json.gz     trace events
+    bodies/             response bodies named by request ID (optional)
+    video_1/ms_*.png    video frames (optional)
+    job.json            job options (optional)
+
+Run it with: python benchmark.py FIXTURE [FIXTURE ...] [--iterations 3]
+    [--baseline baseline.json] [--save baseline.json] [--threshold 20]
+
+Every stage runs in its own process so the CPU time and peak RSS (including any tools it
+runs) are measured separately. Exits with 1 if a stage regressed past the threshold.
+"""
+import argparse
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import monotonic
+import ujson as json
+
+# Pipeline stages in the order the agent runs them
+STAGES = ['optimization', 'trace', 'video', 'upload']
+# Differences smaller than these are noise regardless of the percentage
+MIN_REGRESSION = {'wall': 0.05, 'cpu': 0.05, 'rss': 5.0}
+
+def load_fixture(task_dir):
+    """Job and task for a fixture that has been copied to task_dir"""
+    job = {'Test ID': 'BENCHMARK', 'runs': 1, 'fvonly': 1, 'iq': 30, 'pngss': 0,
+           'width': 1024, 'height': 768, 'timeout': 120, 'Capture Video': 1}
+    job_file = os.path.join(task_dir, 'job.json')
+    if os.path.isfile(job_file):
+        with open(job_file, 'rb') as f_in:
+            job.update(json.load(f_in))
+        os.remove(job_file)
+    task = {'id': job['Test ID'], 'run': 1, 'cached': 0, 'done': True, 'error': None,
+            'log_data': True, 'combine_steps': False, 'current_step': 1, 'dir': task_dir,
+            'task_prefix': '1_', 'prefix': '1_', 'task_video_prefix': 'video_1',
+            'video_subdirectory': 'video_1', 'video_directories': ['video_1'],
+            'step_name': 'Step_1', 'port': 9222, 'time_limit': job['timeout']}
+    if os.path.isfile(os.path.join(task_dir, '1_progress.csv.gz')):
+        task['netlog_bandwidth'] = True
+    return job, task
+
+def load_requests(job, task):
+    """Rebuild the request details from the recorded dev tools events"""
+    from internal.devtools import DevTools
+    devtools = DevTools(job, task)
+    path = os.path.join(task['dir'], task['prefix'] + 'devtools.json.gz')
+    if os.path.isfile(path):
+        with gzip.open(path, 'rb') as f_in:
+            events = json.load(f_in)
+        for msg in events:
+            if 'method' in msg and msg['method'].startswith('Network.') and 'params' in msg:
+                devtools.process_network_event(msg['method'].split('.', 1)[1], msg)
+    return devtools.get_requests()
+
+def run_stage(stage, task_dir, server):
+    """Run one stage of the pipeline against the task directory (in a worker process)"""
+    job, task = load_fixture(task_dir)
+    if stage == 'optimization':
+        from internal.optimization_checks import OptimizationChecks
+        checks = OptimizationChecks(job, task, load_requests(job, task))
+        checks.start()
+        checks.join()
+    elif stage == 'trace':
+        from internal.devtools_browser import DevtoolsBrowser
+        browser = DevtoolsBrowser(job)
+        browser.task = task
+        browser.process_trace()
+    elif stage == 'video':
+        from internal.video_processing import VideoProcessing
+        VideoProcessing(job, task).process()
+    elif stage == 'upload':
+        from internal.webpagetest import WebPageTest
+        options = argparse.Namespace(server=server, location='Benchmark', key=None,
+                                     name='benchmark', profiletemplate=False, longpoll=None,
+                                     spoolsize=0, uploadcodec='auto', samplerate=None,
+                                     loggzip=None, videocapture=None, screencastquality=None,
+                                     screencastsize=None)
+        work_dir = tempfile.mkdtemp()
+        wpt = WebPageTest(options, work_dir)
+        wpt.upload_task_result(task)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def measure_stage(stage, task_dir, server):
+    """Run a stage in a worker process, returns the wall time, CPU time and peak RSS (MB)"""
+    result_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    result_file.close()
+    command = [sys.executable, os.path.abspath(__file__), '--stage', stage,
+               '--dir', task_dir, '--server', server, '--result', result_file.name]
+    proc = subprocess.Popen(command)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    with open(result_file.name, 'rb') as f_in:
+        content = f_in.read()
+    os.remove(result_file.name)
+    wall = json.loads(content)['wall'] if content else None
+    if status or wall is None:
+        logging.error("The %s stage failed", stage)
+    # ru_maxrss is in KB on Linux and bytes on OSX
+    rss = usage.ru_maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' \
+          else usage.ru_maxrss / 1024.0
+    return {'wall': wall if wall is not None else 0.0,
+            'cpu': usage.ru_utime + usage.ru_stime,
+            'rss': rss}
+
+def median(values):
+    """Middle value (of the sorted measurements)"""
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def benchmark_fixture(fixture, iterations, server):
+    """Median measurements for each stage over a number of fresh copies of the fixture"""
+    runs = dict((stage, []) for stage in STAGES)
+    for _ in xrange(iterations):
+        work_dir = tempfile.mkdtemp()
+        task_dir = os.path.join(work_dir, 'task')
+        shutil.copytree(fixture, task_dir)
+        for stage in STAGES:
+            runs[stage].append(measure_stage(stage, task_dir, server))
+        shutil.rmtree(work_dir, ignore_errors=True)
+    results = {}
+    for stage in STAGES:
+        results[stage] = {}
+        for metric in ['wall', 'cpu', 'rss']:
+            results[stage][metric] = median([run[metric] for run in runs[stage]])
+    return results
+
+def find_regressions(results, baseline, threshold):
+    """Stages that are more than threshold % slower (or bigger) than the baseline"""
+    regressions = []
+    for fixture in results:
+        if fixture in baseline:
+            for stage in results[fixture]:
+                if stage in baseline[fixture]:
+                    for metric in ['wall', 'cpu', 'rss']:
+                        old = baseline[fixture][stage][metric]
+                        new = results[fixture][stage][metric]
+                        if new > old * (1.0 + threshold / 100.0) and \
+                                new - old > MIN_REGRESSION[metric]:
+                            regressions.append((fixture, stage, metric, old, new))
+    return regressions
+
+def report(results, baseline):
+    """Print the measurements for each fixture and stage"""
+    print "{0:<24} {1:<14} {2:>10} {3:>10} {4:>10}".format('Fixture', 'Stage', 'Wall (s)',
+                                                          'CPU (s)', 'RSS (MB)')
+    for fixture in sorted(results.keys()):
+        for stage in STAGES:
+            values = results[fixture][stage]
+            line = "{0:<24} {1:<14} {2:>10.3f} {3:>10.3f} {4:>10.1f}".format(
+                fixture[:24], stage, values['wall'], values['cpu'], values['rss'])
+            if baseline is not None and fixture in baseline and stage in baseline[fixture]:
+                old = baseline[fixture][stage]
+                if old['wall'] > 0:
+                    change = (values['wall'] / old['wall'] - 1.0) * 100.0
+                    line += "  ({0:+.0f}% wall)".format(change)
+            print line
+
+def serve_uploads():
+    """Start a mock work server in the background for the upload stage"""
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from mock_server import ChunkedUploads, MockServer, WorkQueue
+    server = MockServer(('127.0.0.1', 0), WorkQueue(), ChunkedUploads())
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0:d}/work/'.format(server.server_address[1])
+
+def main():
+    """Benchmark the fixtures (or run a single stage as a worker)"""
+    parser = argparse.ArgumentParser(description='Post-processing pipeline benchmark.')
+    parser.add_argument('fixtures', nargs='*', help="Fixture directories.")
+    parser.add_argument('--iterations', type=int, default=3,
+                        help="Runs of each fixture (the median is reported).")
+    parser.add_argument('--baseline', help="Results from an earlier run to compare against.")
+    parser.add_argument('--save', help="Write the results to this file (for a baseline).")
+    parser.add_argument('--threshold', type=float, default=20.0,
+                        help="Percentage increase over the baseline that counts as a regression.")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="Log the pipeline's debug output.")
+    parser.add_argument('--stage', help=argparse.SUPPRESS)
+    parser.add_argument('--dir', help=argparse.SUPPRESS)
+    parser.add_argument('--server', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.WARNING,
+                        format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    if options.stage is not None:
+        start = monotonic.monotonic()
+        run_stage(options.stage, options.dir, options.server)
+        with open(options.result, 'wb') as f_out:
+            json.dump({'wall': monotonic.monotonic() - start}, f_out)
+        return
+    if not options.fixtures:
+        parser.error("No fixtures to benchmark.")
+    server, url = serve_uploads()
+    results = {}
+    for fixture in options.fixtures:
+        if os.path.isdir(fixture):
+            results[os.path.basename(os.path.normpath(fixture))] = \
+                benchmark_fixture(fixture, options.iterations, url)
+        else:
+            logging.error("Missing fixture: %s", fixture)
+    server.shutdown()
+    baseline = None
+    if options.baseline is not None and os.path.isfile(options.baseline):
+        with open(options.baseline, 'rb') as f_in:
+            baseline = json.load(f_in)
+    report(results, baseline)
+    if options.save is not None:
+        with open(options.save, 'wb') as f_out:
+            json.dump(results, f_out, indent=2)
+    if baseline is not None:
+        regressions = find_regressions(results, baseline, options.threshold)
+        for fixture, stage, metric, old, new in regressions:
+            print "REGRESSION: {0} {1} {2} {3:.3f} -> {4:.3f}".format(fixture, stage, metric,
+                                                                     old, new)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,11 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Logic for controlling a desktop Chrome browser"""
+import logging
+import shutil
 from .desktop_browser import DesktopBrowser
 from .devtools_browser import DevtoolsBrowser
+from .run_timing import span
 
 CHROME_COMMAND_LINE_OPTIONS = [
     '--disable-background-networking',
@@ -40,17 +43,32 @@ class ChromeDesktop(DesktopBrowser, DevtoolsBrowser):
         self.options = options
         DesktopBrowser.__init__(self, path, job)
         DevtoolsBrowser.__init__(self, job)
+        self.warm = False
 
     def launch(self, job, task):
         """Launch the browser"""
-        args = CHROME_COMMAND_LINE_OPTIONS
-        host_rules = HOST_RULES
+        args = list(CHROME_COMMAND_LINE_OPTIONS)
+        host_rules = list(HOST_RULES)
         if 'host_rules' in task:
             host_rules.extend(task['host_rules'])
+        # Passed to the browser even with the DNS stub (which applies them too) so they
+        # hold for anything that resolves around it
+        if 'dns_rules' in task:
+            for rule in task['dns_rules']:
+                if 'exclude' in rule:
+                    host_rules.append('"MAP {0} 127.0.0.1, EXCLUDE {1}"'.format(
+                        rule['host'], rule['exclude']))
+                elif 'block' in rule and rule['block']:
+                    host_rules.append('"MAP {0} 127.0.0.1"'.format(rule['host']))
+                else:
+                    host_rules.append('"MAP {0} {1}"'.format(rule['host'], rule['address']))
         args.append('--host-rules=' + ','.join(host_rules))
         args.extend(['--window-position="0,0"',
                      '--window-size="{0:d},{1:d}"'.format(task['width'], task['height'])])
         args.append('--remote-debugging-port={0:d}'.format(task['port']))
+        if 'proxy' in task:
+            args.append('--proxy-server="socks5://{0}"'.format(task['proxy']))
+            args.append('--proxy-bypass-list="<-loopback>"')
         if 'ignoreSSL' in job and job['ignoreSSL']:
             args.append('--ignore-certificate-errors')
         if 'profile' in task:
@@ -68,12 +86,60 @@ class ChromeDesktop(DesktopBrowser, DevtoolsBrowser):
 
     def run_task(self, task):
         """Run an individual test"""
+        if self.warm or DevtoolsBrowser.connect(self, task):
+            if not self.warm:
+                DevtoolsBrowser.prepare_browser(self)
+                DevtoolsBrowser.navigate(self, START_PAGE)
+                with span(task, 'wait_for_idle'):
+                    task['idle_wait'] = int(DesktopBrowser.wait_for_idle(self) * 1000)
+            self.warm = False
+            DevtoolsBrowser.run_task(self, task)
+            DevtoolsBrowser.disconnect(self)
+
+    def create_profile_template(self, path, task):
+        """Let Chrome do its first-run profile initialization in the given directory"""
+        ret = False
+        work_dir = path + '.work'
+        template_task = {'width': task['width'], 'height': task['height'],
+                         'port': task['port'], 'profile': path, 'dir': work_dir,
+                         'prefix': '', 'video_subdirectory': 'video'}
+        self.launch({}, template_task)
+        if DevtoolsBrowser.connect(self, template_task):
+            DevtoolsBrowser.navigate(self, START_PAGE)
+            DesktopBrowser.wait_for_idle(self)
+            DevtoolsBrowser.disconnect(self)
+            ret = True
+        self.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return ret
+
+    def warm_up(self, task):
+        """Connect to the pre-launched browser and let it go idle on the start page"""
+        self.warm = False
         if DevtoolsBrowser.connect(self, task):
             DevtoolsBrowser.prepare_browser(self)
             DevtoolsBrowser.navigate(self, START_PAGE)
-            DesktopBrowser.wait_for_idle(self)
-            DevtoolsBrowser.run_task(self, task)
+            with span(task, 'wait_for_idle'):
+                task['idle_wait'] = int(DesktopBrowser.wait_for_idle(self) * 1000)
+            self.warm = True
+        return self.warm
+
+    def is_warm(self, task):
+        """Make sure the pre-launched browser is still alive and clean for the given run"""
+        if self.warm and self.devtools is not None:
+            url = self.devtools.execute_js('window.location.href')
+            if url != START_PAGE:
+                logging.critical("Pre-launched browser is on %s, not %s", url, START_PAGE)
+                self.warm = False
+            elif not task['cached']:
+                # First views must not see anything left over from browser startup
+                self.devtools.send_command('Network.clearBrowserCache', {}, wait=True)
+                self.devtools.send_command('Network.clearBrowserCookies', {}, wait=True)
+        else:
+            self.warm = False
+        if not self.warm:
             DevtoolsBrowser.disconnect(self)
+        return self.warm
 
     def on_start_recording(self, task):
         """Notification that we are about to start an operation that needs to be recorded"""
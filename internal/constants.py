@@ -5,3 +5,15 @@
 
 CURRENT_VERSION = 1
 START_BROWSER_TIME_LIMIT = 30
+STOP_BROWSER_TIME_LIMIT = 10
+# Browser idle detection: CPU (in cores) the browser process tree can use and still be
+# considered idle, how long it has to stay there and how often to check
+IDLE_CPU_THRESHOLD = 0.2
+IDLE_SETTLE_TIME = 0.5
+IDLE_CHECK_INTERVAL = 0.1
+# Resource (CPU/bandwidth/memory) sampling rate while recording (in Hz)
+RESOURCE_SAMPLE_RATE = 10
+RESOURCE_SAMPLE_RATE_MIN = 10
+RESOURCE_SAMPLE_RATE_MAX = 100
+# How often to sample the per-process usage of the browser process tree (in seconds)
+PROCESS_SAMPLE_INTERVAL = 1.0
@@ -3,143 +3,238 @@
 # found in the LICENSE file.
 """Base class support for desktop browsers"""
 import gzip
+import hashlib
 import logging
 import os
-import Queue
+import platform
 import shutil
 import subprocess
-import threading
 import time
 import constants
 import monotonic
+import ujson as json
+from .result_archive import archive_file
+
+# Files and directories that are removed from the profile template after the
+# browser has initialized it (locks, caches and session state)
+PROFILE_VOLATILE_FILES = ['SingletonLock', 'SingletonSocket', 'SingletonCookie', 'lockfile',
+                          'ShaderCache', 'GrShaderCache', 'Crashpad', 'Last Session', 'Last Tabs',
+                          os.path.join('Default', 'Cache'),
+                          os.path.join('Default', 'Code Cache'),
+                          os.path.join('Default', 'GPUCache'),
+                          os.path.join('Default', 'Current Session'),
+                          os.path.join('Default', 'Current Tabs'),
+                          os.path.join('Default', 'Last Session'),
+                          os.path.join('Default', 'Last Tabs')]
 
 class DesktopBrowser(object):
     """Desktop Browser base"""
     def __init__(self, path, job):
         self.path = path
         self.proc = None
+        self.process_group = None
         self.job = job
         self.recording = False
-        self.usage_queue = None
-        self.thread = None
+        self.sampler = None
 
     def prepare(self, _, task):
         """Prepare the profile/OS for the browser"""
         try:
-            from .os_util import kill_all
             from .os_util import flush_dns
+            from .os_util import discard_directory
             logging.debug("Preparing browser")
-            kill_all(os.path.basename(self.path), True)
-            flush_dns()
+            if self.process_group is not None:
+                self.process_group.stop()
+                self.process_group = None
+            # The DNS stub starts every run with an empty cache on its own but any OS cache
+            # in front of it still needs flushing unless the stub is the only resolver
+            if 'dns_stub_only' not in task or not task['dns_stub_only']:
+                flush_dns()
             if 'profile' in task:
+                task['profile_clean'] = False
                 if not task['cached'] and os.path.isdir(task['profile']):
                     logging.debug("Clearing profile %s", task['profile'])
-                    shutil.rmtree(task['profile'])
+                    discard_directory(task['profile'])
+                template = None
+                if not task['cached'] and 'profile_templates' in task:
+                    template = self.get_profile_template(task)
+                    if template is not None:
+                        self.clone_profile(template, task['profile'])
                 if not os.path.isdir(task['profile']):
                     os.makedirs(task['profile'])
+                # Make sure first views start from exactly the template (or nothing)
+                if not task['cached']:
+                    expected = sorted(os.listdir(template)) if template is not None else []
+                    task['profile_clean'] = sorted(os.listdir(task['profile'])) == expected
         except BaseException as err:
             logging.critical("Exception preparing Browser: %s", err.__str__())
 
+    def get_profile_template(self, task):
+        """Find (or build) the pre-initialized profile for this browser build"""
+        template = None
+        build = '{0}|{1:d}|{2:d}'.format(self.path, int(os.path.getmtime(self.path)),
+                                         os.path.getsize(self.path))
+        key = hashlib.md5(build).hexdigest()
+        path = os.path.join(task['profile_templates'], key)
+        if not os.path.isdir(path) and hasattr(self, 'create_profile_template'):
+            # Only keep the template for the current browser build
+            if os.path.isdir(task['profile_templates']):
+                for name in os.listdir(task['profile_templates']):
+                    shutil.rmtree(os.path.join(task['profile_templates'], name),
+                                  ignore_errors=True)
+            else:
+                os.makedirs(task['profile_templates'])
+            tmp_path = path + '.tmp'
+            logging.debug("Building profile template %s", tmp_path)
+            if self.create_profile_template(tmp_path, task):
+                for name in PROFILE_VOLATILE_FILES:
+                    volatile = os.path.join(tmp_path, name)
+                    if os.path.isdir(volatile):
+                        shutil.rmtree(volatile, ignore_errors=True)
+                    elif os.path.exists(volatile) or os.path.islink(volatile):
+                        os.remove(volatile)
+                os.rename(tmp_path, path)
+            else:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        if os.path.isdir(path):
+            template = path
+        return template
+
+    def clone_profile(self, template, profile):
+        """Copy the profile template, using copy-on-write clones where the filesystem allows"""
+        logging.debug("Cloning profile template %s to %s", template, profile)
+        # Anything left behind (if discarding the old profile failed) would end up mixed in
+        if os.path.isdir(profile):
+            shutil.rmtree(profile, ignore_errors=True)
+        # Copy the template's contents (not the template directory itself) so it lands in
+        # the right place even if the profile directory couldn't be removed
+        if platform.system() == "Linux" and \
+                subprocess.call(['cp', '-a', '--reflink=auto', os.path.join(template, '.'),
+                                 profile]) == 0:
+            return
+        if os.path.isdir(profile):
+            shutil.rmtree(profile)
+        shutil.copytree(template, profile, symlinks=True)
+
     def launch_browser(self, command_line):
         """Launch the browser and keep track of the process"""
-        logging.debug(command_line)
-        self.proc = subprocess.Popen(command_line, shell=True)
+        from .os_util import ProcessGroup
+        self.process_group = ProcessGroup(command_line)
+        self.proc = self.process_group.launch()
 
     def stop(self):
         """Terminate the browser (gently at first but forced if needed)"""
-        from .os_util import kill_all
         logging.debug("Stopping browser")
-        if self.proc:
-            kill_all(os.path.basename(self.path), False)
-            self.proc.terminate()
-            self.proc.kill()
-            self.proc = None
+        if self.process_group is not None:
+            self.process_group.stop(constants.STOP_BROWSER_TIME_LIMIT)
+            self.process_group = None
+        self.proc = None
 
-    def wait_for_idle(self):
-        """Wait for no more than 20% of a single core used for 500ms"""
-        import psutil
+    def wait_for_idle(self, settle_time=constants.IDLE_SETTLE_TIME,
+                      timeout=constants.START_BROWSER_TIME_LIMIT):
+        """Wait for the browser process tree to stay under the idle CPU threshold for
+        settle_time seconds. Returns how long the wait took (in seconds)."""
+        from .os_util import get_process_tree_stats
         logging.debug("Waiting for Idle...")
+        start_time = monotonic.monotonic()
+        end_time = start_time + timeout
+        idle = False
+        last_time = start_time
+        last = get_process_tree_stats(self.proc.pid) if self.proc is not None else {}
+        if not last:
+            return self.wait_for_system_idle(settle_time, timeout)
+        idle_start = None
+        while not idle and monotonic.monotonic() < end_time:
+            time.sleep(constants.IDLE_CHECK_INTERVAL)
+            now = monotonic.monotonic()
+            current = get_process_tree_stats(self.proc.pid)
+            # Only count the CPU used by each process since the last check so processes
+            # that exit don't make the total go backwards
+            cpu = 0.0
+            for pid in current:
+                cpu += current[pid]['cpu'] - (last[pid]['cpu'] if pid in last else 0.0)
+            usage = cpu / (now - last_time) if now > last_time else 0.0
+            if usage <= constants.IDLE_CPU_THRESHOLD:
+                if idle_start is None:
+                    idle_start = last_time
+                if now - idle_start >= settle_time:
+                    idle = True
+            else:
+                idle_start = None
+            last = current
+            last_time = now
+        elapsed = monotonic.monotonic() - start_time
+        logging.debug("Browser %s after %0.3f seconds", "idle" if idle else "not idle", elapsed)
+        return elapsed
+
+    def wait_for_system_idle(self, settle_time, timeout):
+        """Fall back to waiting for the system-wide CPU to go idle"""
+        import psutil
+        start_time = monotonic.monotonic()
         cpu_count = psutil.cpu_count()
         if cpu_count > 0:
-            target_pct = 20. / float(cpu_count)
+            target_pct = constants.IDLE_CPU_THRESHOLD * 100. / float(cpu_count)
             idle_start = None
-            end_time = monotonic.monotonic() + constants.START_BROWSER_TIME_LIMIT
+            end_time = start_time + timeout
             idle = False
             while not idle and monotonic.monotonic() < end_time:
                 check_start = monotonic.monotonic()
-                pct = psutil.cpu_percent(interval=0.1)
+                pct = psutil.cpu_percent(interval=constants.IDLE_CHECK_INTERVAL)
                 if pct <= target_pct:
                     if idle_start is None:
                         idle_start = check_start
-                    if monotonic.monotonic() - idle_start > 0.5:
+                    if monotonic.monotonic() - idle_start > settle_time:
                         idle = True
                 else:
                     idle_start = None
+        return monotonic.monotonic() - start_time
 
     def clear_profile(self, task):
         """Delete the browser profile directory"""
+        from .os_util import discard_directory
         if os.path.isdir(task['profile']):
-            end_time = monotonic.monotonic() + 30
-            while monotonic.monotonic() < end_time:
-                shutil.rmtree(task['profile'])
-                if os.path.isdir(task['profile']):
-                    time.sleep(0.1)
-                else:
-                    break
+            discard_directory(task['profile'])
 
     def on_start_recording(self, task):
         """Notification that we are about to start an operation that needs to be recorded"""
         if task['log_data']:
+            from .resource_sampler import ResourceSampler
             self.recording = True
-            self.usage_queue = Queue.Queue()
-            self.thread = threading.Thread(target=self.background_thread)
-            self.thread.daemon = True
-            self.thread.start()
+            # The netlog trace events have the per-connection byte counts so the network
+            # counters only need polling when no netlog is being recorded
+            poll_bandwidth = 'netlog_bandwidth' not in task or not task['netlog_bandwidth']
+            rate = task['sample_rate'] if 'sample_rate' in task else \
+                constants.RESOURCE_SAMPLE_RATE
+            self.sampler = ResourceSampler(self.proc.pid if self.proc is not None else None,
+                                           rate=rate, duration=task['time_limit'],
+                                           poll_bandwidth=poll_bandwidth)
+            self.sampler.start()
 
     def on_stop_recording(self, task):
         """Notification that we are about to start an operation that needs to be recorded"""
         self.recording = False
-        if self.thread is not None:
-            self.thread.join()
-            self.thread = None
-        # record the CPU/Bandwidth/memory info
-        if self.usage_queue is not None and not self.usage_queue.empty() and task is not None:
-            file_path = os.path.join(task['dir'], task['prefix']) + 'progress.csv.gz'
-            gzfile = gzip.open(file_path, 'wb')
-            if gzfile:
-                gzfile.write("Offset Time (ms),Bandwidth In (bps),CPU Utilization (%),Memory\n")
-                while not self.usage_queue.empty():
-                    snapshot = self.usage_queue.get_nowait()
-                    gzfile.write('{0:d},{1:d},{2:0.2f},-1\n'.format(
-                        snapshot['time'], snapshot['bw'], snapshot['cpu']))
-                gzfile.close()
-
-    def get_net_bytes(self):
-        """Get the bytes received, ignoring the loopback interface"""
-        import psutil
-        bytes_in = 0
-        net = psutil.net_io_counters(True)
-        for interface in net:
-            if interface != 'lo':
-                bytes_in += net[interface].bytes_recv
-        return bytes_in
-
-    def background_thread(self):
-        """Background thread for monitoring CPU and bandwidth usage"""
-        import psutil
-        last_time = start_time = monotonic.monotonic()
-        last_bytes = self.get_net_bytes()
-        snapshot = {'time': 0, 'cpu': 0.0, 'bw': 0}
-        self.usage_queue.put(snapshot)
-        while self.recording:
-            snapshot = {'bw': 0}
-            snapshot['cpu'] = psutil.cpu_percent(interval=0.1)
-            now = monotonic.monotonic()
-            snapshot['time'] = int((now - start_time) * 1000)
-            # calculate the bandwidth over the last interval in Kbps
-            bytes_in = self.get_net_bytes()
-            if now > last_time:
-                snapshot['bw'] = int((bytes_in - last_bytes) * 8.0 / (now - last_time))
-            last_time = now
-            last_bytes = bytes_in
-            self.usage_queue.put(snapshot)
+        if self.sampler is not None:
+            self.sampler.stop()
+            # record the CPU/Bandwidth/memory info
+            if task is not None:
+                task['recording_start'] = self.sampler.start_wall
+            if self.sampler.count and task is not None:
+                file_path = os.path.join(task['dir'], task['prefix']) + 'progress.csv.gz'
+                gzfile = gzip.open(file_path, 'wb')
+                if gzfile:
+                    gzfile.write("Offset Time (ms),Bandwidth In (bps),CPU Utilization (%),"
+                                 "Memory\n")
+                    for sample in self.sampler.get_samples():
+                        gzfile.write('{0:d},{1:d},{2:0.2f},{3:d}\n'.format(*sample))
+                    gzfile.close()
+                # The bandwidth gets filled in from the netlog (and archived) after the
+                # trace is processed
+                if 'netlog_bandwidth' not in task or not task['netlog_bandwidth']:
+                    archive_file(task, file_path)
+            # Per-process breakdown of the browser process tree
+            if self.sampler.processes and task is not None:
+                file_path = os.path.join(task['dir'], task['prefix']) + 'process_usage.json.gz'
+                with gzip.open(file_path, 'wb') as f_out:
+                    json.dump(self.sampler.get_process_usage(), f_out)
+                archive_file(task, file_path)
+            self.sampler = None
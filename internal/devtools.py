@@ -3,13 +3,17 @@
 # found in the LICENSE file.
 """Main entry point for interfacing with Chrome's remote debugging protocol"""
 import base64
-import gzip
 import logging
 import os
+import shutil
 import subprocess
 import time
 import monotonic
 import ujson as json
+from .log_writer import GzipLogWriter
+from .result_archive import archive_file
+from .run_timing import span
+from .screencast import ScreencastWriter, SCREENCAST_MAX_SIZE, SCREENCAST_QUALITY
 
 class DevTools(object):
     """Interface into Chrome's remote dev tools protocol"""
@@ -34,6 +38,10 @@ class DevTools(object):
         self.support_path = None
         self.video_path = None
         self.video_prefix = None
+        self.screencast = None
+        self.navigation_wall_time = None
+        self.navigation_start_time = None
+        self.message_count = 0
         self.prepare()
 
     def prepare(self):
@@ -42,6 +50,7 @@ class DevTools(object):
         self.trace_ts_start = None
         self.nav_error = None
         self.main_request = None
+        self.navigation_wall_time = None
         self.path_base = os.path.join(self.task['dir'], self.task['prefix'])
         self.support_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "support")
         self.video_path = os.path.join(self.task['dir'], self.task['video_subdirectory'])
@@ -53,6 +62,8 @@ class DevTools(object):
         """Indicate that we are about to start a known-navigation"""
         self.main_frame = None
         self.is_navigating = True
+        # Fallback for lining up screencast frames if the request doesn't report its wallTime
+        self.navigation_start_time = time.time()
 
     def connect(self, timeout):
         """Connect to the browser"""
@@ -95,14 +106,24 @@ class DevTools(object):
         if self.websocket:
             self.websocket.close()
             self.websocket = None
+        if self.message_count:
+            if 'devtools_messages' not in self.task:
+                self.task['devtools_messages'] = 0
+            self.task['devtools_messages'] += self.message_count
+            self.message_count = 0
 
     def start_recording(self):
         """Start capturing dev tools, timeline and trace data"""
         self.prepare()
+        capture = self.task['video_capture'] if 'video_capture' in self.task else 'trace'
         if 'Capture Video' in self.job and self.job['Capture Video'] and self.task['log_data']:
             self.grab_screenshot(self.video_prefix + '000000.png')
+        else:
+            capture = None
         self.flush_pending_messages()
         self.send_command('Page.enable', {})
+        if capture == 'screencast' or capture == 'compare':
+            self.start_screencast(capture == 'compare')
         self.send_command('Inspector.enable', {})
         self.send_command('Network.enable', {})
         if self.task['log_data']:
@@ -121,28 +142,76 @@ class DevTools(object):
                 trace += ",disabled-by-default-blink.feature_usage"
                 trace += ",toplevel,disabled-by-default-devtools.timeline.frame"
                 trace += "devtools.timeline.frame"
-            if 'Capture Video' in self.job and self.job['Capture Video']:
+            if capture == 'trace' or capture == 'compare':
                 trace += ",disabled-by-default-devtools.screenshot"
             trace += ",blink.user_timing"
+            # Socket-level netlog events replace the polled bandwidth data for the run
+            # if they produce any traffic
+            if trace.find('netlog') == -1:
+                trace += ",netlog"
+            self.task['netlog_bandwidth'] = True
             self.trace_enabled = True
             self.send_command('Tracing.start',
                               {'categories': trace, 'options': 'record-as-much-as-possible'})
         if 'web10' not in self.task or not self.task['web10']:
             self.last_activity = monotonic.monotonic()
 
+    def start_screencast(self, compare):
+        """Capture the video frames with Page.startScreencast (into a separate directory
+        when comparing against the trace screenshots)"""
+        video_path = self.video_path
+        if compare:
+            video_path = self.video_path + '_screencast'
+            if not os.path.isdir(video_path):
+                os.makedirs(video_path)
+            initial_frame = self.video_prefix + '000000.png'
+            if os.path.isfile(initial_frame):
+                shutil.copy(initial_frame, os.path.join(video_path, 'ms_000000.png'))
+        self.screencast = ScreencastWriter(video_path)
+        quality = self.task['screencast_quality'] if 'screencast_quality' in self.task \
+                  else SCREENCAST_QUALITY
+        max_size = self.task['screencast_size'] if 'screencast_size' in self.task \
+                   else SCREENCAST_MAX_SIZE
+        self.send_command('Page.startScreencast', {'format': 'jpeg', 'quality': quality,
+                                                   'maxWidth': max_size, 'maxHeight': max_size,
+                                                   'everyNthFrame': 1})
+
+    def stop_screencast(self):
+        """Stop the screencast and name the frames relative to the navigation start"""
+        if self.screencast is not None:
+            self.send_command('Page.stopScreencast', {})
+            self.screencast.stop(self.navigation_wall_time if self.navigation_wall_time is not None
+                                 else self.navigation_start_time)
+            self.screencast = None
+
+    def process_screencast_frame(self, msg):
+        """Hand a frame to the writer and ack it so the browser sends the next one"""
+        if 'params' in msg and 'sessionId' in msg['params']:
+            # Acking after the frame is queued holds the browser back if the writer falls behind
+            if self.screencast is not None and 'data' in msg['params'] and \
+                    'metadata' in msg['params'] and 'timestamp' in msg['params']['metadata']:
+                self.screencast.write(msg['params']['data'],
+                                      msg['params']['metadata']['timestamp'])
+            self.send_command('Page.screencastFrameAck', {'sessionId': msg['params']['sessionId']})
+
     def stop_recording(self):
         """Stop capturing dev tools, timeline and trace data"""
+        self.stop_screencast()
         self.send_command('Inspector.disable', {})
         self.send_command('Page.disable', {})
         if self.task['log_data']:
             self.send_command('Security.disable', {})
             self.send_command('Console.disable', {})
-            self.get_response_bodies()
+            with span(self.task, 'get_response_bodies'):
+                self.get_response_bodies()
         self.send_command('Network.disable', {})
+        # For lining the netlog traffic up with the resource samples
+        self.task['navigation_wall_time'] = self.navigation_wall_time \
+            if self.navigation_wall_time is not None else self.navigation_start_time
         if self.dev_tools_file is not None:
-            self.dev_tools_file.write("\n]")
             self.dev_tools_file.close()
             self.dev_tools_file = None
+            archive_file(self.task, self.path_base + 'devtools.json.gz')
         self.collect_trace()
 
     def collect_trace(self):
@@ -161,6 +230,9 @@ class DevTools(object):
                     try:
                         raw = self.websocket.recv()
                         if raw is not None and len(raw):
+                            if self.process_raw_trace_data(raw):
+                                last_message = monotonic.monotonic()
+                                continue
                             msg = json.loads(raw)
                             if 'method' in msg:
                                 if msg['method'] == 'Tracing.tracingComplete':
@@ -171,7 +243,6 @@ class DevTools(object):
                     except BaseException as _:
                         pass
             if self.trace_file is not None:
-                self.trace_file.write("\n]}")
                 self.trace_file.close()
                 self.trace_file = None
 
@@ -213,6 +284,7 @@ class DevTools(object):
                                     zip_file.writestr(name, body)
             if zip_file is not None:
                 zip_file.close()
+                archive_file(self.task, self.path_base + 'bodies.zip')
 
     def get_requests(self):
         """Get a dictionary of all of the requests and the details (headers, body file)"""
@@ -283,7 +355,8 @@ class DevTools(object):
         ret = None
         if self.websocket:
             self.command_id += 1
-            msg = {'id': self.command_id, 'method': method, 'params': params}
+            command_id = self.command_id
+            msg = {'id': command_id, 'method': method, 'params': params}
             try:
                 out = json.dumps(msg)
                 logging.debug("Sending: %s", out)
@@ -297,8 +370,12 @@ class DevTools(object):
                             if raw is not None and len(raw):
                                 logging.debug(raw[:1000])
                                 msg = json.loads(raw)
-                                if 'id' in msg and int(msg['id']) == self.command_id:
+                                if 'id' in msg and int(msg['id']) == command_id:
                                     ret = msg
+                                elif 'method' in msg and \
+                                        msg['method'] == 'Page.screencastFrame':
+                                    # Unacked frames stall the screencast
+                                    self.process_screencast_frame(msg)
                         except BaseException as _:
                             pass
             except BaseException as err:
@@ -319,7 +396,7 @@ class DevTools(object):
                         logging.debug(raw[:1000])
                         msg = json.loads(raw)
                         if 'method' in msg:
-                            self.process_message(msg)
+                            self.process_message(msg, raw)
                 except BaseException as _:
                     # ignore timeouts when we're in a polling read loop
                     pass
@@ -365,24 +442,28 @@ class DevTools(object):
             ret = response['result']['result']['value']
         return ret
 
-    def process_message(self, msg):
-        """Process an inbound dev tools message"""
+    def process_message(self, msg, raw=None):
+        """Process an inbound dev tools message (raw is the original websocket frame)"""
+        self.message_count += 1
         parts = msg['method'].split('.')
         if len(parts) >= 2:
             category = parts[0]
             event = parts[1]
             if category == 'Page':
-                self.process_page_event(event, msg)
-                self.log_dev_tools_event(msg)
+                if event == 'screencastFrame':
+                    self.process_screencast_frame(msg)
+                else:
+                    self.process_page_event(event, msg)
+                    self.log_dev_tools_event(msg, raw)
             elif category == 'Network':
                 self.process_network_event(event, msg)
-                self.log_dev_tools_event(msg)
+                self.log_dev_tools_event(msg, raw)
             elif category == 'Inspector':
                 self.process_inspector_event(event)
             elif category == 'Tracing':
                 self.process_trace_event(msg)
             else:
-                self.log_dev_tools_event(msg)
+                self.log_dev_tools_event(msg, raw)
 
     def process_page_event(self, event, msg):
         """Process Page.* dev tools events"""
@@ -427,6 +508,9 @@ class DevTools(object):
                         msg['params']['frameId'] == self.main_frame:
                     logging.debug('Main request detected')
                     self.main_request = request_id
+                    if 'wallTime' in msg['params']:
+                        # Screencast frames are timestamped by the wall clock
+                        self.navigation_wall_time = msg['params']['wallTime']
             elif event == 'resourceChangedPriority':
                 if 'priority' not in self.requests[request_id]:
                     self.requests[request_id]['priority'] = []
@@ -470,45 +554,87 @@ class DevTools(object):
                 'params' in msg and \
                 'value' in msg['params'] and \
                 len(msg['params']['value']):
-            if self.trace_file is None:
-                self.trace_file = gzip.open(self.path_base + 'trace.json.gz', 'wb')
-                self.trace_file.write('{"traceEvents":[{}')
+            self.open_trace_file()
             # write out the trace events one-per-line but pull out any
             # devtools screenshots as separate files.
             if self.trace_file is not None:
-                for index in xrange(len(msg['params']['value'])):
-                    trace_event = msg['params']['value'][index]
-                    is_screenshot = False
-                    if 'cat' in trace_event and 'name' in trace_event and 'ts' in trace_event:
-                        if self.trace_ts_start is None and \
-                                trace_event['name'] == 'navigationStart' and \
-                                trace_event['cat'].find('blink.user_timing') > -1:
-                            self.trace_ts_start = trace_event['ts']
-                        if trace_event['name'] == 'Screenshot' and \
-                                trace_event['cat'].find('devtools.screenshot') > -1:
-                            is_screenshot = True
-                            if self.trace_ts_start is not None and \
-                                    'args' in trace_event and \
-                                    'snapshot' in trace_event['args']:
-                                ms_elapsed = int(round(float(trace_event['ts'] - \
-                                                             self.trace_ts_start) / 1000.0))
-                                if ms_elapsed >= 0:
-                                    path = '{0}{1:06d}.png'.format(self.video_prefix, ms_elapsed)
-                                    with open(path, 'wb') as image_file:
-                                        image_file.write(
-                                            base64.b64decode(trace_event['args']['snapshot']))
-                    if not is_screenshot:
-                        self.trace_file.write(",\n")
-                        self.trace_file.write(json.dumps(trace_event))
+                trace_events = []
+                for trace_event in msg['params']['value']:
+                    if not self.inspect_trace_event(trace_event):
+                        trace_events.append(trace_event)
+                # Serializing and compressing happens on the writer thread
+                self.trace_file.write(trace_events)
                 logging.debug("Processed %d trace events", len(msg['params']['value']))
 
-    def log_dev_tools_event(self, msg):
-        """Log the dev tools events to a file"""
+    def process_raw_trace_data(self, raw):
+        """Fast path for Tracing.dataCollected that copies the original event text to the
+        trace file and only decodes the events that might be screenshots or navigationStart.
+        Returns False if the message needs to go through the full decode."""
+        if raw.find('"Tracing.dataCollected"', 0, 100) < 0:
+            return False
+        start = raw.find('"value":[')
+        end = raw.rfind(']')
+        if start < 0 or raw.find('[') != start + 8 or end < start or \
+                raw[end:].replace(' ', '') != ']}}':
+            return False
+        # Chrome separates the events with ",\n" and JSON strings can't hold a raw newline
+        # so splitting on it lands exactly on the event boundaries
+        events = raw[start + 9:end].split(',\n')
+        if len(events) == 1 and events[0].find('},{') >= 0:
+            return False
+        for event in events:
+            if not event.startswith('{') or not event.endswith('}'):
+                return False
+        self.open_trace_file()
+        if self.trace_file is not None:
+            trace_events = []
+            for event in events:
+                if event.find('"Screenshot"') >= 0 or \
+                        (self.trace_ts_start is None and event.find('"navigationStart"') >= 0):
+                    if self.inspect_trace_event(json.loads(event)):
+                        continue
+                trace_events.append(event)
+            self.trace_file.write(trace_events)
+            logging.debug("Passed through %d trace events", len(events))
+        return True
+
+    def open_trace_file(self):
+        """Start the trace file when the first events arrive"""
+        if self.trace_file is None:
+            self.trace_file = GzipLogWriter(self.path_base + 'trace.json.gz',
+                                            '{"traceEvents":[{}', "\n]}",
+                                            self.task.get('log_gzip_level'))
+
+    def inspect_trace_event(self, trace_event):
+        """Pick up the navigation start time and save any screenshot events as separate
+        files. Returns True for screenshots (which are kept out of the trace file)."""
+        is_screenshot = False
+        if 'cat' in trace_event and 'name' in trace_event and 'ts' in trace_event:
+            if self.trace_ts_start is None and \
+                    trace_event['name'] == 'navigationStart' and \
+                    trace_event['cat'].find('blink.user_timing') > -1:
+                self.trace_ts_start = trace_event['ts']
+            if trace_event['name'] == 'Screenshot' and \
+                    trace_event['cat'].find('devtools.screenshot') > -1:
+                is_screenshot = True
+                if self.trace_ts_start is not None and \
+                        'args' in trace_event and \
+                        'snapshot' in trace_event['args']:
+                    ms_elapsed = int(round(float(trace_event['ts'] - \
+                                                 self.trace_ts_start) / 1000.0))
+                    if ms_elapsed >= 0:
+                        path = '{0}{1:06d}.png'.format(self.video_prefix, ms_elapsed)
+                        with open(path, 'wb') as image_file:
+                            image_file.write(
+                                base64.b64decode(trace_event['args']['snapshot']))
+        return is_screenshot
+
+    def log_dev_tools_event(self, msg, raw=None):
+        """Log the dev tools events to a file (the raw frame as-is when we have it)"""
         if self.task['log_data']:
             if self.dev_tools_file is None:
-                path = self.path_base + 'devtools.json.gz'
-                self.dev_tools_file = gzip.open(path, 'wb')
-                self.dev_tools_file.write("[{}")
+                self.dev_tools_file = GzipLogWriter(self.path_base + 'devtools.json.gz',
+                                                    "[{}", "\n]",
+                                                    self.task.get('log_gzip_level'))
             if self.dev_tools_file is not None:
-                self.dev_tools_file.write(",\n")
-                self.dev_tools_file.write(json.dumps(msg))
+                self.dev_tools_file.write(raw if raw is not None else msg)
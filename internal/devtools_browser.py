@@ -12,6 +12,8 @@ import monotonic
 import ujson as json
 import constants
 from .optimization_checks import OptimizationChecks
+from .result_archive import archive_file
+from .run_timing import span
 
 class DevtoolsBrowser(object):
     """Devtools Browser base"""
@@ -28,7 +30,9 @@ class DevtoolsBrowser(object):
         ret = False
         from internal.devtools import DevTools
         self.devtools = DevTools(self.job, task)
-        if self.devtools.connect(constants.START_BROWSER_TIME_LIMIT):
+        with span(task, 'connect'):
+            connected = self.devtools.connect(constants.START_BROWSER_TIME_LIMIT)
+        if connected:
             logging.debug("Devtools connected")
             ret = True
         else:
@@ -102,22 +106,28 @@ class DevtoolsBrowser(object):
                 if not recording and command['record']:
                     recording = True
                     self.on_start_recording(task)
-                self.process_command(command)
+                with span(task, command['command']):
+                    self.process_command(command)
                 if command['record']:
-                    self.devtools.wait_for_page_load()
+                    with span(task, 'wait_for_page_load'):
+                        self.devtools.wait_for_page_load()
                     if not task['combine_steps'] or not len(task['script']):
-                        self.on_stop_recording(task)
+                        with span(task, 'stop_recording'):
+                            self.on_stop_recording(task)
                         recording = False
                         if task['log_data']:
-                            if self.job['pngss']:
-                                screen_shot = os.path.join(task['dir'],
-                                                           task['prefix'] + 'screen.png')
-                                self.devtools.grab_screenshot(screen_shot, png=True)
-                            else:
-                                screen_shot = os.path.join(task['dir'],
-                                                           task['prefix'] + 'screen.jpg')
-                                self.devtools.grab_screenshot(screen_shot, png=False)
-                            self.collect_browser_metrics(task)
+                            with span(task, 'screenshot'):
+                                if self.job['pngss']:
+                                    screen_shot = os.path.join(task['dir'],
+                                                               task['prefix'] + 'screen.png')
+                                    self.devtools.grab_screenshot(screen_shot, png=True)
+                                else:
+                                    screen_shot = os.path.join(task['dir'],
+                                                               task['prefix'] + 'screen.jpg')
+                                    self.devtools.grab_screenshot(screen_shot, png=False)
+                            archive_file(task, screen_shot)
+                            with span(task, 'browser_metrics'):
+                                self.collect_browser_metrics(task)
                             # Post-process each step separately
                             optimization = OptimizationChecks(self.job, task, self.get_requests())
                             optimization.start()
@@ -151,25 +161,78 @@ class DevtoolsBrowser(object):
         """Post process the video"""
         from internal.video_processing import VideoProcessing
         video = VideoProcessing(self.job, self.task)
-        video.process()
+        with span(self.task, 'video'):
+            video.process()
 
     def process_trace(self):
         """Post-process the trace file"""
         path_base = os.path.join(self.task['dir'], self.task['prefix'])
         trace_file = path_base + 'trace.json.gz'
+        progress_file = path_base + 'progress.csv.gz'
         if os.path.isfile(trace_file):
+            trace_span = span(self.task, 'trace')
             user_timing = path_base + 'user_timing.json.gz'
             cpu_slices = path_base + 'timeline_cpu.json.gz'
             script_timing = path_base + 'script_timing.json.gz'
             feature_usage = path_base + 'feature_usage.json.gz'
             interactive = path_base + 'interactive.json.gz'
             v8_stats = path_base + 'v8stats.json.gz'
+            netlog = path_base + 'netlog.json.gz'
             trace_parser = os.path.join(self.support_path, "trace-parser.py")
             cmd = ['python', trace_parser, '-t', trace_file, '-u', user_timing,
                    '-c', cpu_slices, '-j', script_timing, '-f', feature_usage,
-                   '-i', interactive, '-s', v8_stats]
+                   '-i', interactive, '-s', v8_stats, '-n', netlog]
+            if 'recording_start' in self.task and self.task['recording_start'] is not None and \
+                    'navigation_wall_time' in self.task and \
+                    self.task['navigation_wall_time'] is not None:
+                # Bucket the netlog traffic on the same time base as the resource samples
+                offset = (self.task['navigation_wall_time'] - self.task['recording_start']) * 1000.0
+                cmd.extend(['-o', '{0:0.3f}'.format(offset)])
             logging.debug(cmd)
             subprocess.call(cmd)
+            if 'netlog_bandwidth' in self.task and self.task['netlog_bandwidth']:
+                self.process_netlog_bandwidth(netlog, progress_file)
+            for path in [trace_file, user_timing, cpu_slices, script_timing, feature_usage,
+                         interactive, v8_stats, netlog]:
+                archive_file(self.task, path)
+            trace_span.end()
+        # The progress data was held back in case the netlog bandwidth replaced it
+        if 'netlog_bandwidth' in self.task and self.task['netlog_bandwidth']:
+            archive_file(self.task, progress_file)
+
+    def process_netlog_bandwidth(self, netlog_file, progress_file):
+        """Fill in the bandwidth column of the progress data from the netlog socket traffic
+        (only if the netlog has traffic on the same time base as the samples)"""
+        if os.path.isfile(netlog_file) and os.path.isfile(progress_file):
+            with gzip.open(netlog_file, 'rb') as f_in:
+                netlog = json.load(f_in)
+            traffic = []
+            if netlog is not None and 'offset' in netlog and 'traffic' in netlog:
+                traffic = netlog['traffic']
+            with gzip.open(progress_file, 'rb') as f_in:
+                lines = f_in.read().splitlines()
+            if traffic and len(lines) > 1:
+                logging.debug("Using the netlog traffic for the bandwidth")
+                index = 0
+                last_time = 0
+                out = [lines[0]]
+                for line in lines[1:]:
+                    fields = line.split(',')
+                    if len(fields) >= 4:
+                        now = int(fields[0])
+                        bytes_in = 0
+                        while index < len(traffic) and traffic[index][0] <= now:
+                            bytes_in += traffic[index][1]
+                            index += 1
+                        if now > last_time:
+                            fields[1] = '{0:d}'.format(
+                                int(bytes_in * 8.0 * 1000.0 / float(now - last_time)))
+                        last_time = now
+                    out.append(','.join(fields))
+                with gzip.open(progress_file, 'wb') as f_out:
+                    f_out.write('\n'.join(out) + '\n')
+            else:
+                logging.debug("No netlog traffic to fill in the bandwidth with")
 
     def run_js_file(self, file_name):
         """Execute one of our js scripts"""
@@ -190,15 +253,21 @@ class DevtoolsBrowser(object):
             path = os.path.join(task['dir'], task['prefix'] + 'timed_events.json.gz')
             with gzip.open(path, 'wb') as outfile:
                 outfile.write(json.dumps(user_timing))
+            archive_file(task, path)
         page_data = self.run_js_file('page_data.js')
         if 'step_name' in task:
             if page_data is None:
                 page_data = {}
             page_data['eventName'] = task['step_name']
+        if 'idle_wait' in task:
+            if page_data is None:
+                page_data = {}
+            page_data['browserIdleWait'] = task['idle_wait']
         if page_data is not None:
             path = os.path.join(task['dir'], task['prefix'] + 'page_data.json.gz')
             with gzip.open(path, 'wb') as outfile:
                 outfile.write(json.dumps(page_data))
+            archive_file(task, path)
         if 'customMetrics' in self.job:
             custom_metrics = {}
             for name in self.job['customMetrics']:
@@ -209,6 +278,7 @@ class DevtoolsBrowser(object):
             path = os.path.join(task['dir'], task['prefix'] + 'metrics.json.gz')
             with gzip.open(path, 'wb') as outfile:
                 outfile.write(json.dumps(custom_metrics))
+            archive_file(task, path)
 
     def process_command(self, command):
         """Process an individual script command"""
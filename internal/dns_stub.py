@@ -0,0 +1,387 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Local caching DNS stub resolver (per-run cache, setdns/blockdomains and lookup timing)"""
+import fnmatch
+import gzip
+import logging
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import uuid
+import monotonic
+import ujson as json
+
+TYPE_A = 1
+TYPE_AAAA = 28
+RECORD_TYPES = {1: 'A', 5: 'CNAME', 28: 'AAAA', 65: 'HTTPS'}
+RCODE_SERVFAIL = 2
+# Seconds to wait for the upstream server before giving up on a query
+UPSTREAM_TIMEOUT = 5.0
+# TTL handed back to the browser for synthesized (setdns/blocked) answers
+OVERRIDE_TTL = 60
+# Address the stub answers its own check lookup with
+CHECK_ADDRESS = '127.0.83.66'
+
+class DnsStub(object):
+    """UDP DNS stub that forwards to the system resolvers with a cache that is reset per run"""
+    def __init__(self, address='127.0.0.1', port=53, upstream=None):
+        self.address = address
+        self.port = port
+        self.upstream = upstream
+        self.socket = None
+        self.upstream_socket = None
+        self.thread = None
+        self.must_exit = False
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.pending = {}
+        self.rules = []
+        self.lookups = []
+        self.start_time = monotonic.monotonic()
+
+    def start(self):
+        """Start listening in a background thread"""
+        ret = False
+        try:
+            if self.upstream is None:
+                self.upstream = self.get_system_resolver()
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind((self.address, self.port))
+            self.port = self.socket.getsockname()[1]
+            self.upstream_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.must_exit = False
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            logging.debug("DNS stub listening on %s:%d (upstream %s)", self.address, self.port,
+                          self.upstream)
+            ret = True
+        except socket.error as err:
+            logging.critical("Error starting the DNS stub on %s:%d: %s", self.address,
+                             self.port, err.__str__())
+        return ret
+
+    def stop(self):
+        """Stop the resolver"""
+        self.must_exit = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for sock in [self.socket, self.upstream_socket]:
+            if sock is not None:
+                sock.close()
+        self.socket = None
+        self.upstream_socket = None
+
+    def reset(self, rules=None):
+        """Start a new run: empty cache, no recorded lookups and the run's setdns/block rules"""
+        with self.lock:
+            self.cache = {}
+            self.pending = {}
+            self.lookups = []
+            self.rules = list(rules) if rules is not None else []
+            self.start_time = monotonic.monotonic()
+
+    def check_system_resolver(self):
+        """Make sure lookups through the system resolver actually reach the stub
+        (a one-off name that only the stub answers with CHECK_ADDRESS)"""
+        ret = False
+        name = 'wptagent-{0}.example.com'.format(uuid.uuid4().hex[:16])
+        self.reset([{'host': name, 'address': CHECK_ADDRESS}])
+        try:
+            ret = socket.gethostbyname(name) == CHECK_ADDRESS
+        except socket.error as err:
+            logging.debug("DNS stub check lookup failed: %s", err.__str__())
+        self.reset()
+        if not ret:
+            logging.critical("The system resolver is not using the DNS stub on %s:%d",
+                             self.address, self.port)
+        return ret
+
+    def get_lookups(self):
+        """The lookups recorded since the last reset"""
+        with self.lock:
+            return list(self.lookups)
+
+    def save_lookups(self, path):
+        """Write the lookups recorded since the last reset"""
+        lookups = self.get_lookups()
+        if len(lookups):
+            with gzip.open(path, 'wb') as f_out:
+                json.dump(lookups, f_out)
+
+    def get_system_resolver(self):
+        """First nameserver from resolv.conf that isn't us"""
+        upstream = None
+        if os.path.isfile('/etc/resolv.conf'):
+            with open('/etc/resolv.conf', 'rb') as resolv:
+                for line in resolv:
+                    parts = line.split()
+                    if upstream is None and len(parts) > 1 and parts[0] == 'nameserver' and \
+                            parts[1] != self.address and parts[1].find(':') == -1:
+                        upstream = parts[1]
+        if upstream is None:
+            upstream = '8.8.8.8'
+        return upstream
+
+    def resolve(self, host):
+        """Blocking lookup of the IPv4 addresses for a host (used in-process by the proxy)"""
+        addresses = []
+        query = build_query(host, TYPE_A, random.randint(0, 0xFFFF))
+        question = parse_question(query)
+        start = monotonic.monotonic()
+        response, source, lookup_name = self.answer_locally(query, question)
+        if response is None:
+            upstream_query = build_query(lookup_name, TYPE_A, struct.unpack('!H', query[:2])[0])
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(UPSTREAM_TIMEOUT)
+            try:
+                sock.sendto(upstream_query, (self.upstream, 53))
+                while response is None:
+                    data, _ = sock.recvfrom(4096)
+                    if data[:2] == query[:2]:
+                        response = self.process_response(query, question, lookup_name, data)
+                source = 'upstream'
+            except socket.error as err:
+                logging.debug("DNS lookup of %s failed: %s", host, err.__str__())
+            sock.close()
+        self.record_lookup(question, start, response, source)
+        if response is not None:
+            for record_type, _, rdata in parse_answers(response):
+                if record_type == TYPE_A:
+                    addresses.append(socket.inet_ntoa(rdata))
+        return addresses
+
+    def run(self):
+        """Main loop: answer queries from the cache/rules and relay the rest upstream"""
+        while not self.must_exit:
+            try:
+                readable, _, _ = select.select([self.socket, self.upstream_socket], [], [], 0.1)
+            except select.error:
+                continue
+            now = monotonic.monotonic()
+            if self.socket in readable:
+                try:
+                    data, client = self.socket.recvfrom(4096)
+                    self.handle_query(data, client, now)
+                except socket.error:
+                    pass
+            if self.upstream_socket in readable:
+                try:
+                    data, _ = self.upstream_socket.recvfrom(4096)
+                    self.handle_response(data, now)
+                except socket.error:
+                    pass
+            self.expire_pending(now)
+
+    def handle_query(self, query, client, now):
+        """Answer a query from the browser"""
+        question = parse_question(query)
+        if question is None:
+            return
+        response, source, lookup_name = self.answer_locally(query, question)
+        if response is not None:
+            self.record_lookup(question, now, response, source)
+            self.socket.sendto(response, client)
+        else:
+            # Relay with our own id so that queries from different clients can't collide
+            with self.lock:
+                upstream_id = random.randint(0, 0xFFFF)
+                while upstream_id in self.pending:
+                    upstream_id = random.randint(0, 0xFFFF)
+                self.pending[upstream_id] = (query, question, client, now, lookup_name)
+            if lookup_name == question[1]:
+                upstream_query = struct.pack('!H', upstream_id) + query[2:]
+            else:
+                upstream_query = build_query(lookup_name, question[2], upstream_id)
+            self.upstream_socket.sendto(upstream_query, (self.upstream, 53))
+
+    def handle_response(self, data, now):
+        """Relay an upstream response back to the browser"""
+        if len(data) < 12:
+            return
+        with self.lock:
+            pending = self.pending.pop(struct.unpack('!H', data[:2])[0], None)
+        if pending is not None:
+            query, question, client, start, lookup_name = pending
+            response = self.process_response(query, question, lookup_name, data)
+            self.record_lookup(question, start, response, 'upstream', now)
+            self.socket.sendto(response, client)
+
+    def process_response(self, query, question, lookup_name, data):
+        """Cache an upstream response and turn it into the response for the query"""
+        with self.lock:
+            self.cache[(lookup_name, question[2])] = data
+        return self.response_for(query, question, lookup_name, data)
+
+    def response_for(self, query, question, lookup_name, data):
+        """Response for the query from a (cached or upstream) response for lookup_name"""
+        if lookup_name == question[1]:
+            return query[:2] + data[2:]
+        # setdns mapped the name to a different host so answer with its addresses
+        return build_response(query, question[3], [
+            answer for answer in parse_answers(data) if answer[0] == question[2]])
+
+    def expire_pending(self, now):
+        """Fail any relayed queries that the upstream server never answered"""
+        with self.lock:
+            for upstream_id in self.pending.keys():
+                query, question, client, start, _ = self.pending[upstream_id]
+                if now - start > UPSTREAM_TIMEOUT:
+                    del self.pending[upstream_id]
+                    response = build_response(query, question[3], [], RCODE_SERVFAIL)
+                    self.socket.sendto(response, client)
+                    self.lookups.append(self.lookup_entry(question, start, response,
+                                                          'timeout', now))
+
+    def answer_locally(self, query, question):
+        """Answer from the run's rules or the cache.
+        Returns (response, source, name to look up upstream if there was no answer)"""
+        _, name, record_type, question_end = question
+        lookup_name = name
+        rule = self.match_rule(name)
+        if rule is not None:
+            if 'block' in rule and rule['block']:
+                return (self.synthesize(query, question_end, record_type, '127.0.0.1'),
+                        'blocked', name)
+            if is_ip_address(rule['address']):
+                return (self.synthesize(query, question_end, record_type, rule['address']),
+                        'override', name)
+            lookup_name = rule['address'].lower().rstrip('.')
+        with self.lock:
+            cached = self.cache.get((lookup_name, record_type))
+        if cached is not None:
+            return self.response_for(query, question, lookup_name, cached), 'cache', lookup_name
+        return None, None, lookup_name
+
+    def synthesize(self, query, question_end, record_type, address):
+        """Build an answer for a setdns/blocked name"""
+        answers = []
+        if record_type == TYPE_A and address.find(':') == -1:
+            answers.append((TYPE_A, OVERRIDE_TTL, socket.inet_aton(address)))
+        elif record_type == TYPE_AAAA and address.find(':') >= 0:
+            answers.append((TYPE_AAAA, OVERRIDE_TTL, socket.inet_pton(socket.AF_INET6, address)))
+        return build_response(query, question_end, answers)
+
+    def match_rule(self, name):
+        """Find the setdns/blockdomains rule (if any) that applies to the name"""
+        excluded = False
+        for rule in self.rules:
+            if 'exclude' in rule and fnmatch.fnmatch(name, rule['exclude'].lower()):
+                excluded = True
+        for rule in self.rules:
+            if fnmatch.fnmatch(name, rule['host'].lower()):
+                if 'exclude' not in rule or not excluded:
+                    return rule
+        return None
+
+    def record_lookup(self, question, start, response, source, end=None):
+        """Keep track of the timing for the lookup"""
+        with self.lock:
+            self.lookups.append(self.lookup_entry(question, start, response, source, end))
+
+    def lookup_entry(self, question, start, response, source, end=None):
+        """Summary of a single lookup (times in ms relative to the start of the run)"""
+        if end is None:
+            end = monotonic.monotonic()
+        entry = {'host': question[1],
+                 'type': RECORD_TYPES.get(question[2], question[2]),
+                 'start': int(round((start - self.start_time) * 1000.0)),
+                 'time': round((end - start) * 1000.0, 3),
+                 'source': source,
+                 'addresses': []}
+        if response is not None and len(response) >= 4:
+            entry['rcode'] = ord(response[3]) & 0x0F
+            for record_type, _, rdata in parse_answers(response):
+                if record_type == TYPE_A:
+                    entry['addresses'].append(socket.inet_ntoa(rdata))
+                elif record_type == TYPE_AAAA:
+                    entry['addresses'].append(socket.inet_ntop(socket.AF_INET6, rdata))
+        return entry
+
+
+#
+# Wire format helpers
+#
+def is_ip_address(address):
+    """Check if the string is an IPv4 or IPv6 address"""
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            socket.inet_pton(family, address)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+def build_query(name, record_type, query_id):
+    """Build a recursive query for a single name"""
+    question = ''
+    for label in name.rstrip('.').split('.'):
+        question += chr(len(label)) + label
+    return struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + '\0' + \
+        struct.pack('!HH', record_type, 1)
+
+
+def parse_question(packet):
+    """Returns (id, lower-case name, type, end of the question section) or None"""
+    try:
+        query_id, _, count = struct.unpack('!HHH', packet[:6])
+        if count != 1:
+            return None
+        labels = []
+        offset = 12
+        while ord(packet[offset]):
+            length = ord(packet[offset])
+            labels.append(packet[offset + 1:offset + 1 + length])
+            offset += 1 + length
+        record_type = struct.unpack('!H', packet[offset + 1:offset + 3])[0]
+        return (query_id, '.'.join(labels).lower(), record_type, offset + 5)
+    except (IndexError, struct.error, TypeError):
+        return None
+
+
+def build_response(query, question_end, answers, rcode=0):
+    """Build a response to the query with the given (type, ttl, rdata) answers"""
+    query_id, flags = struct.unpack('!HH', query[:4])
+    flags = 0x8080 | (flags & 0x0100) | rcode
+    response = struct.pack('!HHHHHH', query_id, flags, 1, len(answers), 0, 0)
+    response += query[12:question_end]
+    for record_type, ttl, rdata in answers:
+        # Owner name is a pointer to the name in the question
+        response += '\xc0\x0c' + struct.pack('!HHIH', record_type, 1, ttl, len(rdata)) + rdata
+    return response
+
+
+def skip_name(packet, offset):
+    """Offset just past the (possibly compressed) name at offset"""
+    while True:
+        length = ord(packet[offset])
+        if length == 0:
+            return offset + 1
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        offset += 1 + length
+
+
+def parse_answers(packet):
+    """List of (type, ttl, rdata) for the records in the answer section"""
+    answers = []
+    try:
+        question_count, answer_count = struct.unpack('!HH', packet[4:8])
+        offset = 12
+        for _ in xrange(question_count):
+            offset = skip_name(packet, offset) + 4
+        for _ in xrange(answer_count):
+            offset = skip_name(packet, offset)
+            record_type, _, ttl, length = struct.unpack('!HHIH', packet[offset:offset + 10])
+            offset += 10
+            answers.append((record_type, ttl, packet[offset:offset + length]))
+            offset += length
+    except (IndexError, struct.error, TypeError):
+        pass
+    return answers
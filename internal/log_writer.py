@@ -0,0 +1,98 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Background writer for the gzipped dev tools logs so compression stays off the socket thread"""
+import gzip
+import logging
+import Queue
+import threading
+import ujson as json
+
+# Default gzip level for the logs (level 9 costs several times the CPU for a few % of size)
+LOG_GZIP_LEVEL = 2
+# Pending records before writes block the caller
+LOG_QUEUE_SIZE = 1000
+# Records that are joined into a single write to the gzip stream
+LOG_BATCH_SIZE = 100
+
+class GzipLogWriter(object):
+    """Gzipped JSON array written one record per line from a dedicated thread"""
+    def __init__(self, path, header, footer, level=None):
+        self.path = path
+        self.header = header
+        self.footer = footer
+        self.level = level if level is not None else LOG_GZIP_LEVEL
+        self.queue = Queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.records = 0
+        self.failed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, record):
+        """Queue a record: an already-serialized string (like a raw websocket frame),
+        an object to serialize or a list of either"""
+        self.queue.put(record)
+
+    def close(self):
+        """Flush everything that is queued and finish the file"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        """Writer thread (keeps draining the queue after an error so writers never block)"""
+        out_file = None
+        try:
+            out_file = gzip.open(self.path, 'wb', self.level)
+            out_file.write(self.header)
+        except BaseException as err:
+            out_file = self.write_failed(out_file, err)
+        done = False
+        while not done:
+            batch = [self.queue.get()]
+            # Pick up anything else that is already waiting
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            if None in batch:
+                done = True
+                batch = batch[:batch.index(None)]
+            if out_file is None:
+                continue
+            try:
+                buff = []
+                for record in batch:
+                    if isinstance(record, basestring):
+                        buff.append(record)
+                    elif isinstance(record, list):
+                        for entry in record:
+                            buff.append(entry if isinstance(entry, basestring)
+                                        else json.dumps(entry))
+                    else:
+                        buff.append(json.dumps(record))
+                if buff:
+                    out_file.write(",\n" + ",\n".join(buff))
+                    self.records += len(buff)
+            except BaseException as err:
+                out_file = self.write_failed(out_file, err)
+        if out_file is not None:
+            try:
+                out_file.write(self.footer)
+                out_file.close()
+            except BaseException as err:
+                self.write_failed(out_file, err)
+
+    def write_failed(self, out_file, err):
+        """Give up on the file after an error (the rest of the records are discarded)"""
+        logging.critical("Error writing %s: %s", self.path, err.__str__())
+        self.failed = True
+        if out_file is not None:
+            try:
+                out_file.close()
+            except BaseException as _:
+                pass
+        return None
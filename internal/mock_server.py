@@ -0,0 +1,288 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Local stand-in for the WebPageTest work server for exercising the agent's scheduling.
+
+Run it with: python mock_server.py [--port 8888] [--jobs 5] [--interval 10] [--job job.json]
+and point the agent at it with --server http://127.0.0.1:8888/work/ --location Test
+"""
+import BaseHTTPServer
+import SocketServer
+import argparse
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+import urlparse
+import zlib
+import ujson as json
+
+TEST_PAGE = '<html><head><title>Test</title></head><body><h1>Test page</h1></body></html>'
+
+class WorkQueue(object):
+    """Jobs waiting to be picked up, with the timing for each one"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = []
+        self.leases = {}
+        self.jobs = {}
+        self.polls = 0
+
+    def add(self, job):
+        """Queue a job and wake up any held (long-poll) getwork requests"""
+        with self.condition:
+            self.jobs[job['Test ID']] = {'queued': time.time(), 'fetched': None, 'done': None,
+                                         'runs': 0}
+            self.pending.append(job)
+            self.condition.notify_all()
+
+    def get(self, long_poll, lease):
+        """Hand out the next job, waiting up to long_poll seconds for one to arrive.
+        Leased jobs go back in the queue if they are not acked in time."""
+        end_time = time.time() + long_poll
+        with self.condition:
+            self.polls += 1
+            self.expire_leases()
+            while not self.pending and time.time() < end_time:
+                self.condition.wait(min(end_time - time.time(), 1.0))
+                self.expire_leases()
+            if self.pending:
+                job = self.pending.pop(0)
+                self.jobs[job['Test ID']]['fetched'] = time.time()
+                if lease:
+                    self.leases[job['Test ID']] = (job, time.time() + lease)
+                return job
+        return None
+
+    def ack(self, test_id, release):
+        """A leased job was started (or handed back)"""
+        with self.condition:
+            if test_id in self.leases:
+                job = self.leases.pop(test_id)[0]
+                if release:
+                    logging.info("%s was released", test_id)
+                    self.pending.insert(0, job)
+                    self.condition.notify_all()
+                else:
+                    logging.info("%s was acknowledged", test_id)
+
+    def expire_leases(self):
+        """Re-queue the leased jobs that were never acked"""
+        now = time.time()
+        for test_id in self.leases.keys():
+            job, expires = self.leases[test_id]
+            if now >= expires:
+                logging.info("Lease for %s expired", test_id)
+                del self.leases[test_id]
+                self.pending.insert(0, job)
+
+    def done(self, test_id, finished):
+        """Record a workdone post"""
+        with self.condition:
+            if test_id in self.jobs:
+                self.jobs[test_id]['runs'] += 1
+                if finished:
+                    self.jobs[test_id]['done'] = time.time()
+
+    def report(self):
+        """Print the queue latency and test time for each job"""
+        with self.condition:
+            print "{0} getwork polls".format(self.polls)
+            print "{0:<12} {1:>14} {2:>14} {3:>6}".format('Test ID', 'Queued (s)',
+                                                        'Testing (s)', 'Runs')
+            for test_id in sorted(self.jobs.keys()):
+                job = self.jobs[test_id]
+                waited = job['fetched'] - job['queued'] if job['fetched'] else None
+                testing = job['done'] - job['fetched'] if job['done'] and job['fetched'] \
+                          else None
+                print "{0:<12} {1:>14} {2:>14} {3:>6d}".format(
+                    test_id, '{0:0.3f}'.format(waited) if waited is not None else '-',
+                    '{0:0.3f}'.format(testing) if testing is not None else '-', job['runs'])
+
+
+class ChunkedUploads(object):
+    """Partial files for resultchunk.php, keyed by the whole-file sha1"""
+    def __init__(self, drop_rate=0.0):
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.drop_rate = drop_rate
+        self.chunks = 0
+        self.dropped = 0
+        self.completed = 0
+
+    def status(self, upload):
+        """How far along an upload is"""
+        with self.lock:
+            return self.state(upload)
+
+    def add(self, upload, offset, sha1, chunk):
+        """Append a chunk if it is the next one and arrived intact"""
+        with self.lock:
+            self.chunks += 1
+            if self.drop_rate and random.random() < self.drop_rate:
+                # Simulate the chunk getting mangled on the way in
+                self.dropped += 1
+                chunk = chunk[:len(chunk) / 2]
+            if upload not in self.uploads:
+                self.uploads[upload] = {'data': bytearray(), 'complete': False}
+            entry = self.uploads[upload]
+            if not entry['complete'] and offset == len(entry['data']) and \
+                    hashlib.sha1(chunk).hexdigest() == sha1:
+                entry['data'].extend(chunk)
+            return self.state(upload)
+
+    def state(self, upload):
+        """The response body for an upload (finishing it off once all of the data is in)"""
+        ret = {'offset': 0}
+        if upload in self.uploads:
+            entry = self.uploads[upload]
+            if not entry['complete'] and \
+                    hashlib.sha1(entry['data']).hexdigest() == upload:
+                entry['complete'] = True
+                self.completed += 1
+            ret = {'offset': len(entry['data']), 'complete': entry['complete']}
+        return ret
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server so long-polls don't block uploads"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, queue, uploads):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockRequestHandler)
+        self.queue = queue
+        self.uploads = uploads
+        # Request body codings to advertise on getwork responses
+        self.encodings = 'gzip'
+        try:
+            import zstandard as _
+            self.encodings += ', zstd'
+        except ImportError:
+            pass
+
+
+class MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """getwork.php, ackwork.php, workdone.php, resultimage.php, resultchunk.php and a test page"""
+    def do_GET(self):
+        """Handle a GET"""
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        if url.path.endswith('/getwork.php'):
+            job = self.server.queue.get(int(params['lp']) if 'lp' in params else 0,
+                                        int(params['lease']) if 'lease' in params else 0)
+            self.respond(json.dumps(job) if job is not None else '', 'application/json',
+                         headers={'Accept-Encoding': self.server.encodings})
+        elif url.path.endswith('/ackwork.php') and 'id' in params:
+            self.server.queue.ack(params['id'], 'release' in params and params['release'] == '1')
+            self.respond('', 'text/plain')
+        elif url.path.endswith('/resultchunk.php') and 'upload' in params:
+            self.respond(json.dumps(self.server.uploads.status(params['upload'])),
+                         'application/json')
+        elif url.path == '/' or url.path.endswith('.html'):
+            self.respond(TEST_PAGE, 'text/html')
+        else:
+            self.respond('', 'text/plain', 404)
+
+    def do_POST(self):
+        """Handle a result upload"""
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('content-length', 0))
+        if url.path.endswith('/resultchunk.php') and 'upload' in params and \
+                'offset' in params and 'sha1' in params:
+            chunk = self.decode(self.rfile.read(length))
+            state = self.server.uploads.add(params['upload'], int(params['offset']),
+                                            params['sha1'], chunk)
+            self.respond(json.dumps(state), 'application/json')
+            return
+        while length > 0:
+            length -= len(self.rfile.read(min(length, 65536)))
+        if url.path.endswith('/workdone.php') and 'id' in params:
+            self.server.queue.done(params['id'], 'done' in params and params['done'] == '1')
+        self.respond('', 'text/plain')
+
+    def decode(self, body):
+        """Undo any Content-Encoding on a request body"""
+        coding = self.headers.getheader('content-encoding', '')
+        if coding == 'gzip':
+            body = zlib.decompress(body, 31)
+        elif coding == 'zstd':
+            import zstandard
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        return body
+
+    def respond(self, body, content_type, code=200, headers=None):
+        """Send a complete response"""
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        if headers is not None:
+            for name in headers:
+                self.send_header(name, headers[name])
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        """Route the access log through logging"""
+        logging.debug(fmt, *args)
+
+
+def queue_jobs(queue, template, count, interval):
+    """Add the test jobs to the queue, one every interval seconds"""
+    for index in xrange(count):
+        job = dict(template)
+        job['Test ID'] = 'MOCK_{0:d}'.format(index + 1)
+        logging.info("Queueing %s", job['Test ID'])
+        queue.add(job)
+        if index < count - 1:
+            time.sleep(interval)
+
+
+def main():
+    """Start the server and queue the jobs"""
+    parser = argparse.ArgumentParser(description='Mock WebPageTest work server.')
+    parser.add_argument('--port', type=int, default=8888, help="Port to listen on.")
+    parser.add_argument('--jobs', type=int, default=5, help="Number of jobs to queue.")
+    parser.add_argument('--interval', type=float, default=10,
+                        help="Seconds between jobs being queued.")
+    parser.add_argument('--job', help="JSON file to use as the job template.")
+    parser.add_argument('--drop', type=float, default=0.0,
+                        help="Fraction of upload chunks to corrupt (to simulate a flaky link).")
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help="Log every request.")
+    options = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if options.verbose else logging.INFO,
+                        format="%(asctime)s.%(msecs)03d - %(message)s", datefmt="%H:%M:%S")
+    template = {'url': 'http://127.0.0.1:{0:d}/'.format(options.port), 'browser': 'Chrome',
+                'runs': 1, 'fvonly': 1}
+    if options.job is not None and os.path.isfile(options.job):
+        with open(options.job, 'rb') as job_file:
+            template = json.load(job_file)
+    queue = WorkQueue()
+    uploads = ChunkedUploads(options.drop)
+    server = MockServer(('127.0.0.1', options.port), queue, uploads)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Mock server listening on http://127.0.0.1:%d/work/", options.port)
+    try:
+        queue_jobs(queue, template, options.jobs, options.interval)
+        # Wait for the last job to finish
+        while True:
+            with queue.condition:
+                if all(job['done'] is not None for job in queue.jobs.values()):
+                    break
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    server.shutdown()
+    queue.report()
+    print "{0} upload chunks ({1} dropped), {2} chunked files completed".format(
+        uploads.chunks, uploads.dropped, uploads.completed)
+
+
+if __name__ == '__main__':
+    main()
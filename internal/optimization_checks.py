@@ -10,6 +10,8 @@ import struct
 import subprocess
 import threading
 import ujson as json
+from .result_archive import archive_file
+from .run_timing import span
 
 class OptimizationChecks(object):
     """Threaded optimization checks"""
@@ -24,19 +26,29 @@ class OptimizationChecks(object):
         self.gzip_results = {}
         self.image_results = {}
         self.results = {}
+        self.span = None
 
     def start(self):
         """Start running the optimization checks"""
         if self.requests is not None:
+            self.span = span(self.task, 'optimization')
             # Run the slow checks in background threads
-            self.cdn_thread = threading.Thread(target=self.check_cdn)
+            self.cdn_thread = threading.Thread(target=self.run_check,
+                                               args=('cdn', self.check_cdn))
             self.cdn_thread.start()
-            self.gzip_thread = threading.Thread(target=self.check_gzip)
+            self.gzip_thread = threading.Thread(target=self.run_check,
+                                                args=('gzip', self.check_gzip))
             self.gzip_thread.start()
-            self.image_thread = threading.Thread(target=self.check_images)
+            self.image_thread = threading.Thread(target=self.run_check,
+                                                 args=('images', self.check_images))
             self.image_thread.start()
             # collect the miscellaneous results directly
-            self.check_misc()
+            self.run_check('misc', self.check_misc)
+
+    def run_check(self, name, check):
+        """Run one of the checks (timed separately since they overlap the other stages)"""
+        with span(self.task, 'optimization.' + name):
+            check()
 
     def join(self):
         """Wait for the optimization checks to complete and record the results"""
@@ -69,6 +81,9 @@ class OptimizationChecks(object):
             if gz_file:
                 gz_file.write(json.dumps(self.results))
                 gz_file.close()
+            archive_file(self.task, path)
+        if self.span is not None:
+            self.span.end()
 
     def check_cdn(self):
         """Check each request to see if it was served from a CDN"""
@@ -5,40 +5,198 @@
 import logging
 import os
 import platform
+import Queue
+import shutil
 import subprocess
+import threading
+import time
+import uuid
 
-def kill_all(exe, force, timeout=30):
-    """Terminate all instances of the given process"""
-    logging.debug("Terminating all instances of %s", exe)
-    plat = platform.system()
-    if plat == "Windows":
-        if force:
-            subprocess.call(['taskkill', '/F', '/T', '/IM', exe])
-        else:
-            subprocess.call(['taskkill', '/IM', exe])
-    elif plat == "Linux" or plat == "Darwin":
-        if force:
-            subprocess.call(['killall', '-s', 'SIGKILL', exe])
+if platform.system() == "Linux":
+    CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+class ProcessGroup(object):
+    """Launch a process in its own process group (and cgroup where possible) so that it and
+    everything it spawns can be stopped without touching any other processes"""
+    def __init__(self, command_line):
+        self.command_line = command_line
+        self.proc = None
+        self.cgroup = None
+
+    def launch(self):
+        """Start the process"""
+        logging.debug(self.command_line)
+        plat = platform.system()
+        if plat == "Windows":
+            self.proc = subprocess.Popen(self.command_line, shell=True,
+                                         creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
         else:
-            subprocess.call(['killall', exe])
-    wait_for_all(exe, timeout)
-
-def wait_for_all(exe, timeout=30):
-    """Wait for the given process to exit"""
-    import psutil
-    processes = []
-    for proc in psutil.process_iter():
+            if plat == "Linux":
+                self.cgroup = create_cgroup()
+            self.proc = subprocess.Popen(self.command_line, shell=True,
+                                         preexec_fn=self.prepare_child)
+        return self.proc
+
+    def prepare_child(self):
+        """Runs in the child before exec: start a new process group and join the cgroup"""
+        os.setsid()
+        if self.cgroup is not None:
+            try:
+                with open(os.path.join(self.cgroup, 'cgroup.procs'), 'wb') as procs:
+                    procs.write('0')
+            except BaseException as _:
+                pass
+
+    def cgroup_pids(self):
+        """The processes that are still in the cgroup"""
+        pids = []
+        if self.cgroup is not None:
+            try:
+                with open(os.path.join(self.cgroup, 'cgroup.procs'), 'rb') as procs:
+                    pids = [int(pid) for pid in procs.read().split()]
+            except (IOError, ValueError):
+                pass
+        return pids
+
+    def is_running(self):
+        """Check to see if anything in the process group (or cgroup) is still running"""
+        if len(self.cgroup_pids()):
+            return True
+        try:
+            os.killpg(self.proc.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def signal(self, force):
+        """Send the group SIGTERM (or SIGKILL when forced)"""
+        import signal
+        sig = signal.SIGKILL if force else signal.SIGTERM
+        if self.cgroup is not None and force and \
+                os.path.isfile(os.path.join(self.cgroup, 'cgroup.kill')):
+            try:
+                with open(os.path.join(self.cgroup, 'cgroup.kill'), 'wb') as kill:
+                    kill.write('1')
+            except IOError:
+                pass
+        # Anything in the cgroup that moved to a different process group
+        for pid in self.cgroup_pids():
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
         try:
-            pinfo = proc.as_dict(attrs=['pid', 'name', 'exe'])
-        except psutil.NoSuchProcess:
+            os.killpg(self.proc.pid, sig)
+        except OSError:
             pass
+
+    def stop(self, timeout=30):
+        """Terminate the group (gently at first but forced if needed) and wait for it to exit"""
+        if self.proc is None:
+            return
+        if platform.system() == "Windows":
+            subprocess.call(['taskkill', '/T', '/PID', str(self.proc.pid)])
+            if not self.wait(timeout):
+                subprocess.call(['taskkill', '/F', '/T', '/PID', str(self.proc.pid)])
+                self.wait(timeout)
         else:
-            if 'exe' in pinfo and pinfo['exe'] is not None and\
-                    os.path.basename(pinfo['exe']) == exe:
-                processes.append(proc)
-    if len(processes):
-        logging.debug("Waiting up to %d seconds for %s to exit", timeout, exe)
-        psutil.wait_procs(processes, timeout=timeout)
+            self.signal(False)
+            if not self.wait(timeout):
+                logging.debug("Process group %d did not exit, killing it", self.proc.pid)
+                self.signal(True)
+                self.wait(timeout)
+        if self.cgroup is not None:
+            try:
+                os.rmdir(self.cgroup)
+            except OSError:
+                logging.debug("Unable to remove cgroup %s", self.cgroup)
+            self.cgroup = None
+        self.proc = None
+
+    def wait(self, timeout):
+        """Reap the process we launched and wait for the rest of the group to exit"""
+        end_time = time.time() + timeout
+        done = False
+        while not done:
+            done = self.proc.poll() is not None
+            if done and platform.system() != "Windows":
+                done = not self.is_running()
+            if not done:
+                if time.time() >= end_time:
+                    break
+                time.sleep(0.1)
+        return done
+
+
+def create_cgroup():
+    """Create a transient cgroup (v2) under the agent's own cgroup if we have access"""
+    path = None
+    try:
+        if os.path.isfile('/sys/fs/cgroup/cgroup.controllers'):
+            with open('/proc/self/cgroup', 'rb') as cgroup_file:
+                for line in cgroup_file:
+                    if line.startswith('0::'):
+                        parent = '/sys/fs/cgroup' + line[3:].strip().rstrip('/')
+                        if os.access(parent, os.W_OK):
+                            path = os.path.join(parent, 'wptagent-' + uuid.uuid4().hex)
+                            os.mkdir(path)
+                        break
+    except (IOError, OSError) as err:
+        logging.debug("Unable to create a cgroup: %s", err.__str__())
+        path = None
+    return path
+
+def get_process_tree_stats(pid):
+    """Get the CPU time (seconds) and RSS (bytes) of a process and all of its descendants.
+    Returns a dictionary of pid: {'name', 'ppid', 'cpu', 'rss'}"""
+    procs = {}
+    if platform.system() == "Linux" and os.path.isdir('/proc'):
+        # Single pass over /proc/*/stat (much cheaper than building psutil objects)
+        all_procs = {}
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open('/proc/' + entry + '/stat', 'rb') as stat_file:
+                        stat = stat_file.read()
+                except IOError:
+                    continue
+                # The process name can contain spaces and parens so parse around the last ')'
+                name_end = stat.rfind(')')
+                fields = stat[name_end + 2:].split()
+                if len(fields) > 21:
+                    ppid = int(fields[1])
+                    all_procs[int(entry)] = {'name': stat[stat.find('(') + 1:name_end],
+                                             'ppid': ppid,
+                                             'cpu': float(int(fields[11]) + int(fields[12])) /
+                                                    CLOCK_TICKS,
+                                             'rss': int(fields[21]) * PAGE_SIZE}
+                    if ppid not in children:
+                        children[ppid] = []
+                    children[ppid].append(int(entry))
+        pending = [pid]
+        while len(pending):
+            current = pending.pop()
+            if current in all_procs:
+                procs[current] = all_procs[current]
+                pending.extend(children.get(current, []))
+    else:
+        import psutil
+        try:
+            root = psutil.Process(pid)
+            for proc in [root] + root.children(recursive=True):
+                try:
+                    cpu_times = proc.cpu_times()
+                    procs[proc.pid] = {'name': proc.name(),
+                                       'ppid': proc.ppid(),
+                                       'cpu': cpu_times.user + cpu_times.system,
+                                       'rss': proc.memory_info().rss}
+                except psutil.Error:
+                    pass
+        except psutil.Error:
+            pass
+    return procs
 
 def flush_dns():
     """Flush the OS DNS resolver"""
@@ -79,3 +237,79 @@ def run_elevated(command, args):
         logging.debug('sudo ' + command + ' ' + args)
         ret = subprocess.call('sudo ' + command + ' ' + args, shell=True)
     return ret
+
+
+class DirectoryReaper(object):
+    """Deletes directories that were moved into a trash area using a low-priority thread"""
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.trash_dirs = []
+        self.lock = threading.Lock()
+
+    def discard(self, path, timeout=30):
+        """Move the directory into a trash directory next to it and queue it for deletion"""
+        ret = False
+        path = os.path.abspath(path)
+        trash = os.path.join(os.path.dirname(path), '.trash')
+        try:
+            with self.lock:
+                if not os.path.isdir(trash):
+                    os.makedirs(trash)
+                # Pick up anything left behind by a previous run of the agent
+                if trash not in self.trash_dirs:
+                    self.trash_dirs.append(trash)
+                    for name in os.listdir(trash):
+                        self.queue.put(os.path.join(trash, name))
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+            dest = os.path.join(trash, '{0}.{1}'.format(os.path.basename(path), uuid.uuid4().hex))
+            # The rename can fail while the browser is still releasing files (Windows)
+            end_time = time.time() + timeout
+            while not ret and os.path.isdir(path):
+                try:
+                    os.rename(path, dest)
+                    self.queue.put(dest)
+                    ret = True
+                except OSError:
+                    if time.time() >= end_time:
+                        raise
+                    time.sleep(0.1)
+        except BaseException as err:
+            logging.debug("Unable to move %s to the trash (%s), deleting it now",
+                          path, err.__str__())
+            shutil.rmtree(path, ignore_errors=True)
+            ret = not os.path.isdir(path)
+        return ret
+
+    def run(self):
+        """Background thread that deletes the trashed directories"""
+        plat = platform.system()
+        if plat == "Windows":
+            try:
+                import win32api
+                import win32process
+                # THREAD_MODE_BACKGROUND_BEGIN lowers the CPU, I/O and memory priority
+                win32process.SetThreadPriority(win32api.GetCurrentThread(), 0x00010000)
+            except BaseException as _:
+                pass
+        while True:
+            path = self.queue.get()
+            if plat == "Linux" or plat == "Darwin":
+                command = ['nice', '-n', '19', 'rm', '-rf', path]
+                if plat == "Linux":
+                    command = ['ionice', '-c', '3'] + command
+                try:
+                    subprocess.call(command)
+                except OSError:
+                    shutil.rmtree(path, ignore_errors=True)
+            else:
+                shutil.rmtree(path, ignore_errors=True)
+
+REAPER = DirectoryReaper()
+
+def discard_directory(path, timeout=30):
+    """Get the directory out of the way immediately and delete it in the background"""
+    return REAPER.discard(path, timeout)
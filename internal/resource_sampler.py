@@ -0,0 +1,340 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Low-overhead CPU, bandwidth and memory sampling while a test is recording"""
+import array
+import logging
+import os
+import platform
+import threading
+import time
+import monotonic
+import constants
+
+# Each sample is a fixed-size record: time (ms), bandwidth in (bps), CPU (%), memory (KB)
+RECORD_SIZE = 4
+# Per-process columns: time (ms), CPU time (ms), RSS (KB), PSS (KB) and the
+# voluntary/involuntary context switches from /proc/<pid>/status (on Linux that is
+# the process' main thread, the same counters psutil reports)
+PROCESS_COLUMNS = ['time', 'cpu', 'rss', 'pss', 'voluntary_switches', 'involuntary_switches']
+
+class ResourceSampler(object):
+    """Sample the system CPU, inbound bandwidth and browser memory into a preallocated array"""
+    def __init__(self, pid, rate=constants.RESOURCE_SAMPLE_RATE, duration=120,
+                 poll_bandwidth=True):
+        self.pid = pid
+        self.rate = min(max(int(rate), constants.RESOURCE_SAMPLE_RATE_MIN),
+                        constants.RESOURCE_SAMPLE_RATE_MAX)
+        self.interval = 1.0 / float(self.rate)
+        self.poll_bandwidth = poll_bandwidth
+        # Allow for a little more than the full test time so the array never needs to grow
+        capacity = int((duration + 30) * self.rate)
+        self.samples = array.array('d', [0.0]) * (capacity * RECORD_SIZE)
+        self.count = 0
+        self.running = False
+        self.thread = None
+        self.start_wall = None
+        self.linux = platform.system() == "Linux" and os.path.isfile('/proc/stat')
+        self.stat_file = None
+        self.net_file = None
+        self.statm_files = {}
+        self.last_cpu = None
+        self.ppids = {}
+        self.proc_entries = None
+        self.processes = {}
+
+    def start(self):
+        """Start sampling in a background thread"""
+        self.count = 0
+        self.processes = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop sampling"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.close_files()
+
+    def get_samples(self):
+        """Generator for the (time, bandwidth, cpu, memory) samples that were collected"""
+        for index in xrange(self.count):
+            offset = index * RECORD_SIZE
+            yield (int(self.samples[offset]), int(self.samples[offset + 1]),
+                   self.samples[offset + 2], int(self.samples[offset + 3]))
+
+    def run(self):
+        """Background sampling loop"""
+        try:
+            if self.linux:
+                self.stat_file = open('/proc/stat', 'rb')
+                if self.poll_bandwidth:
+                    self.net_file = open('/proc/net/dev', 'rb')
+            start_time = monotonic.monotonic()
+            # Wall clock time of the first sample (for lining up other timelines)
+            self.start_wall = time.time()
+            self.get_cpu()
+            last_bytes = self.get_net_bytes() if self.poll_bandwidth else 0
+            self.add_sample(0, 0, 0.0, self.get_memory())
+            self.sample_processes(0)
+            last_time = start_time
+            next_time = start_time
+            last_process_time = start_time
+            while self.running:
+                next_time += self.interval
+                delay = next_time - monotonic.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind, don't try to catch up with a burst of samples
+                    next_time = monotonic.monotonic()
+                now = monotonic.monotonic()
+                bandwidth = 0
+                if self.poll_bandwidth:
+                    bytes_in = self.get_net_bytes()
+                    if now > last_time:
+                        bandwidth = int((bytes_in - last_bytes) * 8.0 / (now - last_time))
+                    last_bytes = bytes_in
+                last_time = now
+                self.add_sample(int((now - start_time) * 1000), bandwidth, self.get_cpu(),
+                                self.get_memory())
+                if now - last_process_time >= constants.PROCESS_SAMPLE_INTERVAL:
+                    last_process_time = now
+                    self.sample_processes(int((now - start_time) * 1000))
+        except BaseException as err:
+            logging.critical("Error sampling resource usage: %s", err.__str__())
+        self.close_files()
+
+    def add_sample(self, elapsed, bandwidth, cpu, memory):
+        """Store a record in the sample array (only grows if the test overran)"""
+        offset = self.count * RECORD_SIZE
+        if offset + RECORD_SIZE > len(self.samples):
+            self.samples.extend(array.array('d', [0.0]) * len(self.samples))
+        self.samples[offset] = elapsed
+        self.samples[offset + 1] = bandwidth
+        self.samples[offset + 2] = cpu
+        self.samples[offset + 3] = memory
+        self.count += 1
+
+    def get_process_usage(self):
+        """Per-process samples for the browser process tree in a columnar layout"""
+        processes = []
+        for pid in sorted(self.processes.keys()):
+            process = self.processes[pid]
+            entry = {'pid': pid, 'ppid': process['ppid'], 'name': process['name'],
+                     'type': process['type']}
+            for column in PROCESS_COLUMNS:
+                entry[column] = process[column].tolist()
+            processes.append(entry)
+        return {'interval': int(constants.PROCESS_SAMPLE_INTERVAL * 1000),
+                'processes': processes}
+
+    def sample_processes(self, elapsed):
+        """Record the CPU time, memory and context switches of each process in the tree"""
+        from .os_util import get_process_tree_stats
+        if self.pid is None:
+            return
+        if self.linux:
+            for pid in self.statm_files.keys():
+                sample = self.get_linux_process_sample(pid)
+                if sample is not None:
+                    self.add_process_sample(pid, elapsed, sample)
+        else:
+            import psutil
+            for pid in get_process_tree_stats(self.pid):
+                try:
+                    proc = psutil.Process(pid)
+                    cpu_times = proc.cpu_times()
+                    memory = proc.memory_info()
+                    switches = proc.num_ctx_switches()
+                    self.add_process_sample(pid, elapsed, {
+                        'ppid': proc.ppid(), 'name': proc.name(), 'cmdline': proc.cmdline(),
+                        'cpu': int((cpu_times.user + cpu_times.system) * 1000),
+                        'rss': memory.rss / 1024, 'pss': -1,
+                        'voluntary_switches': switches.voluntary,
+                        'involuntary_switches': switches.involuntary})
+                except psutil.Error:
+                    pass
+
+    def get_linux_process_sample(self, pid):
+        """Read a single process' counters from /proc"""
+        from .os_util import CLOCK_TICKS, PAGE_SIZE
+        sample = None
+        path = '/proc/{0:d}/'.format(pid)
+        try:
+            with open(path + 'stat', 'rb') as stat_file:
+                stat = stat_file.read()
+            name_end = stat.rfind(')')
+            fields = stat[name_end + 2:].split()
+            sample = {'ppid': int(fields[1]),
+                      'name': stat[stat.find('(') + 1:name_end],
+                      'cpu': int((int(fields[11]) + int(fields[12])) * 1000 / CLOCK_TICKS),
+                      'rss': int(fields[21]) * PAGE_SIZE / 1024,
+                      'pss': -1,
+                      'voluntary_switches': 0,
+                      'involuntary_switches': 0}
+            # Re-check the command line if the process exec'd since it was first seen
+            if pid not in self.processes or self.processes[pid]['name'] != sample['name']:
+                with open(path + 'cmdline', 'rb') as cmdline_file:
+                    sample['cmdline'] = cmdline_file.read().split('\0')
+        except (IOError, IndexError, ValueError):
+            return None
+        # PSS needs smaps_rollup (Linux 4.14+), the full smaps is too expensive to parse
+        try:
+            with open(path + 'smaps_rollup', 'rb') as smaps:
+                for line in smaps:
+                    if line.startswith('Pss:'):
+                        sample['pss'] = int(line.split()[1])
+                        break
+        except (IOError, IndexError, ValueError):
+            pass
+        # One status file per process (walking every thread's status costs hundreds of
+        # opens per sample with Chrome's thread counts)
+        try:
+            with open(path + 'status', 'rb') as status:
+                for line in status:
+                    if line.startswith('voluntary_ctxt_switches:'):
+                        sample['voluntary_switches'] = int(line.split()[1])
+                    elif line.startswith('nonvoluntary_ctxt_switches:'):
+                        sample['involuntary_switches'] = int(line.split()[1])
+        except (IOError, IndexError, ValueError):
+            pass
+        return sample
+
+    def add_process_sample(self, pid, elapsed, sample):
+        """Append a sample to the process' columns"""
+        if pid not in self.processes:
+            self.processes[pid] = {'ppid': sample['ppid']}
+            for column in PROCESS_COLUMNS:
+                self.processes[pid][column] = array.array('l')
+        if 'cmdline' in sample:
+            process_type = 'browser' if pid == self.pid else 'other'
+            for arg in sample['cmdline']:
+                if arg.startswith('--type='):
+                    process_type = arg[7:]
+                    break
+            self.processes[pid]['name'] = sample['name']
+            self.processes[pid]['type'] = process_type
+        sample['time'] = elapsed
+        process = self.processes[pid]
+        for column in PROCESS_COLUMNS:
+            process[column].append(sample[column])
+
+    def get_cpu(self):
+        """System-wide CPU utilization (%) since the last call"""
+        cpu = 0.0
+        if self.stat_file is not None:
+            self.stat_file.seek(0)
+            fields = self.stat_file.readline().split()
+            # user nice system idle iowait irq softirq steal
+            times = [int(value) for value in fields[1:9]]
+            total = sum(times)
+            idle = times[3] + times[4]
+            if self.last_cpu is not None and total > self.last_cpu[0]:
+                elapsed = total - self.last_cpu[0]
+                cpu = 100.0 * float(elapsed - (idle - self.last_cpu[1])) / float(elapsed)
+            self.last_cpu = (total, idle)
+        else:
+            import psutil
+            cpu = psutil.cpu_percent(interval=None)
+        return cpu
+
+    def get_net_bytes(self):
+        """Get the bytes received, ignoring the loopback interface"""
+        bytes_in = 0
+        if self.net_file is not None:
+            self.net_file.seek(0)
+            for line in self.net_file.read().splitlines()[2:]:
+                interface, _, counters = line.partition(':')
+                if interface.strip() != 'lo':
+                    bytes_in += int(counters.split()[0])
+        else:
+            import psutil
+            net = psutil.net_io_counters(True)
+            for interface in net:
+                if interface != 'lo':
+                    bytes_in += net[interface].bytes_recv
+        return bytes_in
+
+    def get_memory(self):
+        """Resident memory (KB) of the browser process tree"""
+        from .os_util import get_process_tree_stats
+        memory = 0
+        if self.pid is None:
+            return -1
+        if not self.linux:
+            for proc in get_process_tree_stats(self.pid).values():
+                memory += proc['rss']
+            return memory / 1024
+        self.update_tree()
+        from .os_util import PAGE_SIZE
+        for pid in self.statm_files.keys():
+            try:
+                statm = self.statm_files[pid]
+                statm.seek(0)
+                memory += int(statm.read().split()[1]) * PAGE_SIZE
+            except (IOError, IndexError, ValueError):
+                self.statm_files[pid].close()
+                del self.statm_files[pid]
+        return memory / 1024
+
+    def update_tree(self):
+        """Keep the statm files for the browser process tree open.
+        The parent of a pid never changes (short of re-parenting when the parent exits)
+        so only the stat files for pids we haven't seen before need to be read."""
+        entries = os.listdir('/proc')
+        if entries == self.proc_entries:
+            # Nothing started or exited since the last sample
+            return
+        self.proc_entries = entries
+        pids = set()
+        for entry in entries:
+            if entry.isdigit():
+                pid = int(entry)
+                pids.add(pid)
+                if pid not in self.ppids:
+                    try:
+                        with open('/proc/' + entry + '/stat', 'rb') as stat_file:
+                            stat = stat_file.read()
+                        self.ppids[pid] = int(stat[stat.rfind(')') + 2:].split()[1])
+                    except (IOError, IndexError, ValueError):
+                        pass
+        for pid in self.ppids.keys():
+            if pid not in pids:
+                del self.ppids[pid]
+        tree = set()
+        for pid in self.ppids:
+            # Walk up to see if the process is a descendant of the browser
+            parent = pid
+            while parent in self.ppids and parent not in tree and parent != self.pid:
+                parent = self.ppids[parent]
+            if parent == self.pid or parent in tree:
+                tree.add(pid)
+        if self.pid in self.ppids:
+            tree.add(self.pid)
+        for pid in self.statm_files.keys():
+            if pid not in tree:
+                self.statm_files[pid].close()
+                del self.statm_files[pid]
+        for pid in tree:
+            if pid not in self.statm_files:
+                try:
+                    self.statm_files[pid] = open('/proc/{0:d}/statm'.format(pid), 'rb')
+                except IOError:
+                    pass
+
+    def close_files(self):
+        """Close any of the /proc files we were holding open"""
+        for handle in [self.stat_file, self.net_file] + self.statm_files.values():
+            if handle is not None:
+                try:
+                    handle.close()
+                except IOError:
+                    pass
+        self.stat_file = None
+        self.net_file = None
+        self.statm_files = {}
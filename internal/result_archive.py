@@ -0,0 +1,57 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""result.zip for a test run, built up as each artifact is finished"""
+import logging
+import os
+import threading
+import zipfile
+from .upload_codec import is_precompressed
+
+# Files larger than this are uploaded on their own instead of going into result.zip
+SEPARATE_UPLOAD_SIZE = 100000
+
+class ResultArchive(object):
+    """Archive that the run's small artifacts are moved into as soon as they are complete"""
+    def __init__(self, task_dir):
+        self.dir = task_dir
+        self.path = os.path.join(task_dir, 'result.zip')
+        self.zip_file = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, path, force=False):
+        """Move a finished file into the archive.
+        Large files are left in place to be uploaded separately unless forced."""
+        ret = False
+        try:
+            if os.path.isfile(path) and (force or os.path.getsize(path) <= SEPARATE_UPLOAD_SIZE):
+                name = os.path.relpath(path, self.dir).replace(os.sep, '/')
+                with self.lock:
+                    if self.zip_file is None:
+                        self.zip_file = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED)
+                    # Only spend CPU deflating the files that aren't already compressed
+                    compress_type = zipfile.ZIP_STORED if is_precompressed(name) \
+                        else zipfile.ZIP_DEFLATED
+                    logging.debug('Storing %s', name)
+                    self.zip_file.write(path, name, compress_type)
+                    self.count += 1
+                os.remove(path)
+                ret = True
+        except BaseException as err:
+            logging.error("Error adding %s to the result archive: %s", path, err.__str__())
+        return ret
+
+    def close(self):
+        """Finish the archive, returns the path to it (or None if nothing was added)"""
+        with self.lock:
+            if self.zip_file is not None:
+                self.zip_file.close()
+                self.zip_file = None
+        return self.path if self.count and os.path.isfile(self.path) else None
+
+
+def archive_file(task, path):
+    """Add a finished artifact to the task's result archive (if it has one)"""
+    if 'archive' in task and task['archive'] is not None:
+        task['archive'].add(path)
@@ -0,0 +1,172 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Durable on-disk spool for results that couldn't be uploaded, drained in the background"""
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+import ujson as json
+from .os_util import discard_directory
+
+# Backoff (in seconds) between drain attempts while the server is unreachable
+SPOOL_BASE_DELAY = 5.0
+SPOOL_MAX_DELAY = 300.0
+MANIFEST = 'manifest.json'
+
+class ResultSpool(object):
+    """Complete task results waiting to be uploaded, oldest first"""
+    def __init__(self, spool_dir, max_size, upload):
+        self.dir = spool_dir
+        self.max_size = max_size
+        self.upload = upload
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.must_exit = False
+        self.active = None
+        self.failures = 0
+        self.sequence = 0
+
+    def start(self):
+        """Clean out any half-written entries and start the background drain"""
+        ret = False
+        try:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            # Entries that were still being written when the agent died were never committed
+            for name in os.listdir(self.dir):
+                if name.startswith('tmp.'):
+                    discard_directory(os.path.join(self.dir, name))
+            count = len(self.entries())
+            if count:
+                logging.info("%d spooled results waiting to be uploaded", count)
+                # Send what an earlier run of the agent left behind without waiting for a
+                # new commit
+                self.wake.set()
+            self.must_exit = False
+            self.thread = threading.Thread(target=self.drain)
+            self.thread.daemon = True
+            self.thread.start()
+            ret = True
+        except BaseException as err:
+            logging.critical("Error starting the result spool: %s", err.__str__())
+        return ret
+
+    def stop(self):
+        """Stop draining (anything left stays on disk for the next start)"""
+        self.must_exit = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(10)
+            self.thread = None
+
+    def entries(self):
+        """Names of the committed entries, oldest first"""
+        ret = []
+        if os.path.isdir(self.dir):
+            for name in os.listdir(self.dir):
+                if not name.startswith('tmp.') and \
+                        os.path.isfile(os.path.join(self.dir, name, MANIFEST)):
+                    ret.append(name)
+        ret.sort()
+        return ret
+
+    def pending(self):
+        """Whether there are results waiting (new ones need to queue behind them)"""
+        with self.lock:
+            return len(self.entries()) > 0
+
+    def commit(self, data, files, zip_path):
+        """Move a finished run's results into the spool.
+        files is a list of (path, upload name) for the separately uploaded artifacts."""
+        ret = False
+        with self.lock:
+            self.sequence += 1
+            name = '{0:013d}.{1:04d}.{2}.{3}.{4}'.format(int(time.time() * 1000),
+                                                        self.sequence % 10000, data['id'],
+                                                        data['run'], data['cached'])
+        temp_dir = os.path.join(self.dir, 'tmp.' + name)
+        try:
+            os.makedirs(temp_dir)
+            manifest = {'data': data, 'files': [], 'zip': None}
+            for index, (path, upload_name) in enumerate(files):
+                file_name = '{0:d}.dat'.format(index)
+                shutil.move(path, os.path.join(temp_dir, file_name))
+                manifest['files'].append({'file': file_name, 'name': upload_name})
+            if zip_path is not None and os.path.isfile(zip_path):
+                shutil.move(zip_path, os.path.join(temp_dir, 'result.zip'))
+                manifest['zip'] = 'result.zip'
+            with open(os.path.join(temp_dir, MANIFEST), 'wb') as f_out:
+                json.dump(manifest, f_out)
+            # The entry only becomes visible to the drain once it is complete
+            os.rename(temp_dir, os.path.join(self.dir, name))
+            logging.info("Spooled the result for %s run %s", data['id'], data['run'])
+            ret = True
+        except BaseException as err:
+            logging.critical("Error spooling the result for %s: %s", data['id'], err.__str__())
+            discard_directory(temp_dir)
+        self.evict()
+        self.wake.set()
+        return ret
+
+    def evict(self):
+        """Drop the least-recently spooled entries until the spool fits on disk"""
+        with self.lock:
+            entries = self.entries()
+            sizes = {}
+            total = 0
+            for name in entries:
+                size = 0
+                entry_dir = os.path.join(self.dir, name)
+                for file_name in os.listdir(entry_dir):
+                    size += os.path.getsize(os.path.join(entry_dir, file_name))
+                sizes[name] = size
+                total += size
+            # Always keep the newest entry and the one that is being uploaded
+            for name in entries[:-1]:
+                if total <= self.max_size:
+                    break
+                if name != self.active:
+                    logging.warning("Spool is full, dropping result %s", name)
+                    discard_directory(os.path.join(self.dir, name))
+                    total -= sizes[name]
+
+    def drain(self):
+        """Background thread that uploads the spooled results in order"""
+        delay = None
+        while not self.must_exit:
+            self.wake.wait(delay)
+            self.wake.clear()
+            delay = None
+            while not self.must_exit:
+                with self.lock:
+                    entries = self.entries()
+                    self.active = entries[0] if entries else None
+                if self.active is None:
+                    self.failures = 0
+                    break
+                entry_dir = os.path.join(self.dir, self.active)
+                ok = False
+                try:
+                    with open(os.path.join(entry_dir, MANIFEST), 'rb') as f_in:
+                        manifest = json.load(f_in)
+                    ok = self.upload(entry_dir, manifest)
+                except BaseException as err:
+                    logging.error("Error uploading spooled result %s: %s", self.active,
+                                  err.__str__())
+                with self.lock:
+                    self.active = None
+                if ok:
+                    logging.info("Uploaded spooled result %s", os.path.basename(entry_dir))
+                    discard_directory(entry_dir)
+                    self.failures = 0
+                else:
+                    # Exponential backoff with jitter until the server is reachable again
+                    base = min(SPOOL_MAX_DELAY, SPOOL_BASE_DELAY * (2 ** min(self.failures, 16)))
+                    delay = base / 2.0 + random.uniform(0, base / 2.0)
+                    self.failures += 1
+                    logging.debug("Retrying spooled uploads in %0.1f seconds", delay)
+                    break
@@ -0,0 +1,118 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Timing spans for the stages of a test run, saved with the result as agent_timing.json.
+
+CPU time is for the whole agent process (and any tools it waited on) during the span so
+spans that overlap on different threads share it."""
+import logging
+import os
+import threading
+import monotonic
+import ujson as json
+
+def cpu_time():
+    """CPU seconds used by the agent and its finished child processes"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class Span(object):
+    """One timed stage (usable as a context manager)"""
+    def __init__(self, name, step):
+        self.name = name
+        self.step = step
+        self.thread = threading.current_thread().name
+        self.start = monotonic.monotonic()
+        self.start_cpu = cpu_time()
+        self.end_time = None
+        self.cpu = None
+
+    def end(self):
+        """Finish the span"""
+        if self.end_time is None:
+            self.end_time = monotonic.monotonic()
+            self.cpu = cpu_time() - self.start_cpu
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.end()
+
+    def to_dict(self, base):
+        """Span details in ms relative to the start of the run"""
+        end_time = self.end_time if self.end_time is not None else monotonic.monotonic()
+        cpu = self.cpu if self.cpu is not None else cpu_time() - self.start_cpu
+        ret = {'name': self.name,
+               'start': int(round((self.start - base) * 1000.0)),
+               'end': int(round((end_time - base) * 1000.0)),
+               'duration': int(round((end_time - self.start) * 1000.0)),
+               'cpu': int(round(cpu * 1000.0)),
+               'thread': self.thread}
+        if self.step is not None:
+            ret['step'] = self.step
+        if self.end_time is None:
+            # Still running when the timing was saved
+            ret['complete'] = False
+        return ret
+
+
+class NullSpan(object):
+    """Stand-in when the run isn't being timed"""
+    def end(self):
+        """Nothing to finish"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+class RunTiming(object):
+    """The spans for a single run"""
+    def __init__(self):
+        self.start = monotonic.monotonic()
+        self.start_cpu = cpu_time()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def span(self, name, step=None):
+        """Start timing a stage"""
+        span_entry = Span(name, step)
+        with self.lock:
+            self.spans.append(span_entry)
+        return span_entry
+
+    def elapsed(self):
+        """Seconds since the run started"""
+        return monotonic.monotonic() - self.start
+
+    def stages(self):
+        """(name, seconds) for each of the spans that have finished"""
+        with self.lock:
+            return [(span_entry.name, span_entry.end_time - span_entry.start)
+                    for span_entry in self.spans if span_entry.end_time is not None]
+
+    def save(self, path):
+        """Write the spans out (any that are still open are timed up to now)"""
+        with self.lock:
+            spans = [span_entry.to_dict(self.start) for span_entry in self.spans]
+        data = {'duration': int(round((monotonic.monotonic() - self.start) * 1000.0)),
+                'cpu': int(round((cpu_time() - self.start_cpu) * 1000.0)),
+                'spans': spans}
+        try:
+            with open(path, 'wb') as f_out:
+                json.dump(data, f_out)
+        except BaseException as err:
+            logging.error("Error writing %s: %s", path, err.__str__())
+
+
+def span(task, name):
+    """Span for a stage of the task's run (a no-op if the run isn't being timed)"""
+    if task is not None and 'timing' in task and task['timing'] is not None:
+        return task['timing'].span(name, task['current_step'] if 'current_step' in task
+                                   else None)
+    return NullSpan()
@@ -0,0 +1,73 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Video capture from Page.startScreencast frames instead of trace screenshots"""
+import base64
+import logging
+import os
+import Queue
+import threading
+
+# Screencast settings (frames are limited to this size in either dimension)
+SCREENCAST_QUALITY = 70
+SCREENCAST_MAX_SIZE = 1024
+# Frames waiting to be written before acks (and so new frames) are held up
+SCREENCAST_QUEUE_SIZE = 30
+
+class ScreencastWriter(object):
+    """Decodes and writes screencast frames from a background thread.
+    Frames are kept by capture time until the navigation start is known."""
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.queue = Queue.Queue(maxsize=SCREENCAST_QUEUE_SIZE)
+        self.frames = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data, timestamp):
+        """Queue a base64-encoded frame captured at timestamp (in seconds)"""
+        self.queue.put((data, timestamp))
+
+    def stop(self, start_time):
+        """Write out everything that is queued and name the frames by their offset in ms
+        from start_time (frames from before it are dropped)"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if start_time is None and self.frames:
+            start_time = self.frames[0][0]
+        count = 0
+        for timestamp, path in self.frames:
+            ms_elapsed = int(round((timestamp - start_time) * 1000.0))
+            if ms_elapsed >= 0:
+                # Same naming as the trace screenshots so video processing treats them alike
+                dest = os.path.join(self.video_path, 'ms_{0:06d}.png'.format(ms_elapsed))
+                if ms_elapsed == 0 and os.path.isfile(dest):
+                    # Keep the initial blank frame
+                    os.remove(path)
+                else:
+                    os.rename(path, dest)
+                    count += 1
+            else:
+                os.remove(path)
+        logging.debug("Kept %d of %d screencast frames", count, len(self.frames))
+        self.frames = []
+
+    def run(self):
+        """Writer thread"""
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            data, timestamp = frame
+            path = os.path.join(self.video_path,
+                                'screencast_{0:d}.jpg'.format(len(self.frames)))
+            try:
+                with open(path, 'wb') as image_file:
+                    image_file.write(base64.b64decode(data))
+                self.frames.append((timestamp, path))
+            except BaseException as err:
+                logging.error("Error writing screencast frame: %s", err.__str__())
+
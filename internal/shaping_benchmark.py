@@ -0,0 +1,398 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Local verification of the traffic-shaping backends.
+
+netem is checked over a veth pair into a network namespace. The proxy shaper is
+checked against a probe server on the loopback interface, connecting through the
+proxy the same way the browser does (no root needed).
+
+The probe server half of this file is also run directly (inside the network
+namespace) as: python shaping_benchmark.py --serve <address> <port>
+"""
+import logging
+import errno
+import math
+import os
+import select
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import monotonic
+
+NAMESPACE = 'wptshaper'
+LOCAL_INTERFACE = 'wptveth0'
+REMOTE_INTERFACE = 'wptveth1'
+LOCAL_ADDRESS = '10.201.0.1'
+REMOTE_ADDRESS = '10.201.0.2'
+PROBE_PORT = 9876
+# Seconds at the start of a throughput probe that are ignored for TCP slow-start
+WARMUP_TIME = 1.0
+CHUNK_SIZE = 65536
+
+# Connectivity profiles to check (bwIn/bwOut in Kbps, latency is the RTT in ms)
+PROFILES = [
+    {'name': 'Cable', 'bwIn': 5000, 'bwOut': 1000, 'latency': 28, 'plr': 0.0},
+    {'name': 'DSL', 'bwIn': 1500, 'bwOut': 384, 'latency': 50, 'plr': 0.0},
+    {'name': '3GFast', 'bwIn': 1600, 'bwOut': 768, 'latency': 150, 'plr': 0.0},
+    {'name': '3G', 'bwIn': 1600, 'bwOut': 768, 'latency': 300, 'plr': 0.0},
+    {'name': 'LTE', 'bwIn': 12000, 'bwOut': 12000, 'latency': 70, 'plr': 0.0},
+    {'name': 'Lossy', 'bwIn': 0, 'bwOut': 0, 'latency': 40, 'plr': 5.0}
+]
+
+class ShapingBenchmark(object):
+    """Measure the bandwidth, RTT and loss delivered by a traffic-shaper"""
+    def __init__(self, duration=5, backend=None):
+        self.duration = duration
+        # Same selection as the agent's --shaper option (None is netem)
+        self.backend = backend
+        self.server = None
+        self.address = REMOTE_ADDRESS
+        self.port = PROBE_PORT
+        self.proxy = None
+
+    def run(self, profiles=None):
+        """Run the probes for each of the (named) profiles and print the results"""
+        from .traffic_shaping import TrafficShaper, NetEm, ProxyShaper
+        results = []
+        if profiles is None:
+            profiles = PROFILES
+        else:
+            profiles = [profile for profile in PROFILES if profile['name'] in profiles]
+        if self.backend == 'proxy':
+            shaper = TrafficShaper(shaper=ProxyShaper())
+            ready = self.setup_local()
+        else:
+            shaper = TrafficShaper(shaper=NetEm(interface=LOCAL_INTERFACE, ifb='ifb1'))
+            ready = self.setup()
+        if ready:
+            if shaper.install():
+                self.proxy = shaper.get_proxy()
+                for profile in profiles:
+                    logging.info("Checking the %s profile", profile['name'])
+                    result = {'profile': profile, 'configured': shaper.configure(profile)}
+                    if result['configured']:
+                        result.update(self.measure())
+                    shaper.reset()
+                    results.append(result)
+                shaper.remove()
+            else:
+                logging.critical("Error installing the %s traffic-shaper",
+                                 self.backend if self.backend else 'netem')
+            self.teardown()
+        self.report(results)
+        return results
+
+    def setup_local(self):
+        """Run the probe server in this process on the loopback interface"""
+        self.address = '127.0.0.1'
+        tcp = start_probe_server(self.address, 0)
+        self.port = tcp.getsockname()[1]
+        thread = threading.Thread(target=accept_probes, args=(tcp,))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def setup(self):
+        """Create a veth pair with one end in a network namespace running the probe server"""
+        self.teardown()
+        commands = [['ip', 'netns', 'add', NAMESPACE],
+                    ['ip', 'link', 'add', LOCAL_INTERFACE, 'type', 'veth',
+                     'peer', 'name', REMOTE_INTERFACE],
+                    ['ip', 'link', 'set', REMOTE_INTERFACE, 'netns', NAMESPACE],
+                    ['ip', 'addr', 'add', LOCAL_ADDRESS + '/30', 'dev', LOCAL_INTERFACE],
+                    ['ip', 'link', 'set', LOCAL_INTERFACE, 'up'],
+                    ['ip', 'netns', 'exec', NAMESPACE, 'ip', 'addr', 'add',
+                     REMOTE_ADDRESS + '/30', 'dev', REMOTE_INTERFACE],
+                    ['ip', 'netns', 'exec', NAMESPACE, 'ip', 'link', 'set', REMOTE_INTERFACE,
+                     'up'],
+                    ['ip', 'netns', 'exec', NAMESPACE, 'ip', 'link', 'set', 'lo', 'up']]
+        for command in commands:
+            logging.debug(' '.join(command))
+            if subprocess.call(['sudo'] + command):
+                logging.critical("Error setting up the test link: %s", ' '.join(command))
+                return False
+        self.server = subprocess.Popen(['sudo', 'ip', 'netns', 'exec', NAMESPACE,
+                                        sys.executable, os.path.abspath(__file__), '--serve',
+                                        REMOTE_ADDRESS, str(PROBE_PORT)])
+        # Wait for the probe server to start listening
+        end_time = monotonic.monotonic() + 10
+        while monotonic.monotonic() < end_time:
+            try:
+                sock = socket.create_connection((REMOTE_ADDRESS, PROBE_PORT), timeout=1)
+                sock.sendall('QUIT\n')
+                sock.close()
+                return True
+            except socket.error:
+                time.sleep(0.1)
+        logging.critical("Probe server did not start")
+        return False
+
+    def teardown(self):
+        """Remove the namespace (which also removes the veth pair) and the probe server"""
+        if self.server is not None:
+            # sudo relays the signal to the probe server it started
+            self.server.terminate()
+            self.server.wait()
+            self.server = None
+        if self.backend == 'proxy':
+            return
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['sudo', 'ip', 'netns', 'del', NAMESPACE], stderr=devnull)
+            subprocess.call(['sudo', 'ip', 'link', 'del', LOCAL_INTERFACE], stderr=devnull)
+
+    def measure(self):
+        """Run all of the probes against the currently-configured shaping"""
+        result = {}
+        result['rtt'] = self.measure_rtt()
+        result['bwIn'] = self.measure_download()
+        result['bwOut'] = self.measure_upload()
+        # The proxy only carries TCP (it emulates loss as retransmit delays)
+        if self.proxy is None:
+            result['plr'] = self.measure_loss(result['rtt'])
+        return result
+
+    def connect(self):
+        """Open a TCP connection to the probe server (through the shaping proxy if there is one)"""
+        if self.proxy is None:
+            return socket.create_connection((self.address, self.port), timeout=30)
+        host, _, port = self.proxy.rpartition(':')
+        sock = socket.create_connection((host, int(port)), timeout=30)
+        try:
+            sock.sendall('\x05\x01\x00')
+            if receive_exactly(sock, 2) != '\x05\x00':
+                raise socket.error("SOCKS greeting rejected")
+            sock.sendall('\x05\x01\x00\x01' + socket.inet_aton(self.address) +
+                         struct.pack('!H', self.port))
+            reply = receive_exactly(sock, 10)
+            if len(reply) < 2 or reply[1] != '\x00':
+                raise socket.error("SOCKS connect failed")
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def measure_rtt(self, count=10):
+        """Median round-trip time (ms) of single-byte TCP exchanges"""
+        samples = []
+        sock = self.connect()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall('PING\n')
+        for _ in xrange(count):
+            start = monotonic.monotonic()
+            sock.sendall('x')
+            if not len(sock.recv(1)):
+                break
+            samples.append((monotonic.monotonic() - start) * 1000.0)
+        sock.close()
+        samples.sort()
+        return samples[len(samples) / 2] if len(samples) else None
+
+    def measure_download(self):
+        """Inbound throughput (Kbps) measured on the receiving side"""
+        sock = self.connect()
+        sock.sendall('DOWN {0:d}\n'.format(self.duration))
+        samples = receive_samples(sock)
+        sock.close()
+        return steady_rate(samples)
+
+    def measure_upload(self):
+        """Outbound throughput (Kbps) as measured by the probe server.
+        The server times the window so whatever is still buffered locally when it replies
+        doesn't have to drain through the shaper first."""
+        sock = self.connect()
+        sock.sendall('UP {0:d}\n'.format(self.duration))
+        sock.setblocking(0)
+        data = '\0' * CHUNK_SIZE
+        response = ''
+        end_time = monotonic.monotonic() + self.duration + 30
+        while monotonic.monotonic() < end_time:
+            readable, writable, _ = select.select([sock], [sock], [], 1)
+            if readable:
+                buff = sock.recv(1024)
+                if not len(buff):
+                    break
+                response += buff
+            elif writable:
+                try:
+                    sock.send(data)
+                except socket.error as err:
+                    if err.args[0] not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                        break
+        sock.close()
+        return float(response) if len(response) else None
+
+    def measure_loss(self, rtt, count=200):
+        """One-way packet loss (%) estimated from UDP echo round-trips"""
+        received = set()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(0.005)
+        for sequence in xrange(count):
+            sock.sendto(struct.pack('!I', sequence), (self.address, self.port))
+            received.update(receive_datagrams(sock))
+        # Wait for the stragglers
+        end_time = monotonic.monotonic() + (rtt if rtt else 0) * 2.0 / 1000.0 + 1.0
+        while monotonic.monotonic() < end_time:
+            received.update(receive_datagrams(sock))
+        sock.close()
+        delivered = float(len(received)) / float(count)
+        # Loss is applied to both directions so convert the round-trip delivery rate
+        return (1.0 - math.sqrt(delivered)) * 100.0
+
+    def report(self, results):
+        """Print the achieved vs. requested values for each profile"""
+        print "{0:<10} {1:>21} {2:>21} {3:>17} {4:>13}".format(
+            'Profile', 'In (Kbps)', 'Out (Kbps)', 'RTT (ms)', 'PLR (%)')
+        for result in results:
+            profile = result['profile']
+            if not result['configured']:
+                print "{0:<10} Error configuring traffic-shaping".format(profile['name'])
+                continue
+            print "{0:<10} {1:>21} {2:>21} {3:>17} {4:>13}".format(
+                profile['name'],
+                format_check(result['bwIn'], profile['bwIn']),
+                format_check(result['bwOut'], profile['bwOut']),
+                format_check(result['rtt'], profile['latency']),
+                format_check(result['plr'], profile['plr']) if 'plr' in result else 'n/a')
+
+
+def format_check(achieved, requested):
+    """Format an achieved/requested pair"""
+    if achieved is None:
+        return 'failed / {0}'.format(requested)
+    return '{0:0.1f} / {1}'.format(achieved, requested if requested else '-')
+
+
+def steady_rate(samples):
+    """Throughput in Kbps from (time, total bytes) samples, skipping the warmup period"""
+    rate = None
+    if len(samples) > 1:
+        start_time, start_bytes = samples[0]
+        for sample in samples:
+            if sample[0] - samples[0][0] >= WARMUP_TIME:
+                break
+            start_time, start_bytes = sample
+        end_time, end_bytes = samples[-1]
+        if end_time > start_time:
+            rate = (end_bytes - start_bytes) * 8.0 / (end_time - start_time) / 1000.0
+    return rate
+
+
+def receive_samples(sock, duration=None):
+    """Receive until the connection closes (or for duration seconds from the first data),
+    recording the running byte count"""
+    samples = []
+    total = 0
+    while True:
+        buff = sock.recv(CHUNK_SIZE)
+        if not len(buff):
+            break
+        total += len(buff)
+        samples.append((monotonic.monotonic(), total))
+        if duration is not None and samples[-1][0] - samples[0][0] >= duration:
+            break
+    return samples
+
+
+def receive_exactly(sock, count):
+    """Receive count bytes (or less if the connection closes)"""
+    buff = ''
+    while len(buff) < count:
+        data = sock.recv(count - len(buff))
+        if not len(data):
+            break
+        buff += data
+    return buff
+
+
+def receive_datagrams(sock):
+    """Drain any pending UDP echo responses"""
+    sequences = []
+    try:
+        while True:
+            data = sock.recv(64)
+            if len(data) == 4:
+                sequences.append(struct.unpack('!I', data)[0])
+    except socket.error:
+        pass
+    return sequences
+
+
+#
+# Probe server (runs inside the network namespace)
+#
+def serve(address, port):
+    """Serve the TCP and UDP probes until killed"""
+    accept_probes(start_probe_server(address, port))
+
+
+def start_probe_server(address, port):
+    """Listen for the probes (TCP and UDP on the same port), returns the TCP socket"""
+    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tcp.bind((address, port))
+    tcp.listen(5)
+    udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    udp.bind((address, tcp.getsockname()[1]))
+    thread = threading.Thread(target=udp_echo, args=(udp,))
+    thread.daemon = True
+    thread.start()
+    return tcp
+
+
+def accept_probes(tcp):
+    """Handle each of the probe connections in its own thread"""
+    while True:
+        conn, _ = tcp.accept()
+        thread = threading.Thread(target=handle_probe, args=(conn,))
+        thread.daemon = True
+        thread.start()
+
+
+def udp_echo(sock):
+    """Echo every datagram back to the sender"""
+    while True:
+        data, addr = sock.recvfrom(64)
+        sock.sendto(data, addr)
+
+
+def handle_probe(conn):
+    """Handle a single TCP probe connection"""
+    try:
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        command = ''
+        while not command.endswith('\n'):
+            buff = conn.recv(1)
+            if not len(buff):
+                break
+            command += buff
+        parts = command.split()
+        if len(parts) and parts[0] == 'PING':
+            while True:
+                buff = conn.recv(1)
+                if not len(buff):
+                    break
+                conn.sendall(buff)
+        elif len(parts) > 1 and parts[0] == 'DOWN':
+            data = '\0' * CHUNK_SIZE
+            end_time = monotonic.monotonic() + int(parts[1])
+            while monotonic.monotonic() < end_time:
+                conn.sendall(data)
+        elif len(parts) > 1 and parts[0] == 'UP':
+            rate = steady_rate(receive_samples(conn, int(parts[1])))
+            conn.sendall('{0:0.3f}'.format(rate) if rate is not None else '')
+            conn.shutdown(socket.SHUT_WR)
+            # Let the sender stop on its own (closing with unread data would reset it)
+            while len(conn.recv(CHUNK_SIZE)):
+                pass
+    except socket.error:
+        pass
+    conn.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], int(sys.argv[3]))
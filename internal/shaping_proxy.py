@@ -0,0 +1,403 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""User-space traffic-shaping SOCKS5/HTTP CONNECT proxy"""
+import errno
+import logging
+import math
+import random
+import select
+import socket
+import struct
+import threading
+import monotonic
+from .dns_stub import is_ip_address
+
+# Maximum bytes buffered in each direction before we stop reading from the source
+MAX_BUFFERED = 256 * 1024
+READ_SIZE = 32 * 1024
+SEGMENT_SIZE = 1460
+IDLE_TIMEOUT = 0.1
+BUSY_TIMEOUT = 0.005
+
+class TokenBucket(object):
+    """Link-level token bucket shared by every connection in one direction"""
+    def __init__(self):
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0.0
+        self.last_update = monotonic.monotonic()
+
+    def configure(self, bps):
+        """Set the rate in bits per second (0 = unlimited)"""
+        self.rate = float(bps) / 8.0
+        self.burst = max(self.rate * 0.05, SEGMENT_SIZE * 2)
+        self.tokens = self.burst
+        self.last_update = monotonic.monotonic()
+
+    def available(self, now):
+        """Number of bytes that can be sent right now"""
+        if self.rate <= 0:
+            return READ_SIZE
+        self.tokens = min(self.burst, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+        return int(self.tokens)
+
+    def consume(self, count):
+        """Take the given number of bytes out of the bucket"""
+        if self.rate > 0:
+            self.tokens -= count
+
+
+class Pipe(object):
+    """One direction of a proxied connection (delay queue + shared bandwidth)"""
+    def __init__(self, src, dst, bucket):
+        self.src = src
+        self.dst = dst
+        self.bucket = bucket
+        self.queue = []
+        self.buffered = 0
+        self.last_release = 0
+        self.eof = False
+        self.closed = False
+
+    def wants_read(self):
+        """Is there room to read more from the source?"""
+        return not self.eof and self.buffered < MAX_BUFFERED
+
+    def has_ready(self, now):
+        """Is there data whose delay has expired?"""
+        return len(self.queue) and self.queue[0][0] <= now
+
+    def read(self, now, latency, rtt, plr):
+        """Read from the source and queue the data with the emulated delay/loss"""
+        data = self.src.recv(READ_SIZE)
+        if not len(data):
+            self.eof = True
+            return
+        release = now + latency
+        # Each lost segment costs (roughly) one round trip for the retransmit
+        if plr > 0:
+            segments = int(math.ceil(float(len(data)) / SEGMENT_SIZE))
+            if random.random() < 1.0 - math.pow(1.0 - plr, segments):
+                release += rtt
+        # Never re-order data within a connection
+        release = max(release, self.last_release)
+        self.last_release = release
+        self.queue.append([release, data])
+        self.buffered += len(data)
+
+    def write(self, now):
+        """Send whatever the delay queue and bandwidth allow"""
+        while self.has_ready(now):
+            allowed = self.bucket.available(now)
+            if allowed <= 0:
+                break
+            data = self.queue[0][1]
+            sent = self.dst.send(data[:allowed])
+            self.bucket.consume(sent)
+            self.buffered -= sent
+            if sent < len(data):
+                self.queue[0][1] = data[sent:]
+                break
+            self.queue.pop(0)
+        if self.eof and not len(self.queue) and not self.closed:
+            self.closed = True
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+
+
+class Connection(object):
+    """A single client connection and its upstream"""
+    def __init__(self, client):
+        self.client = client
+        self.upstream = None
+        self.buffer = ''
+        self.protocol = None
+        self.state = 'handshake'
+        self.reply = None
+        self.reply_time = None
+        self.inbound = None
+        self.outbound = None
+
+    def sockets(self):
+        """All of the open sockets for the connection"""
+        return [sock for sock in [self.client, self.upstream] if sock is not None]
+
+    def close(self):
+        """Close both sides"""
+        for sock in self.sockets():
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self.state = 'closed'
+
+
+class ShapingProxy(object):
+    """SOCKS5 and HTTP CONNECT proxy that shapes all of the traffic passing through it"""
+    def __init__(self, port=0):
+        self.port = port
+        self.listen_socket = None
+        self.thread = None
+        self.must_exit = False
+        self.connections = []
+        self.connected = []
+        self.lock = threading.Lock()
+        self.inbound = TokenBucket()
+        self.outbound = TokenBucket()
+        self.rtt = 0.0
+        self.plr = 0.0
+        self.resolver = None
+
+    def start(self):
+        """Start listening on localhost in a background thread"""
+        ret = False
+        try:
+            self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listen_socket.bind(('127.0.0.1', self.port))
+            self.listen_socket.listen(128)
+            self.listen_socket.setblocking(0)
+            self.port = self.listen_socket.getsockname()[1]
+            self.must_exit = False
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+            logging.debug("Shaping proxy listening on port %d", self.port)
+            ret = True
+        except socket.error as err:
+            logging.critical("Error starting the shaping proxy: %s", err.__str__())
+        return ret
+
+    def stop(self):
+        """Stop the proxy and close all of the connections"""
+        self.must_exit = True
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+            self.listen_socket = None
+
+    def configure(self, in_bps, out_bps, rtt, plr):
+        """Change the shaping (applies to new data on existing connections too)"""
+        with self.lock:
+            self.inbound.configure(in_bps)
+            self.outbound.configure(out_bps)
+            self.rtt = float(rtt) / 1000.0
+            self.plr = float(plr) / 100.0
+        return True
+
+    def run(self):
+        """Main event loop"""
+        while not self.must_exit:
+            now = monotonic.monotonic()
+            with self.lock:
+                self.service_connections(now)
+            readers = [self.listen_socket]
+            writers = []
+            busy = False
+            for connection in self.connections:
+                if connection.state in ['handshake', 'open']:
+                    if connection.state == 'handshake' or connection.outbound.wants_read():
+                        readers.append(connection.client)
+                    if connection.state == 'open' and connection.inbound.wants_read():
+                        readers.append(connection.upstream)
+                if connection.state == 'open':
+                    for pipe in [connection.inbound, connection.outbound]:
+                        if len(pipe.queue):
+                            busy = True
+                            if pipe.has_ready(now) and pipe.bucket.available(now) > 0:
+                                writers.append(pipe.dst)
+                elif connection.state in ['connecting', 'replying']:
+                    busy = True
+            timeout = BUSY_TIMEOUT if busy else IDLE_TIMEOUT
+            try:
+                readable, _ = self.wait_for_sockets(readers, writers, timeout)
+            except (select.error, socket.error, ValueError) as err:
+                logging.debug("Shaping proxy select error: %s", err.__str__())
+                self.prune()
+                continue
+            with self.lock:
+                self.process(readable, monotonic.monotonic())
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+    def wait_for_sockets(self, readers, writers, timeout):
+        """Wait for socket activity, using poll() where it is available"""
+        if not hasattr(select, 'poll'):
+            readable, writable, _ = select.select(readers, writers, [], timeout)
+            return readable, writable
+        poller = select.poll()
+        lookup = {}
+        events = {}
+        for sock in readers:
+            lookup[sock.fileno()] = sock
+            events[sock.fileno()] = events.get(sock.fileno(), 0) | select.POLLIN
+        for sock in writers:
+            lookup[sock.fileno()] = sock
+            events[sock.fileno()] = events.get(sock.fileno(), 0) | select.POLLOUT
+        for fileno in events:
+            poller.register(fileno, events[fileno])
+        readable = []
+        writable = []
+        for fileno, event in poller.poll(timeout * 1000.0):
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                readable.append(lookup[fileno])
+            if event & select.POLLOUT:
+                writable.append(lookup[fileno])
+        return readable, writable
+
+    def process(self, readable, now):
+        """Handle the sockets that have data waiting"""
+        if self.listen_socket in readable:
+            self.accept()
+        for connection in self.connections:
+            try:
+                if connection.state == 'handshake' and connection.client in readable:
+                    self.handshake(connection)
+                elif connection.state == 'open':
+                    if connection.client in readable and connection.outbound.wants_read():
+                        connection.outbound.read(now, self.rtt / 2.0, self.rtt, self.plr)
+                    if connection.upstream in readable and connection.inbound.wants_read():
+                        connection.inbound.read(now, self.rtt / 2.0, self.rtt, self.plr)
+                    connection.outbound.write(now)
+                    connection.inbound.write(now)
+                    if connection.inbound.closed and connection.outbound.closed:
+                        connection.close()
+            except socket.error as err:
+                if err.args[0] not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    connection.close()
+        self.prune()
+
+    def prune(self):
+        """Drop closed connections (and any with sockets that went bad)"""
+        for connection in self.connections:
+            for sock in connection.sockets():
+                try:
+                    sock.fileno()
+                except socket.error:
+                    connection.close()
+        self.connections = [c for c in self.connections if c.state != 'closed']
+
+    def accept(self):
+        """Accept all of the pending client connections"""
+        while True:
+            try:
+                client, _ = self.listen_socket.accept()
+            except socket.error:
+                break
+            client.setblocking(0)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections.append(Connection(client))
+
+    def handshake(self, connection):
+        """Parse the SOCKS5 or HTTP CONNECT request"""
+        data = connection.client.recv(4096)
+        if not len(data):
+            connection.close()
+            return
+        connection.buffer += data
+        buff = connection.buffer
+        if buff[0] == '\x05':
+            connection.protocol = 'socks5'
+            if connection.reply is None:
+                # Greeting: version, method count, methods (only "no auth" is supported)
+                if len(buff) >= 2 and len(buff) >= 2 + ord(buff[1]):
+                    connection.client.sendall('\x05\x00')
+                    connection.buffer = buff[2 + ord(buff[1]):]
+                    connection.reply = ''
+                    buff = connection.buffer
+            if connection.reply is not None and len(buff) >= 5:
+                target = self.parse_socks_request(buff)
+                if target is not None:
+                    self.connect_upstream(connection, target[0], target[1])
+        elif buff.startswith('CONNECT '):
+            connection.protocol = 'http'
+            end = buff.find('\r\n\r\n')
+            if end > 0:
+                host, _, port = buff.split(' ', 2)[1].rpartition(':')
+                self.connect_upstream(connection, host.strip('[]'), int(port))
+        else:
+            connection.close()
+
+    def parse_socks_request(self, buff):
+        """Extract the (host, port) from a SOCKS5 CONNECT request"""
+        target = None
+        addr_type = ord(buff[3])
+        if addr_type == 1 and len(buff) >= 10:
+            target = (socket.inet_ntoa(buff[4:8]), struct.unpack('!H', buff[8:10])[0])
+        elif addr_type == 3 and len(buff) >= 5 + ord(buff[4]) + 2:
+            length = ord(buff[4])
+            target = (buff[5:5 + length], struct.unpack('!H', buff[5 + length:7 + length])[0])
+        elif addr_type == 4 and len(buff) >= 22:
+            target = (socket.inet_ntop(socket.AF_INET6, buff[4:20]),
+                      struct.unpack('!H', buff[20:22])[0])
+        return target
+
+    def connect_upstream(self, connection, host, port):
+        """Resolve and connect to the target in a worker thread so the loop never blocks"""
+        connection.state = 'connecting'
+        thread = threading.Thread(target=self.connect_thread, args=(connection, host, port))
+        thread.daemon = True
+        thread.start()
+
+    def connect_thread(self, connection, host, port):
+        """Blocking connect to the upstream server"""
+        upstream = None
+        try:
+            if self.resolver is not None and not is_ip_address(host):
+                addresses = self.resolver.resolve(host)
+                if not len(addresses):
+                    raise socket.gaierror("No addresses for {0}".format(host))
+                host = addresses[0]
+            upstream = socket.create_connection((host, port), timeout=30)
+            upstream.setblocking(0)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except BaseException as err:
+            logging.debug("Shaping proxy connect to %s:%d failed: %s", host, port, err.__str__())
+            upstream = None
+        with self.lock:
+            self.connected.append((connection, upstream))
+
+    def service_connections(self, now):
+        """Complete upstream connects and send the (delayed) handshake replies"""
+        for connection, upstream in self.connected:
+            if connection.state != 'connecting':
+                if upstream is not None:
+                    upstream.close()
+            elif upstream is None:
+                if connection.protocol == 'socks5':
+                    reply = '\x05\x04\x00\x01\x00\x00\x00\x00\x00\x00'
+                else:
+                    reply = 'HTTP/1.1 502 Bad Gateway\r\n\r\n'
+                try:
+                    connection.client.sendall(reply)
+                except socket.error:
+                    pass
+                connection.close()
+            else:
+                connection.upstream = upstream
+                connection.state = 'replying'
+                # The emulated TCP handshake costs one round trip
+                connection.reply_time = now + self.rtt
+        self.connected = []
+        for connection in self.connections:
+            if connection.state == 'replying' and connection.reply_time <= now:
+                if connection.protocol == 'socks5':
+                    reply = '\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+                else:
+                    reply = 'HTTP/1.1 200 Connection established\r\n\r\n'
+                try:
+                    connection.client.sendall(reply)
+                    connection.inbound = Pipe(connection.upstream, connection.client,
+                                              self.inbound)
+                    connection.outbound = Pipe(connection.client, connection.upstream,
+                                               self.outbound)
+                    connection.state = 'open'
+                except socket.error:
+                    connection.close()
@@ -49,6 +49,9 @@ class Trace():
     self.feature_usage = None
     self.feature_usage_start_time = None
     self.netlog = {'bytes_in': 0, 'bytes_out': 0}
+    self.netlog_start = None
+    self.netlog_offset = None
+    self.netlog_traffic = []
     self.v8stats = None
     self.v8stack = {}
     return
@@ -165,6 +168,7 @@ class Trace():
             cat.find('devtools.timeline') >= 0 or \
             cat.find('blink.feature_usage') >= 0 or \
             cat.find('blink.user_timing') >= 0 or \
+            cat.find('netlog') >= 0 or \
             cat.find('v8') >= 0:
       self.trace_events.append(trace_event)
 
@@ -179,6 +183,9 @@ class Trace():
     # Do the post-processing on timeline events
     self.ProcessTimelineEvents()
 
+    # Bucket the netlog socket traffic relative to the start of the recording
+    self.ProcessNetlogBandwidth()
+
   def ProcessTraceEvent(self, trace_event):
     cat = trace_event['cat']
     if cat == 'devtools.timeline' or cat.find('devtools.timeline') >= 0:
@@ -187,11 +194,12 @@ class Trace():
       self.ProcessFeatureUsageEvent(trace_event)
     elif cat.find('blink.user_timing') >= 0:
       self.user_timing.append(trace_event)
+      if self.netlog_start is None and 'name' in trace_event and trace_event['name'] == 'navigationStart':
+        self.netlog_start = trace_event['ts']
+    elif cat.find('netlog') >= 0:
+      self.ProcessNetlogEvent(trace_event)
     elif cat.find('v8') >= 0:
       self.ProcessV8Event(trace_event)
-    #Netlog support is still in progress
-    #elif cat.find('netlog') >= 0:
-    #  self.ProcessNetlogEvent(trace_event)
 
 
   ########################################################################################################################
@@ -479,51 +487,86 @@ class Trace():
     if 'sockets' not in self.netlog:
       self.netlog['sockets'] = {}
     if s['id'] not in self.netlog['sockets']:
-      self.netlog['sockets'][s['id']] = {'bytes_in': 0, 'bytes_out': 0}
-    if s['name'] == 'SOCKET_BYTES_RECEIVED' and 'params' in s['args'] and 'byte_count' in s['args']['params']:
-      self.netlog['sockets'][s['id']]['bytes_in'] += s['args']['params']['byte_count']
-      self.netlog['bytes_in'] += s['args']['params']['byte_count']
-    if s['name'] == 'SOCKET_BYTES_SENT' and 'params' in s['args'] and 'byte_count' in s['args']['params']:
-      self.netlog['sockets'][s['id']]['bytes_out'] += s['args']['params']['byte_count']
-      self.netlog['bytes_out'] += s['args']['params']['byte_count']
+      self.netlog['sockets'][s['id']] = {'bytes_in': 0, 'bytes_out': 0, 'start': s['ts'], 'end': s['ts']}
+    socket = self.netlog['sockets'][s['id']]
+    if s['ts'] > socket['end']:
+      socket['end'] = s['ts']
+    if 'params' in s['args'] and 'byte_count' in s['args']['params']:
+      byte_count = int(s['args']['params']['byte_count'])
+      if s['name'] == 'SOCKET_BYTES_RECEIVED':
+        socket['bytes_in'] += byte_count
+        self.netlog['bytes_in'] += byte_count
+        self.netlog_traffic.append((s['ts'], byte_count, 0))
+      elif s['name'] == 'SOCKET_BYTES_SENT':
+        socket['bytes_out'] += byte_count
+        self.netlog['bytes_out'] += byte_count
+        self.netlog_traffic.append((s['ts'], 0, byte_count))
 
   def ProcessNetlogHTTP2SessionEvent(self, s):
-    if 'params' in s['args'] and 'stream_id' in s['args']['params']:
-      if 'http2' not in self.netlog:
-        self.netlog['http2'] = {'bytes_in': 0, 'bytes_out': 0}
-      if s['id'] not in self.netlog['http2']:
-        self.netlog['http2'][s['id']] = {'bytes_in': 0, 'bytes_out': 0, 'streams':{}}
-      stream = '{0:d}'.format(s['args']['params']['stream_id'])
-      if stream not in self.netlog['http2'][s['id']]['streams']:
-        self.netlog['http2'][s['id']]['streams'][stream] = {'start': s['tts'], 'end': s['tts'], 'bytes_in': 0, 'bytes_out': 0}
-      if s['tts'] > self.netlog['http2'][s['id']]['streams'][stream]['end']:
-        self.netlog['http2'][s['id']]['streams'][stream]['end'] = s['tts']
-
-    if s['name'] == 'HTTP2_SESSION_SEND_HEADERS' and 'params' in s['args']:
-      if 'request' not in self.netlog['http2'][s['id']]['streams'][stream]:
-        self.netlog['http2'][s['id']]['streams'][stream]['request'] = {}
-      if 'headers' in s['args']['params']:
-        self.netlog['http2'][s['id']]['streams'][stream]['request']['headers'] = s['args']['params']['headers']
-      if 'parent_stream_id' in s['args']['params']:
-        self.netlog['http2'][s['id']]['streams'][stream]['request']['parent_stream_id'] = s['args']['params']['parent_stream_id']
-      if 'exclusive' in s['args']['params']:
-        self.netlog['http2'][s['id']]['streams'][stream]['request']['exclusive'] = s['args']['params']['exclusive']
-      if 'priority' in s['args']['params']:
-        self.netlog['http2'][s['id']]['streams'][stream]['request']['priority'] = s['args']['params']['priority']
-
-    if s['name'] == 'HTTP2_SESSION_RECV_HEADERS' and 'params' in s['args']:
-      if 'first_byte' not in self.netlog['http2'][s['id']]['streams'][stream]:
-        self.netlog['http2'][s['id']]['streams'][stream]['first_byte'] = s['tts']
-      if 'response' not in self.netlog['http2'][s['id']]['streams'][stream]:
-        self.netlog['http2'][s['id']]['streams'][stream]['response'] = {}
-      if 'headers' in s['args']['params']:
-        self.netlog['http2'][s['id']]['response']['streams'][stream]['headers'] = s['args']['params']['headers']
-
-    if s['name'] == 'HTTP2_SESSION_RECV_DATA' and 'params' in s['args'] and 'size' in s['args']['params']:
-      if 'first_byte' not in self.netlog['http2'][s['id']]['streams'][stream]:
-        self.netlog['http2'][s['id']]['streams'][stream]['first_byte'] = s['tts']
-      self.netlog['http2'][s['id']]['streams'][stream]['bytes_in'] += s['args']['params']['size']
-      self.netlog['http2'][s['id']]['bytes_in'] += s['args']['params']['size']
+    if 'params' not in s['args'] or 'stream_id' not in s['args']['params']:
+      return
+    if 'http2' not in self.netlog:
+      self.netlog['http2'] = {}
+    if s['id'] not in self.netlog['http2']:
+      self.netlog['http2'][s['id']] = {'bytes_in': 0, 'bytes_out': 0, 'streams': {}}
+    session = self.netlog['http2'][s['id']]
+    params = s['args']['params']
+    stream_id = '{0:d}'.format(int(params['stream_id']))
+    if stream_id not in session['streams']:
+      session['streams'][stream_id] = {'start': s['ts'], 'end': s['ts'], 'bytes_in': 0, 'bytes_out': 0}
+    stream = session['streams'][stream_id]
+    if s['ts'] > stream['end']:
+      stream['end'] = s['ts']
+
+    if s['name'] == 'HTTP2_SESSION_SEND_HEADERS':
+      if 'request' not in stream:
+        stream['request'] = {}
+      for key in ['headers', 'parent_stream_id', 'exclusive', 'priority']:
+        if key in params:
+          stream['request'][key] = params[key]
+
+    elif s['name'] == 'HTTP2_SESSION_RECV_HEADERS':
+      if 'first_byte' not in stream:
+        stream['first_byte'] = s['ts']
+      if 'response' not in stream:
+        stream['response'] = {}
+      if 'headers' in params:
+        stream['response']['headers'] = params['headers']
+
+    elif s['name'] == 'HTTP2_SESSION_RECV_DATA' and 'size' in params:
+      if 'first_byte' not in stream:
+        stream['first_byte'] = s['ts']
+      stream['bytes_in'] += int(params['size'])
+      session['bytes_in'] += int(params['size'])
+
+    elif s['name'] == 'HTTP2_SESSION_SEND_DATA' and 'size' in params:
+      stream['bytes_out'] += int(params['size'])
+      session['bytes_out'] += int(params['size'])
+
+  # Roll the socket traffic up into per-millisecond [offset, bytes_in, bytes_out] entries.
+  # Offsets are from the start of the recording when netlog_offset (the ms from the start
+  # of the recording to navigationStart) is known, otherwise from navigationStart.
+  def ProcessNetlogBandwidth(self):
+    if not len(self.netlog_traffic) or self.netlog_start is None:
+      self.netlog_traffic = []
+      return
+    start = self.netlog_start
+    offset = self.netlog_offset if self.netlog_offset is not None else 0.0
+    buckets = {}
+    for ts, bytes_in, bytes_out in self.netlog_traffic:
+      ms = int(math.floor((ts - start) / 1000.0 + offset))
+      # Traffic from before the recording started doesn't belong to any sample
+      if self.netlog_offset is not None and ms < 0:
+        continue
+      if ms not in buckets:
+        buckets[ms] = [ms, 0, 0]
+      buckets[ms][1] += bytes_in
+      buckets[ms][2] += bytes_out
+    self.netlog['start'] = start
+    if self.netlog_offset is not None:
+      self.netlog['offset'] = self.netlog_offset
+    self.netlog['traffic'] = [buckets[ms] for ms in sorted(buckets)]
+    self.netlog_traffic = []
 
 
   ########################################################################################################################
@@ -585,6 +628,8 @@ def main():
   parser.add_argument('-f', '--features', help="Output blink feature usage file.")
   parser.add_argument('-i', '--interactive', help="Output list of interactive times.")
   parser.add_argument('-n', '--netlog', help="Output netlog details file.")
+  parser.add_argument('-o', '--netlogoffset', type=float,
+                      help="Time from the start of the recording to navigationStart (ms) for the netlog traffic.")
   parser.add_argument('-s', '--stats', help="Output v8 Call stats file.")
   options, unknown = parser.parse_known_args()
 
@@ -605,6 +650,7 @@ def main():
 
   start = time.time()
   trace = Trace()
+  trace.netlog_offset = options.netlogoffset
   if options.trace:
     trace.Process(options.trace)
   elif options.timeline:
@@ -10,17 +10,19 @@ import subprocess
 
 class TrafficShaper(object):
     """Main traffic-shaper interface"""
-    def __init__(self):
+    def __init__(self, options=None, shaper=None):
         self.support_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), "support")
-        self.shaper = None
+        self.shaper = shaper
         plat = platform.system()
-        if plat == "Windows":
+        if self.shaper is None and options is not None and options.shaper == 'proxy':
+            self.shaper = ProxyShaper()
+        elif self.shaper is None and plat == "Windows":
             winver = float(".".join(platform.version().split('.')[:2]))
             if winver >= 8.1:
                 self.shaper = WinShaper()
             else:
                 self.shaper = Dummynet()
-        elif plat == "Linux":
+        elif self.shaper is None and plat == "Linux":
             self.shaper = NetEm()
 
     def install(self):
@@ -44,6 +46,18 @@ class TrafficShaper(object):
             ret = self.shaper.reset()
         return ret
 
+    def get_proxy(self):
+        """The host:port of the SOCKS proxy browsers need to use (if any)"""
+        ret = None
+        if self.shaper is not None and hasattr(self.shaper, 'get_proxy'):
+            ret = self.shaper.get_proxy()
+        return ret
+
+    def set_resolver(self, resolver):
+        """Use the given DNS resolver for host names the proxy has to look up (if any)"""
+        if self.shaper is not None and hasattr(self.shaper, 'set_resolver'):
+            self.shaper.set_resolver(resolver)
+
     def configure(self, job):
         """Enable traffic-shaping"""
         ret = False
@@ -64,6 +78,40 @@ class TrafficShaper(object):
         return ret
 
 
+#
+# User-space proxy
+#
+class ProxyShaper(object):
+    """Cross-platform traffic-shaping through a local SOCKS5 proxy (no root needed)"""
+    def __init__(self):
+        from .shaping_proxy import ShapingProxy
+        self.proxy = ShapingProxy()
+
+    def install(self):
+        """Start the proxy"""
+        return self.proxy.start()
+
+    def remove(self):
+        """Stop the proxy"""
+        self.proxy.stop()
+        return True
+
+    def reset(self):
+        """Disable traffic-shaping"""
+        return self.proxy.configure(0, 0, 0, 0)
+
+    def configure(self, in_bps, out_bps, rtt, plr):
+        """Enable traffic-shaping"""
+        return self.proxy.configure(in_bps, out_bps, rtt, plr)
+
+    def get_proxy(self):
+        """Address for the browser to use"""
+        return '127.0.0.1:{0:d}'.format(self.proxy.port)
+
+    def set_resolver(self, resolver):
+        """DNS resolver for the proxy to use"""
+        self.proxy.resolver = resolver
+
 #
 # winshaper
 #
@@ -186,45 +234,137 @@ class Dummynet(object):
 #
 class NetEm(object):
     """Linux traffic-shaper using netem/tc"""
-    def __init__(self):
-        self.interface = None
+    def __init__(self, interface=None, ifb='ifb0'):
+        self.interface = interface
+        self.ifb = ifb
+        self.applied = {}
+        self.tx_bytes = {}
 
     def install(self):
         """Install and configure the traffic-shaper"""
         ret = False
 
-        # Figure out the default interface
         try:
-            out = subprocess.check_output(['route'])
-            routes = out.splitlines()
-            match = re.compile(r'^([^\s]+)\s+[^\s]+\s+[^\s]+\s+[^\s]+\s+'\
-                               r'[^\s]+\s+[^\s]+\s+[^\s]+\s+([^\s]+)')
-            for route in routes:
-                fields = re.search(match, route)
-                if fields:
-                    destination = fields.group(1)
-                    if destination == 'default':
-                        self.interface = fields.group(2)
-                        logging.debug("Default interface: %s", self.interface)
-                        break
-
+            if self.interface is None:
+                self.interface = self.get_default_interface()
             if self.interface:
-                # Set up the ifb interface so inbound traffic can be shaped
+                # Set up the ifb interface so inbound traffic on the default
+                # interface can be shaped
                 subprocess.call(['sudo', 'modprobe', 'ifb'])
-                subprocess.call(['sudo', 'ip', 'link', 'set', 'dev', 'ifb0', 'up'])
-                subprocess.call(['sudo', 'tc', 'qdisc', 'add', 'dev', 'ens33', 'ingress'])
-                subprocess.call(['sudo', 'tc', 'filter', 'add', 'dev', 'ens33', 'parent',
-                                 'ffff:', 'protocol', 'ip', 'u32', 'match', 'u32', '0', '0',
-                                 'flowid', '1:1', 'action', 'mirred', 'egress', 'redirect',
-                                 'dev', 'ifb0'])
-                self.reset()
-                ret = True
+                subprocess.call(['sudo', 'ip', 'link', 'set', 'dev', self.ifb, 'up'])
+                self.tc_batch(['qdisc del dev {0} ingress'.format(self.interface),
+                               'qdisc add dev {0} ingress'.format(self.interface),
+                               'filter add dev {0} parent ffff: protocol ip u32 match u32 0 0 '
+                               'flowid 1:1 action mirred egress redirect '
+                               'dev {1}'.format(self.interface, self.ifb)])
+                # Start from a known, unshaped state
+                self.tc_batch(['qdisc del dev {0} root'.format(self.ifb),
+                               'qdisc del dev {0} root'.format(self.interface)])
+                self.applied = {self.ifb: None, self.interface: None}
+                ret = self.verify_ingress()
             else:
-                logging.critical("Unable to identify default interface using 'route'")
+                logging.critical("Unable to identify the default interface")
         except BaseException as err:
             logging.debug("Error configuring netem: %s", err.__str__())
         return ret
 
+    def get_default_interface(self):
+        """Find the interface for the lowest-metric default route in /proc/net/route"""
+        interface = None
+        metric = None
+        if os.path.isfile('/proc/net/route'):
+            with open('/proc/net/route', 'r') as routes:
+                for line in routes.readlines()[1:]:
+                    fields = line.split()
+                    # Iface Destination Gateway Flags RefCnt Use Metric Mask ...
+                    if len(fields) >= 8 and fields[1] == '00000000' and \
+                            fields[7] == '00000000' and int(fields[3], 16) & 0x1:
+                        if metric is None or int(fields[6]) < metric:
+                            interface = fields[0]
+                            metric = int(fields[6])
+        logging.debug("Default interface: %s", interface)
+        return interface
+
+    def verify_ingress(self):
+        """Make sure inbound traffic on the shaped interface is redirected to the ifb device"""
+        ret = False
+        try:
+            out = subprocess.check_output(['tc', 'filter', 'show', 'dev', self.interface,
+                                           'parent', 'ffff:'])
+            if out.find('mirred (Egress Redirect to device {0})'.format(self.ifb)) > -1:
+                ret = True
+            else:
+                logging.critical("Inbound traffic on %s is not redirected to %s",
+                                 self.interface, self.ifb)
+        except BaseException as err:
+            logging.critical("Error checking the ingress filter: %s", err.__str__())
+        return ret
+
+    def get_qdisc_stats(self):
+        """Read back the netem/tbf qdisc settings and counters for every interface
+        (in a single tc process)"""
+        stats = {}
+        try:
+            out = subprocess.check_output(['tc', '-s', 'qdisc', 'show'])
+            entry = None
+            for line in out.splitlines():
+                match = re.match(r'^qdisc (\w+) [0-9a-f:]+ dev ([^\s]+) ', line)
+                if match:
+                    entry = None
+                    qdisc = match.group(1)
+                    if qdisc in ['netem', 'tbf']:
+                        entry = {'sent': 0}
+                        stats.setdefault(match.group(2), {})[qdisc] = entry
+                        delay = re.search(r' delay ([0-9.]+)(us|ms|s)', line)
+                        if delay:
+                            scale = {'us': 0.001, 'ms': 1.0, 's': 1000.0}[delay.group(2)]
+                            entry['delay'] = float(delay.group(1)) * scale
+                        loss = re.search(r' loss ([0-9.]+)%', line)
+                        if loss:
+                            entry['loss'] = float(loss.group(1))
+                        rate = re.search(r' rate ([0-9.]+)([KMG]?)bit', line)
+                        if rate:
+                            scale = {'': 1, 'K': 1000, 'M': 1000000, 'G': 1000000000}
+                            entry['rate'] = float(rate.group(1)) * scale[rate.group(2)]
+                elif entry is not None:
+                    sent = re.search(r'Sent ([0-9]+) bytes', line)
+                    if sent:
+                        entry['sent'] = int(sent.group(1))
+        except BaseException as err:
+            logging.critical("Error reading the qdisc stats: %s", err.__str__())
+        return stats
+
+    def get_tx_bytes(self, interface):
+        """Bytes sent by an interface (from sysfs so it doesn't cost a tc process)"""
+        ret = None
+        try:
+            with open('/sys/class/net/{0}/statistics/tx_bytes'.format(interface), 'r') as f_in:
+                ret = int(f_in.read().strip())
+        except BaseException as _:
+            pass
+        return ret
+
+    def verify(self, config):
+        """Make sure the kernel reports the shaping that we asked for"""
+        ret = True
+        all_stats = self.get_qdisc_stats()
+        for interface in config:
+            if config[interface] is not None:
+                bps, latency, plr = config[interface]
+                stats = all_stats.get(interface, {})
+                if 'netem' not in stats or \
+                        abs(stats['netem'].get('delay', 0.0) - latency) > 1.0 or \
+                        abs(stats['netem'].get('loss', 0.0) - plr) > 0.01:
+                    ret = False
+                elif bps > 0 and ('tbf' not in stats or
+                                  abs(stats['tbf'].get('rate', 0) - bps) > bps * 0.05):
+                    ret = False
+                if not ret:
+                    logging.critical("Traffic-shaping on %s does not match the requested "
+                                     "settings: %s", interface, stats)
+                    break
+        return ret
+
     def remove(self):
         """Uninstall traffic-shaping"""
         return True
@@ -233,9 +373,17 @@ class NetEm(object):
         """Disable traffic-shaping"""
         ret = False
         if self.interface is not None:
-            ret = subprocess.call(['sudo', 'tc', 'qdisc', 'del', 'dev', 'ifb0', 'root']) == 0 and\
-                  subprocess.call(['sudo', 'tc', 'qdisc', 'del', 'dev', self.interface,
-                                   'root']) == 0
+            # Flag runs where shaped inbound traffic never made it through the ifb device
+            if self.applied.get(self.ifb) is not None and self.tx_bytes:
+                inbound = self.get_tx_bytes(self.ifb)
+                outbound = self.get_tx_bytes(self.interface)
+                if None not in [inbound, outbound, self.tx_bytes.get(self.ifb),
+                                self.tx_bytes.get(self.interface)] and \
+                        outbound > self.tx_bytes[self.interface] and \
+                        inbound == self.tx_bytes[self.ifb]:
+                    logging.critical("No inbound traffic was shaped through %s", self.ifb)
+            self.tx_bytes = {}
+            ret = self.apply({self.ifb: None, self.interface: None})
         return ret
 
     def configure(self, in_bps, out_bps, rtt, plr):
@@ -245,22 +393,70 @@ class NetEm(object):
             in_latency = rtt / 2
             if rtt % 2:
                 in_latency += 1
-            if self.configure_interface('ifb0', in_bps, in_latency, plr):
-                ret = self.configure_interface(self.interface, out_bps, rtt / 2, plr)
+            config = {self.ifb: (in_bps, in_latency, plr),
+                      self.interface: (out_bps, rtt / 2, plr)}
+            changed = [interface for interface in config
+                       if interface not in self.applied or
+                       self.applied[interface] != config[interface]]
+            ret = self.apply(config)
+            # Read the settings back whenever they changed, tc can accept a batch without
+            # the kernel ending up with what was asked for
+            if ret and changed and not self.verify(config):
+                ret = False
+                self.apply({self.ifb: None, self.interface: None})
+            if ret:
+                self.tx_bytes = {self.ifb: self.get_tx_bytes(self.ifb),
+                                 self.interface: self.get_tx_bytes(self.interface)}
         return ret
 
+    def apply(self, config):
+        """Apply the per-interface (bps, latency, plr) settings in a single tc batch,
+        skipping any interfaces that already have the requested settings"""
+        ret = True
+        commands = []
+        changed = []
+        for interface in sorted(config):
+            if interface not in self.applied or self.applied[interface] != config[interface]:
+                changed.append(interface)
+                if interface not in self.applied or self.applied[interface] is not None:
+                    commands.append('qdisc del dev {0} root'.format(interface))
+                if config[interface] is not None:
+                    bps, latency, plr = config[interface]
+                    commands.extend(self.configure_interface(interface, bps, latency, plr))
+        if len(commands):
+            # tc keeps going after a failed command with -force but still reports the failure
+            ret = self.tc_batch(commands)
+            if ret:
+                for interface in changed:
+                    self.applied[interface] = config[interface]
+            else:
+                # Log what the kernel ended up with before putting the interfaces back
+                self.verify(dict((interface, config[interface]) for interface in changed))
+                # Put the interfaces back into a known (unshaped) state
+                self.tc_batch(['qdisc del dev {0} root'.format(interface)
+                               for interface in changed])
+                for interface in changed:
+                    self.applied[interface] = None
+        else:
+            logging.debug("Traffic-shaping already configured")
+        return ret
+
+    def tc_batch(self, commands):
+        """Run a set of tc commands in a single elevated tc process"""
+        logging.debug('sudo tc -force -batch -\n%s', '\n'.join(commands))
+        proc = subprocess.Popen(['sudo', 'tc', '-force', '-batch', '-'], stdin=subprocess.PIPE)
+        proc.communicate('\n'.join(commands) + '\n')
+        return proc.returncode == 0
+
     def configure_interface(self, interface, bps, latency, plr):
-        """Configure traffic-shaping for a single interface"""
-        ret = False
-        args = ['sudo', 'tc', 'qdisc', 'add', 'dev', interface, 'root', 'handle',
-                '1:0', 'netem', 'delay', '{0:d}ms'.format(latency)]
+        """Build the tc commands to configure traffic-shaping for a single interface"""
+        command = 'qdisc add dev {0} root handle 1:0 netem delay {1:d}ms'.format(interface,
+                                                                                 latency)
         if plr > 0:
-            args.extend(['loss', '{0:.2f}%'.format(plr)])
-        ret = subprocess.call(args) == 0
-        if ret and bps > 0:
+            command += ' loss {0:.2f}%'.format(plr)
+        commands = [command]
+        if bps > 0:
             kbps = int(bps / 1000)
-            args = ['sudo', 'tc', 'qdisc', 'add', 'dev', interface, 'parent', '1:1',
-                    'handle', '10:', 'tbf', 'rate', '{0:d}kbit'.format(kbps),
-                    'buffer', '150000', 'limit', '150000']
-            ret = subprocess.call(args) == 0
-        return ret
+            commands.append('qdisc add dev {0} parent 1:1 handle 10: tbf rate {1:d}kbit '
+                            'buffer 150000 limit 150000'.format(interface, kbps))
+        return commands
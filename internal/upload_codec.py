@@ -0,0 +1,262 @@
+# Copyright 2017 Google Inc. All rights reserved.
+# Use of this source code is governed by the Apache 2.0 license that can be
+# found in the LICENSE file.
+"""Content-Encoding for uploads, picked per artifact type from what has worked on this agent"""
+import logging
+import os
+import platform
+import threading
+import time
+import zlib
+
+# Artifacts that are already compressed and are always sent as-is
+PRECOMPRESSED = ['.gz', '.zip', '.jpg', '.jpeg', '.webp', '.webm', '.mp4']
+# Codecs that are tried for everything else (along with sending it uncompressed)
+CODEC_CANDIDATES = [('gzip', 1), ('gzip', 6), ('zstd', 3)]
+# Each codec gets used this many times for an artifact type before the stats take over
+CODEC_TRIALS = 2
+# Uplink speed (bytes/sec) to assume until an upload has been timed
+DEFAULT_UPLINK = 1000000.0
+# Valid (lowest, highest, default) compression levels for each codec
+CODEC_LEVELS = {'gzip': (1, 9, 6), 'zstd': (1, 22, 3)}
+# clock_gettime() clock for the calling thread's CPU time
+THREAD_CPUTIME_ID = {'Linux': 3, 'Darwin': 16}
+# Resolved thread CPU clock (False if the platform doesn't have one)
+THREAD_CLOCK = None
+
+def artifact_type(filename):
+    """The file extension that the codec stats are kept by"""
+    return os.path.splitext(filename)[1].lower()
+
+def is_precompressed(filename):
+    """Whether the file is already compressed"""
+    return artifact_type(filename) in PRECOMPRESSED
+
+def parse_setting(setting):
+    """Validate a --uploadcodec setting, returns None for auto, 'none' or (coding, level)"""
+    ret = None
+    if setting is not None and setting != 'auto':
+        coding, _, level = setting.partition(':')
+        if coding == 'none' and not level:
+            ret = 'none'
+        elif coding in CODEC_LEVELS:
+            low, high, default = CODEC_LEVELS[coding]
+            if level:
+                try:
+                    level = int(level)
+                except ValueError:
+                    raise ValueError("invalid {0} level '{1}'".format(coding, level))
+                if level < low or level > high:
+                    raise ValueError("{0} level must be between {1:d} and {2:d}".format(
+                        coding, low, high))
+            else:
+                level = default
+            if coding == 'zstd':
+                try:
+                    import zstandard as _
+                except ImportError:
+                    raise ValueError("zstd needs the zstandard module (pip install zstandard)")
+            ret = (coding, level)
+        else:
+            raise ValueError("unknown codec '{0}' (use auto, none, gzip[:LEVEL] or "
+                             "zstd[:LEVEL])".format(setting))
+    return ret
+
+def load_thread_clock():
+    """clock_gettime() for the calling thread's CPU time (None where it isn't available)"""
+    ret = None
+    system = platform.system()
+    if system in THREAD_CPUTIME_ID:
+        try:
+            import ctypes
+            import ctypes.util
+            class Timespec(ctypes.Structure):
+                """struct timespec"""
+                _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+            # clock_gettime moved from librt into libc with glibc 2.17
+            for name in [ctypes.util.find_library('c'), ctypes.util.find_library('rt')]:
+                if name is None:
+                    continue
+                lib = ctypes.CDLL(name)
+                if hasattr(lib, 'clock_gettime'):
+                    clock_gettime = lib.clock_gettime
+                    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+                    clock_id = THREAD_CPUTIME_ID[system]
+                    def thread_clock():
+                        """CPU seconds used by the calling thread"""
+                        value = Timespec()
+                        if clock_gettime(clock_id, ctypes.byref(value)) != 0:
+                            raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+                        return value.tv_sec + value.tv_nsec / 1000000000.0
+                    thread_clock()
+                    ret = thread_clock
+                    break
+        except BaseException as err:
+            logging.debug("Per-thread CPU time is not available: %s", err.__str__())
+    elif system == 'Windows':
+        try:
+            import win32api
+            import win32process
+            def thread_clock():
+                """CPU seconds used by the calling thread"""
+                times = win32process.GetThreadTimes(win32api.GetCurrentThread())
+                # Kernel and user times are in 100ns units
+                return (times['KernelTime'] + times['UserTime']) / 10000000.0
+            thread_clock()
+            ret = thread_clock
+        except BaseException as err:
+            logging.debug("Per-thread CPU time is not available: %s", err.__str__())
+    return ret
+
+def cpu_time():
+    """CPU seconds used by the calling thread so far.
+
+    The sampler, log writer and upload threads all run while something is being encoded so
+    process-wide CPU time would charge their work to the codec. Where the thread's own clock
+    isn't available the process time is used instead."""
+    global THREAD_CLOCK
+    if THREAD_CLOCK is None:
+        THREAD_CLOCK = load_thread_clock() or False
+    if THREAD_CLOCK:
+        return THREAD_CLOCK()
+    if platform.system() == 'Windows':
+        times = os.times()
+        return times[0] + times[1]
+    # Process CPU time at a much finer resolution than the os.times() ticks
+    return time.clock()
+
+
+class Encoder(object):
+    """Streaming compressor with a zlib-style compress/flush interface"""
+    def __init__(self, coding, level):
+        self.coding = coding
+        if coding == 'zstd':
+            import zstandard
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            # wbits of 31 makes zlib write a gzip header and trailer
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        """Compress the next piece of data"""
+        return self.compressor.compress(data)
+
+    def flush(self):
+        """Finish the stream"""
+        return self.compressor.flush()
+
+
+class UploadCodecs(object):
+    """Picks the codec for each upload from the measured ratio and CPU cost of each one"""
+    def __init__(self, setting=None):
+        self.lock = threading.Lock()
+        self.accepted = set()
+        self.stats = {}
+        self.uplink = None
+        # Fixed codec if one was configured ('none', 'gzip', 'gzip:9', 'zstd:3')
+        self.fixed = None
+        # (validated when the command line is parsed)
+        self.fixed = parse_setting(setting)
+
+    def set_accepted(self, header):
+        """Record the codings the server accepts for request bodies (its Accept-Encoding)"""
+        accepted = set()
+        if header:
+            for coding in header.split(','):
+                coding = coding.split(';')[0].strip().lower()
+                if coding == 'zstd':
+                    try:
+                        import zstandard as _
+                        accepted.add(coding)
+                    except ImportError:
+                        pass
+                elif coding:
+                    accepted.add(coding)
+        with self.lock:
+            if accepted != self.accepted:
+                logging.debug("Server accepts %s encoded uploads", ', '.join(sorted(accepted)))
+            self.accepted = accepted
+
+    def choose(self, filename):
+        """The (coding, level) to send the file with or None to send it as-is"""
+        ret = None
+        if not is_precompressed(filename):
+            with self.lock:
+                if self.fixed is not None:
+                    if self.fixed != 'none' and self.fixed[0] in self.accepted:
+                        ret = self.fixed
+                else:
+                    ret = self.best_codec(artifact_type(filename))
+        return ret
+
+    def best_codec(self, extension):
+        """Cheapest codec for the artifact type (in seconds of CPU plus uplink per byte)"""
+        candidates = [codec for codec in CODEC_CANDIDATES if codec[0] in self.accepted]
+        if not candidates:
+            return None
+        stats = self.stats.get(extension, {})
+        # Try everything a few times before trusting the numbers
+        for codec in candidates:
+            if codec not in stats or stats[codec]['count'] < CODEC_TRIALS:
+                return codec
+        uplink = self.uplink if self.uplink else DEFAULT_UPLINK
+        best = None
+        best_cost = 1.0 / uplink
+        for codec in candidates:
+            entry = stats[codec]
+            if entry['in']:
+                cost = (entry['cpu'] + entry['out'] / uplink) / entry['in']
+                if cost < best_cost:
+                    best = codec
+                    best_cost = cost
+        return best
+
+    def encode(self, source, dest, codec, filename):
+        """Compress everything that can be read from source into the dest file"""
+        bytes_in = 0
+        bytes_out = 0
+        start = cpu_time()
+        encoder = Encoder(codec[0], codec[1])
+        while True:
+            data = source.read(65536)
+            if not data:
+                break
+            bytes_in += len(data)
+            out = encoder.compress(data)
+            bytes_out += len(out)
+            dest.write(out)
+        out = encoder.flush()
+        bytes_out += len(out)
+        dest.write(out)
+        self.record(filename, codec, bytes_in, bytes_out, cpu_time() - start)
+
+    def encode_data(self, data, codec, filename):
+        """Compress a buffer"""
+        start = cpu_time()
+        encoder = Encoder(codec[0], codec[1])
+        out = encoder.compress(data) + encoder.flush()
+        self.record(filename, codec, len(data), len(out), cpu_time() - start)
+        return out
+
+    def record(self, filename, codec, bytes_in, bytes_out, cpu):
+        """Add a compression run to the stats for the artifact type"""
+        extension = artifact_type(filename)
+        with self.lock:
+            if extension not in self.stats:
+                self.stats[extension] = {}
+            if codec not in self.stats[extension]:
+                self.stats[extension][codec] = {'count': 0, 'in': 0, 'out': 0, 'cpu': 0.0}
+            entry = self.stats[extension][codec]
+            entry['count'] += 1
+            entry['in'] += bytes_in
+            entry['out'] += bytes_out
+            entry['cpu'] += max(0.0, cpu)
+        logging.debug("%s %s:%d %d -> %d bytes in %0.1fms", filename, codec[0], codec[1],
+                      bytes_in, bytes_out, cpu * 1000.0)
+
+    def record_upload(self, byte_count, elapsed):
+        """Fold a timed upload into the uplink speed estimate"""
+        if byte_count >= 100000 and elapsed > 0:
+            speed = float(byte_count) / elapsed
+            with self.lock:
+                self.uplink = speed if self.uplink is None else self.uplink * 0.7 + speed * 0.3
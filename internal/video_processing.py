@@ -3,12 +3,16 @@
 # found in the LICENSE file.
 """Video processing logic"""
 import glob
+import gzip
 import logging
 import math
 import os
 import re
 import subprocess
 import threading
+import ujson as json
+from .os_util import discard_directory
+from .result_archive import archive_file
 
 VIDEO_SIZE = 400
 
@@ -23,37 +27,7 @@ class VideoProcessing(object):
     def process(self):
         """Post Process the video"""
         if os.path.isdir(self.video_path):
-            # Make the initial screen shot the same size as the video
-            logging.debug("Resizing initial video frame")
-            from PIL import Image
-            files = sorted(glob.glob(os.path.join(self.video_path, 'ms_*.png')))
-            count = len(files)
-            width = 0
-            height = 0
-            if count > 1:
-                with Image.open(files[1]) as image:
-                    width, height = image.size
-                    command = 'convert "{0}" -resize {1:d}x{2:d} "{0}"'.format(
-                        files[0], width, height)
-                    logging.debug(command)
-                    subprocess.call(command, shell=True)
-            # Eliminate duplicate frames ignoring 25 pixels across the bottom and
-            # right sides for status and scroll bars
-            crop = None
-            if width > 25 and height > 25:
-                crop = '{0:d}x{1:d}+0+0'.format(width - 25, height - 25)
-            logging.debug("Removing duplicate video frames")
-            self.cap_frame_count(self.video_path, 50)
-            files = sorted(glob.glob(os.path.join(self.video_path, 'ms_*.png')))
-            count = len(files)
-            if count > 1:
-                baseline = files[0]
-                for index in xrange(1, count):
-                    if self.frames_match(baseline, files[index], crop, 1, 0):
-                        logging.debug('Removing similar frame %s', os.path.basename(files[index]))
-                        os.remove(files[index])
-                    else:
-                        baseline = files[index]
+            self.reduce_frames(self.video_path)
             # start a background thread to convert the images to jpeg
             logging.debug("Converting video frames to jpeg")
             jpeg_thread = threading.Thread(target=self.convert_to_jpeg)
@@ -68,14 +42,94 @@ class VideoProcessing(object):
                                                                          self.task['cached'],
                                                                          self.task['current_step'])
             histograms = os.path.join(self.task['dir'], filename)
-            visualmetrics = os.path.join(self.support_path, "visualmetrics.py")
-            subprocess.call(['python', visualmetrics, '-d', self.video_path,
-                             '--histogram', histograms])
+            metrics = self.visual_metrics(self.video_path, histograms)
+            if 'video_capture' in self.task and self.task['video_capture'] == 'compare':
+                self.compare_capture(metrics)
             # Wait for the jpeg task to complete and delete the png's
             logging.debug("Waiting for jpeg conversion to finish")
             jpeg_thread.join()
             for filepath in sorted(glob.glob(os.path.join(self.video_path, 'ms_*.png'))):
                 os.remove(filepath)
+            archive_file(self.task, histograms)
+            for filepath in sorted(glob.glob(os.path.join(self.video_path, 'ms_*.jpg'))):
+                archive_file(self.task, filepath)
+
+    def reduce_frames(self, video_path):
+        """Size the initial frame to match and drop the excess and duplicate frames"""
+        # Make the initial screen shot the same size as the video
+        logging.debug("Resizing initial video frame")
+        from PIL import Image
+        files = sorted(glob.glob(os.path.join(video_path, 'ms_*.png')))
+        count = len(files)
+        width = 0
+        height = 0
+        if count > 1:
+            with Image.open(files[1]) as image:
+                width, height = image.size
+                command = 'convert "{0}" -resize {1:d}x{2:d} "{0}"'.format(
+                    files[0], width, height)
+                logging.debug(command)
+                subprocess.call(command, shell=True)
+        # Eliminate duplicate frames ignoring 25 pixels across the bottom and
+        # right sides for status and scroll bars
+        crop = None
+        if width > 25 and height > 25:
+            crop = '{0:d}x{1:d}+0+0'.format(width - 25, height - 25)
+        logging.debug("Removing duplicate video frames")
+        self.cap_frame_count(video_path, 50)
+        files = sorted(glob.glob(os.path.join(video_path, 'ms_*.png')))
+        count = len(files)
+        if count > 1:
+            baseline = files[0]
+            for index in xrange(1, count):
+                if self.frames_match(baseline, files[index], crop, 1, 0):
+                    logging.debug('Removing similar frame %s', os.path.basename(files[index]))
+                    os.remove(files[index])
+                else:
+                    baseline = files[index]
+
+    def visual_metrics(self, video_path, histograms):
+        """Run visualmetrics against the frames, returns the metrics it calculated"""
+        metrics = None
+        visualmetrics = os.path.join(self.support_path, "visualmetrics.py")
+        command = ['python', visualmetrics, '-d', video_path, '--histogram', histograms,
+                   '--json']
+        logging.debug(command)
+        out, _ = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()
+        try:
+            if out:
+                metrics = json.loads(out.strip().splitlines()[-1])
+        except ValueError:
+            logging.debug("Unexpected visualmetrics output: %s", out)
+        return metrics
+
+    def compare_capture(self, metrics):
+        """Calculate the visual metrics from the screencast frames that were captured
+        alongside the trace screenshots and record how they differ"""
+        screencast_path = self.video_path + '_screencast'
+        if os.path.isdir(screencast_path):
+            logging.debug("Processing screencast frames for comparison")
+            self.reduce_frames(screencast_path)
+            histograms = os.path.join(screencast_path, 'histograms.json.gz')
+            screencast_metrics = self.visual_metrics(screencast_path, histograms)
+            comparison = {'trace': metrics, 'screencast': screencast_metrics,
+                          'trace_frames': len(glob.glob(os.path.join(self.video_path,
+                                                                     'ms_*.png'))),
+                          'screencast_frames': len(glob.glob(os.path.join(screencast_path,
+                                                                          'ms_*.png'))),
+                          'difference': {}}
+            if metrics is not None and screencast_metrics is not None:
+                for name in metrics:
+                    if name in screencast_metrics and \
+                            isinstance(metrics[name], (int, long, float)) and \
+                            isinstance(screencast_metrics[name], (int, long, float)):
+                        comparison['difference'][name] = screencast_metrics[name] - metrics[name]
+            logging.info("Screencast vs trace capture: %s", json.dumps(comparison['difference']))
+            path = os.path.join(self.task['dir'], self.task['prefix'] + 'video_compare.json.gz')
+            with gzip.open(path, 'wb') as f_out:
+                json.dump(comparison, f_out)
+            archive_file(self.task, path)
+            discard_directory(screencast_path)
 
     def convert_to_jpeg(self):
         """Convert all of the pngs in the given directory to jpeg"""
@@ -2,21 +2,41 @@
 # Use of this source code is governed by the Apache 2.0 license that can be
 # found in the LICENSE file.
 """Main entry point for interfacing with WebPageTest server"""
+import hashlib
 import logging
 import os
 import platform
-import shutil
+import random
+import time
 import urllib
-import zipfile
+import uuid
+import monotonic
 import ujson as json
+from .os_util import discard_directory
+from .result_archive import ResultArchive, SEPARATE_UPLOAD_SIZE
+from .result_spool import ResultSpool
+from .run_timing import RunTiming
+from .upload_codec import UploadCodecs
 
 DEFAULT_JPEG_QUALITY = 30
+# Backoff (in seconds) between getwork polls that come back empty (capped at the old fixed
+# 5 second poll interval so an idle agent never picks up new work later than it used to)
+POLL_BASE_DELAY = 0.5
+POLL_MAX_DELAY = 5.0
+# How long the server should hold a prefetched job for us before handing it to another agent
+JOB_LEASE_TIME = 600
+# Files larger than this are sent in resumable chunks (if the server supports it)
+CHUNKED_UPLOAD_SIZE = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 512 * 1024
+UPLOAD_CHUNK_RETRIES = 5
 
 class WebPageTest(object):
     """Controller for interfacing with the WebPageTest server"""
     def __init__(self, options, workdir):
         import requests
         self.session = requests.Session()
+        self.prefetch_session = requests.Session()
+        self.spool_session = requests.Session()
         self.options = options
         self.url = options.server
         self.location = options.location
@@ -27,14 +47,28 @@ class WebPageTest(object):
             self.pc_name = options.name
         self.workdir = os.path.join(workdir, self.pc_name)
         if os.path.isdir(self.workdir):
-            try:
-                shutil.rmtree(self.workdir)
-            except BaseException as _:
-                pass
+            discard_directory(self.workdir)
         self.profile_dir = os.path.join(self.workdir, 'browser')
+        # Profile templates live outside of the per-agent work directory so they
+        # survive between jobs
+        self.profile_templates = None
+        if options.profiletemplate:
+            self.profile_templates = os.path.join(workdir, 'profile_templates', self.pc_name)
+        self.long_poll = options.longpoll
+        self.idle_polls = 0
+        self.poll_delay = 0
+        self.chunked_uploads = True
+        self.codecs = UploadCodecs(options.uploadcodec)
+        self.metrics = None
+        # Results that can't be uploaded are kept outside of the work directory so they
+        # survive a restart
+        self.spool = None
+        if options.spoolsize:
+            self.spool = ResultSpool(os.path.join(workdir, 'spool', self.pc_name),
+                                     options.spoolsize * 1024 * 1024, self.upload_spooled)
 
-    def get_test(self):
-        """Get a job from the server"""
+    def get_test(self, prefetch=False):
+        """Get a job from the server (leased until it is acked when prefetching)"""
         import requests
         job = None
         url = self.url + "getwork.php?f=json"
@@ -42,9 +76,21 @@ class WebPageTest(object):
         url += "&pc=" + urllib.quote_plus(self.pc_name)
         if self.key is not None:
             url += "&key=" + self.key
+        session = self.session
+        if prefetch:
+            url += "&lease={0:d}".format(JOB_LEASE_TIME)
+            # Uploads for the current job may be using the main session at the same time
+            session = self.prefetch_session
+        timeout = 30
+        if self.long_poll:
+            # Ask the server to hold the request until work arrives
+            url += "&lp={0:d}".format(self.long_poll)
+            timeout += self.long_poll
         logging.info("Checking for work: %s", url)
+        start = monotonic.monotonic()
         try:
-            response = self.session.get(url, timeout=30)
+            response = session.get(url, timeout=timeout)
+            self.codecs.set_accepted(response.headers.get('Accept-Encoding'))
             if len(response.text):
                 job = response.json()
                 logging.debug("Job: %s", json.dumps(job))
@@ -69,8 +115,39 @@ class WebPageTest(object):
                     job = None
         except requests.exceptions.RequestException as err:
             logging.critical("Get Work Error: %s", err.strerror)
+        if prefetch:
+            # Prefetches run on their own thread while the main loop owns the poll state
+            pass
+        elif job is not None:
+            self.idle_polls = 0
+            self.poll_delay = 0
+        elif self.long_poll and monotonic.monotonic() - start >= self.long_poll * 0.9:
+            # The server held the request for the full long-poll so ask again right away
+            self.idle_polls = 0
+            self.poll_delay = 0
+        else:
+            # Exponential backoff with jitter so a fleet of idle agents doesn't poll in step
+            delay = min(POLL_MAX_DELAY, POLL_BASE_DELAY * (2 ** min(self.idle_polls, 16)))
+            self.poll_delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+            self.idle_polls += 1
         return job
 
+    def ack_test(self, job, release=False):
+        """Confirm that a prefetched job is starting (or hand it back to the server)"""
+        import requests
+        url = self.url + "ackwork.php?id=" + urllib.quote_plus(job['Test ID'])
+        url += "&location=" + urllib.quote_plus(self.location)
+        url += "&pc=" + urllib.quote_plus(self.pc_name)
+        if self.key is not None:
+            url += "&key=" + self.key
+        if release:
+            url += "&release=1"
+        logging.debug(url)
+        try:
+            self.session.get(url, timeout=30)
+        except requests.exceptions.RequestException as err:
+            logging.error("Error acknowledging job %s: %s", job['Test ID'], err.strerror)
+
     def get_task(self, job):
         """Create a task object for the next test run or return None if the job is done"""
         task = None
@@ -98,6 +175,18 @@ class WebPageTest(object):
                         'video_directories': []}
                 # Set up the task configuration options
                 task['port'] = 9222
+                if self.profile_templates is not None:
+                    task['profile_templates'] = self.profile_templates
+                if self.options.samplerate:
+                    task['sample_rate'] = self.options.samplerate
+                if self.options.loggzip is not None:
+                    task['log_gzip_level'] = self.options.loggzip
+                if self.options.videocapture:
+                    task['video_capture'] = self.options.videocapture
+                if self.options.screencastquality:
+                    task['screencast_quality'] = self.options.screencastquality
+                if self.options.screencastsize:
+                    task['screencast_size'] = self.options.screencastsize
                 task['task_prefix'] = "{0:d}_".format(run)
                 if task['cached']:
                     task['task_prefix'] += "Cached_"
@@ -109,8 +198,10 @@ class WebPageTest(object):
                     task['task_video_prefix'] += "_cached"
                 task['video_subdirectory'] = task['task_video_prefix']
                 if os.path.isdir(task['dir']):
-                    shutil.rmtree(task['dir'])
+                    discard_directory(task['dir'])
                 os.makedirs(task['dir'])
+                task['archive'] = ResultArchive(task['dir'])
+                task['timing'] = RunTiming()
                 if not os.path.isdir(profile_dir):
                     os.makedirs(profile_dir)
                 if job['current_state']['run'] == job['runs']:
@@ -131,11 +222,8 @@ class WebPageTest(object):
                         task['width'] = job['width']
                         task['height'] = job['height']
                 task['time_limit'] = job['timeout']
-        if task is None and os.path.isdir(self.workdir):
-            try:
-                shutil.rmtree(self.workdir)
-            except BaseException as _:
-                pass
+        if task is None:
+            self.discard_job_files(job['Test ID'])
         return task
 
     def build_script(self, job, task):
@@ -182,30 +270,30 @@ class WebPageTest(object):
                             job['timeout'] = time_limit
                     elif command == 'blockdomains':
                         keep = False
-                        if 'host_rules' not in task:
-                            task['host_rules'] = []
+                        if 'dns_rules' not in task:
+                            task['dns_rules'] = []
                         domains = target.split()
                         for domain in domains:
                             domain = domain.strip()
                             if len(domain) and domain.find('"') == -1:
-                                task['host_rules'].append('"MAP {0} 127.0.0.1"'.format(domain))
+                                task['dns_rules'].append({'host': domain, 'block': True})
                     elif command == 'blockdomainsexcept':
                         keep = False
-                        if 'host_rules' not in task:
-                            task['host_rules'] = []
+                        if 'dns_rules' not in task:
+                            task['dns_rules'] = []
                         domains = target.split()
                         for domain in domains:
                             domain = domain.strip()
                             if len(domain) and domain.find('"') == -1:
-                                task['host_rules'].append(
-                                    '"MAP * 127.0.0.1, EXCLUDE {0}"'.format(domain))
+                                task['dns_rules'].append({'host': '*', 'block': True,
+                                                          'exclude': domain})
                     elif command == 'setdns':
                         keep = False
                         if target is not None and value is not None and len(target) and len(value):
                             if target.find('"') == -1 and value.find('"') == -1:
-                                if 'host_rules' not in task:
-                                    task['host_rules'] = []
-                                task['host_rules'].append('"MAP {0} {1}"'.format(target, value))
+                                if 'dns_rules' not in task:
+                                    task['dns_rules'] = []
+                                task['dns_rules'].append({'host': target, 'address': value})
 
                     elif command == 'addheader' or command == 'setheader':
                         keep = False
@@ -248,9 +336,16 @@ class WebPageTest(object):
                 'key': self.key,
                 'run': str(task['run']),
                 'cached': str(task['cached'])}
-        needs_zip = []
         zip_path = None
+        separate = []
+        # Queue up behind any results that are already waiting to go out
+        spooling = self.spool is not None and self.spool.pending()
         if os.path.isdir(task['dir']):
+            # Most of the small artifacts were already moved into the archive as they finished
+            if 'archive' in task and task['archive'] is not None:
+                archive = task['archive']
+            else:
+                archive = ResultArchive(task['dir'])
             # upload any video images
             if len(task['video_directories']):
                 for video_subdirectory in task['video_directories']:
@@ -259,75 +354,305 @@ class WebPageTest(object):
                         for filename in os.listdir(video_dir):
                             filepath = os.path.join(video_dir, filename)
                             if os.path.isfile(filepath):
-                                name = video_subdirectory + '/' + filename
-                                if os.path.getsize(filepath) > 100000:
+                                if os.path.getsize(filepath) > SEPARATE_UPLOAD_SIZE and \
+                                        spooling:
+                                    separate.append((filepath, task['prefix'] + filename))
+                                elif os.path.getsize(filepath) > SEPARATE_UPLOAD_SIZE:
                                     logging.debug('Uploading %s', filename)
-                                    if self.post_data(self.url + "resultimage.php", data,
-                                                      filepath, task['prefix'] + filename):
+                                    if self.upload_file(data, filepath,
+                                                        task['prefix'] + filename):
                                         os.remove(filepath)
+                                    elif self.spool is not None:
+                                        # Spool the rest of the result instead of
+                                        # re-sending the file in the zip
+                                        spooling = True
+                                        separate.append((filepath, task['prefix'] + filename))
                                     else:
-                                        needs_zip.append({'path': filepath, 'name': name})
+                                        archive.add(filepath, force=True)
                                 else:
-                                    needs_zip.append({'path': filepath, 'name': name})
+                                    archive.add(filepath, force=True)
             # Upload the separate large files (> 100KB)
             for filename in os.listdir(task['dir']):
                 filepath = os.path.join(task['dir'], filename)
-                if os.path.isfile(filepath):
-                    if os.path.getsize(filepath) > 100000:
+                if os.path.isfile(filepath) and filepath != archive.path:
+                    if os.path.getsize(filepath) > SEPARATE_UPLOAD_SIZE and spooling:
+                        separate.append((filepath, filename))
+                    elif os.path.getsize(filepath) > SEPARATE_UPLOAD_SIZE:
                         logging.debug('Uploading %s', filename)
-                        if self.post_data(self.url + "resultimage.php", data, filepath, filename):
+                        if self.upload_file(data, filepath, filename):
                             os.remove(filepath)
+                        elif self.spool is not None:
+                            # Spool the rest of the result (the chunked upload resumes from
+                            # wherever the server got to) instead of re-sending it in the zip
+                            spooling = True
+                            separate.append((filepath, filename))
                         else:
-                            needs_zip.append({'path': filepath, 'name': filename})
+                            archive.add(filepath, force=True)
                     else:
-                        needs_zip.append({'path': filepath, 'name': filename})
-            # Zip the remaining files
-            if len(needs_zip):
-                zip_path = os.path.join(task['dir'], "result.zip")
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zip_file:
-                    for zipitem in needs_zip:
-                        logging.debug('Storing %s', zipitem['name'])
-                        zip_file.write(zipitem['path'], zipitem['name'])
-                        os.remove(zipitem['path'])
+                        archive.add(filepath, force=True)
+            # The timing goes in with the result (the upload is timed up to this point)
+            if 'timing' in task and task['timing'] is not None:
+                timing_file = os.path.join(task['dir'], task['task_prefix'] + 'agent_timing.json')
+                task['timing'].save(timing_file)
+                archive.add(timing_file, force=True)
+            # Finish off the zip of the remaining files
+            zip_path = archive.close()
         # Post the workdone event for the task (with the zip attached)
         if task['done']:
             data['done'] = '1'
         if task['error'] is not None:
             data['error'] = task['error']
-        logging.debug('Uploading result zip')
-        self.post_data(self.url + "workdone.php", data, zip_path, 'result.zip')
+        if spooling:
+            self.spool.commit(data, separate, zip_path)
+        else:
+            logging.debug('Uploading result zip')
+            if not self.post_data(self.url + "workdone.php", data, zip_path, 'result.zip') and \
+                    self.spool is not None:
+                # Keep the result around until the server is reachable again
+                self.spool.commit(data, separate, zip_path)
         # Clean up so we don't leave directories lying around
         if os.path.isdir(task['dir']):
-            try:
-                shutil.rmtree(task['dir'])
-            except BaseException as _:
-                pass
-        if task['done'] and os.path.isdir(self.workdir):
-            try:
-                shutil.rmtree(self.workdir)
-            except BaseException as _:
-                pass
+            discard_directory(task['dir'])
+        if task['done']:
+            self.discard_job_files(task['id'])
+
+    def discard_job_files(self, test_id):
+        """Delete the task and profile directories for a job (but not for a prefetched one)"""
+        if os.path.isdir(self.workdir):
+            profile_prefix = os.path.basename(self.profile_dir) + '.' + test_id + '.'
+            for name in os.listdir(self.workdir):
+                if name.startswith(test_id + '.') or name.startswith(profile_prefix):
+                    discard_directory(os.path.join(self.workdir, name))
+
+    def upload_spooled(self, entry_dir, manifest):
+        """Send a spooled result (called from the spool's drain thread)"""
+        data = manifest['data']
+        for entry in manifest['files']:
+            file_path = os.path.join(entry_dir, entry['file'])
+            if os.path.isfile(file_path):
+                if not self.upload_file(data, file_path, entry['name'], self.spool_session):
+                    return False
+                # Don't send it again if the workdone post needs to be retried
+                os.remove(file_path)
+        zip_path = os.path.join(entry_dir, manifest['zip']) if manifest['zip'] else None
+        return self.post_data(self.url + "workdone.php", data, zip_path, 'result.zip',
+                              self.spool_session)
 
-    def post_data(self, url, data, file_path, filename):
+    def upload_file(self, data, file_path, filename, session=None):
+        """Upload a large artifact on its own (in resumable chunks if the server supports it)"""
+        ret = None
+        if self.chunked_uploads and os.path.getsize(file_path) > CHUNKED_UPLOAD_SIZE:
+            ret = self.post_chunked(self.url + "resultchunk.php", data, file_path, filename,
+                                    session)
+        if ret is None:
+            ret = self.post_data(self.url + "resultimage.php", data, file_path, filename,
+                                 session)
+        return ret
+
+    def post_chunked(self, url, data, file_path, filename, session=None):
+        """Send a file in checksummed chunks, picking up from wherever the server got to.
+        Returns None if the server doesn't support chunked uploads."""
+        file_size = os.path.getsize(file_path)
+        file_hash = hashlib.sha1()
+        with open(file_path, 'rb') as file_in:
+            while True:
+                buff = file_in.read(1024 * 1024)
+                if not buff:
+                    break
+                file_hash.update(buff)
+        params = dict(data)
+        params['file'] = filename
+        params['size'] = str(file_size)
+        params['upload'] = file_hash.hexdigest()
+        # Find out how much of the file the server already has (from an earlier attempt)
+        status = self.chunk_request(url, params, session=session)
+        if status is None:
+            return None
+        offset = status['offset'] if status else 0
+        complete = status['complete'] if status else False
+        codec = self.codecs.choose(filename)
+        failures = 0
+        with open(file_path, 'rb') as file_in:
+            while not complete and failures <= UPLOAD_CHUNK_RETRIES:
+                if status and 0 <= status['offset'] < file_size:
+                    file_in.seek(offset)
+                    chunk = file_in.read(UPLOAD_CHUNK_SIZE)
+                    chunk_params = dict(params)
+                    chunk_params['offset'] = str(offset)
+                    chunk_params['sha1'] = hashlib.sha1(chunk).hexdigest()
+                    logging.debug('Uploading %s bytes %d-%d of %d', filename, offset,
+                                  offset + len(chunk), file_size)
+                    status = self.chunk_request(url, chunk_params, chunk, session, codec)
+                if status and status['complete']:
+                    complete = True
+                elif status and status['offset'] > offset:
+                    offset = status['offset']
+                    failures = 0
+                else:
+                    # Back off and re-sync with the server before trying the chunk again
+                    failures += 1
+                    if failures <= UPLOAD_CHUNK_RETRIES:
+                        time.sleep(min(10.0, 0.5 * (2 ** failures)))
+                        status = self.chunk_request(url, params, session=session)
+                        if status is None:
+                            break
+                        if status:
+                            offset = status['offset']
+                            complete = status['complete']
+        if not complete:
+            logging.error("Chunked upload of %s failed at %d of %d bytes", filename, offset,
+                          file_size)
+        return complete
+
+    def chunk_request(self, url, params, chunk=None, session=None, codec=None):
+        """Send one chunk (or a status check if there is no chunk).
+        Returns the server's upload state, {} on a failure or None if chunks aren't supported"""
+        import requests
+        ret = {}
+        if session is None:
+            session = self.session
+        url += "?"
+        for key in params:
+            if params[key] is not None:
+                url += key + '=' + urllib.quote_plus(params[key]) + '&'
+        try:
+            if chunk is None:
+                response = session.get(url, timeout=30)
+            else:
+                headers = {'Content-Type': 'application/octet-stream'}
+                if codec is not None:
+                    chunk = self.codecs.encode_data(chunk, codec, params['file'])
+                    headers['Content-Encoding'] = codec[0]
+                start = monotonic.monotonic()
+                response = session.post(url, data=chunk, timeout=60, headers=headers)
+                self.codecs.record_upload(len(chunk), monotonic.monotonic() - start)
+                if self.metrics is not None:
+                    self.metrics.inc('wptagent_upload_bytes_total', len(chunk),
+                                     endpoint='resultchunk.php')
+            if response.status_code == 404:
+                logging.debug("Chunked uploads are not supported by the server")
+                self.chunked_uploads = False
+                ret = None
+            elif response.status_code == 200:
+                state = response.json()
+                if state is not None and 'offset' in state:
+                    ret = {'offset': int(state['offset']),
+                           'complete': bool('complete' in state and state['complete'])}
+                elif chunk is None:
+                    self.chunked_uploads = False
+                    ret = None
+        except requests.exceptions.RequestException as err:
+            logging.error("Chunk upload error: %s", err.__str__())
+        except ValueError:
+            if chunk is None:
+                # Not a JSON response so the endpoint isn't there
+                self.chunked_uploads = False
+                ret = None
+        if chunk is not None and not ret and self.metrics is not None:
+            self.metrics.inc('wptagent_upload_failures_total', endpoint='resultchunk.php')
+        return ret
+
+    def post_data(self, url, data, file_path, filename, session=None):
         """Send a multi-part post"""
         import requests
         ret = True
+        if session is None:
+            session = self.session
+        endpoint = url.rsplit('/', 1)[-1]
         # pass the data fields as query params and any files as post data
         url += "?"
         for key in data:
-            url += key + '=' + urllib.quote_plus(data[key]) + '&'
+            if data[key] is not None:
+                url += key + '=' + urllib.quote_plus(data[key]) + '&'
         logging.debug(url)
+        encoded_path = None
         try:
             if file_path is not None and os.path.isfile(file_path):
-                self.session.post(url,
-                              files={'file':(filename, open(file_path, 'rb'))},
-                              timeout=300)
+                # Stream the file from disk instead of building the whole post body in memory
+                codec = self.codecs.choose(filename)
+                with open(file_path, 'rb') as file_in:
+                    body = MultipartStream(file_in, filename)
+                    headers = {'Content-Type': body.content_type,
+                               'Content-Length': str(len(body))}
+                    if codec is not None:
+                        encoded_path = file_path + '.upload'
+                        with open(encoded_path, 'wb') as encoded:
+                            self.codecs.encode(body, encoded, codec, filename)
+                        headers['Content-Encoding'] = codec[0]
+                        headers['Content-Length'] = str(os.path.getsize(encoded_path))
+                        body = open(encoded_path, 'rb')
+                    start = monotonic.monotonic()
+                    try:
+                        response = session.post(url, data=body, timeout=300, headers=headers)
+                    finally:
+                        if encoded_path is not None:
+                            body.close()
+                    self.codecs.record_upload(int(headers['Content-Length']),
+                                              monotonic.monotonic() - start)
+                    if self.metrics is not None:
+                        self.metrics.inc('wptagent_upload_bytes_total',
+                                         int(headers['Content-Length']), endpoint=endpoint)
             else:
-                self.session.post(url)
+                response = session.post(url)
+            if response.status_code >= 500:
+                logging.error("Upload: server error %d", response.status_code)
+                ret = False
         except requests.exceptions.RequestException as err:
             logging.critical("Upload: %s", err.strerror)
             ret = False
         except IOError as err:
             logging.error("Upload Error: %s", err.strerror)
             ret = False
+        if encoded_path is not None and os.path.isfile(encoded_path):
+            os.remove(encoded_path)
+        if not ret and self.metrics is not None:
+            self.metrics.inc('wptagent_upload_failures_total', endpoint=endpoint)
         return ret
+
+
+class MultipartStream(object):
+    """File-like multipart/form-data body that reads the file from disk as it is sent"""
+    def __init__(self, file_in, filename, field='file', chunk_size=65536):
+        self.file_in = file_in
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=' + boundary
+        self.header = '--{0}\r\nContent-Disposition: form-data; name="{1}"; ' \
+                      'filename="{2}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(
+                          boundary, field, filename.replace('"', ''))
+        self.footer = '\r\n--{0}--\r\n'.format(boundary)
+        self.file_in.seek(0, os.SEEK_END)
+        self.file_size = self.file_in.tell()
+        self.file_in.seek(0)
+        self.pending = self.header
+        self.footer_sent = False
+
+    def __len__(self):
+        return len(self.header) + self.file_size + len(self.footer)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        """Return the next piece of the body (header, file contents then footer)"""
+        if size is None or size < 0:
+            size = len(self)
+        out = ''
+        while len(out) < size:
+            if not self.pending:
+                data = self.file_in.read(min(size - len(out), self.chunk_size))
+                if data:
+                    self.pending = data
+                elif not self.footer_sent:
+                    self.pending = self.footer
+                    self.footer_sent = True
+                else:
+                    break
+            count = size - len(out)
+            out += self.pending[:count]
+            self.pending = self.pending[count:]
+        return out
@@ -10,6 +10,7 @@ import platform
 import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -24,54 +25,232 @@ class WPTAgent(object):
         self.browsers = Browsers(options, browsers)
         self.root_path = os.path.abspath(os.path.dirname(__file__))
         self.wpt = WebPageTest(options, os.path.join(self.root_path, "work"))
-        self.shaper = TrafficShaper()
+        self.shaper = TrafficShaper(options)
+        self.metrics = None
+        if options.metrics:
+            from internal.agent_metrics import AgentMetrics, METRICS_ADDRESS, METRICS_PORT
+            # Only listen on other interfaces if an address was given explicitly
+            address, _, port = options.metrics.rpartition(':')
+            self.metrics = AgentMetrics(address if address else METRICS_ADDRESS,
+                                        int(port) if port else METRICS_PORT)
+            self.wpt.metrics = self.metrics
+        self.dns = None
+        if options.dnsstub:
+            from internal.dns_stub import DnsStub
+            address, _, port = options.dnsstub.rpartition(':')
+            self.dns = DnsStub(address, int(port))
         self.job = None
         self.task = None
         self.xvfb = None
+        self.warm_browser = None
+        self.warm_thread = None
+        self.prefetch_thread = None
+        self.prefetched_job = None
+        self.prefetched_task = None
+        self.staged_browser = None
         atexit.register(self.cleanup)
         signal.signal(signal.SIGINT, self.signal_handler)
 
     def run_testing(self):
         """Main testing flow"""
+        import monotonic
+        from internal.run_timing import span
+        idle_start = monotonic.monotonic()
         while not self.must_exit:
+            browser = None
+            poll_delay = 5
             try:
                 if self.browsers.is_ready():
-                    self.job = self.wpt.get_test()
+                    if self.prefetch_thread is not None:
+                        self.claim_prefetched_job()
+                    else:
+                        self.job = self.wpt.get_test()
+                        if self.job is not None:
+                            self.task = self.wpt.get_task(self.job)
+                    poll_delay = self.wpt.poll_delay
+                    if self.job is not None and self.metrics is not None:
+                        self.metrics.observe('wptagent_queue_wait_seconds',
+                                             monotonic.monotonic() - idle_start)
                     if self.job is not None:
-                        self.task = self.wpt.get_task(self.job)
                         while self.task is not None:
-                            # - Prepare the browser
-                            browser = self.browsers.get_browser(self.job['browser'], self.job)
+                            # - Prepare the browser (or use the pre-launched/staged one)
+                            browser = self.claim_warm_browser(self.task)
+                            if browser is None and self.staged_browser is not None:
+                                browser = self.staged_browser
+                                self.staged_browser = None
+                                self.launch_browser(browser, self.task)
+                            if browser is None:
+                                browser = self.browsers.get_browser(self.job['browser'],
+                                                                    self.job)
+                                if browser is not None:
+                                    self.launch_browser(browser, self.task)
                             if browser is not None:
-                                browser.prepare(self.job, self.task)
-                                browser.launch(self.job, self.task)
-                                if self.shaper.configure(self.job):
+                                shaped = self.shaper.configure(self.job)
+                                if self.metrics is not None:
+                                    self.metrics.inc('wptagent_shaping_reconfigurations_total',
+                                                     result='ok' if shaped else 'error')
+                                if shaped:
                                     # Run the actual test
                                     browser.run_task(self.task)
+                                    if self.dns is not None:
+                                        self.dns.save_lookups(os.path.join(
+                                            self.task['dir'],
+                                            self.task['task_prefix'] + 'dns.json.gz'))
                                 else:
-                                    self.task.error = "Error configuring traffic-shaping"
+                                    self.task['error'] = "Error configuring traffic-shaping"
                                 self.shaper.reset()
+                                # Fetch and stage the next job while this one finishes up
+                                if self.options.prefetch and self.task['done'] and \
+                                        not self.must_exit:
+                                    self.start_prefetch()
                                 browser.stop()
                             else:
                                 err = "Invalid browser - {0}".format(self.job['browser'])
                                 logging.critical(err)
                                 self.task['error'] = err
-                            self.wpt.upload_task_result(self.task)
+                            # Start the next run's browser while this one uploads
+                            next_task = None
+                            if self.options.warmpool and not self.task['done']:
+                                next_task = self.wpt.get_task(self.job)
+                                if next_task is not None:
+                                    self.start_warm_browser(next_task)
+                            with span(self.task, 'upload'):
+                                self.wpt.upload_task_result(self.task)
+                            if self.metrics is not None:
+                                self.metrics.record_run(self.task)
                             # Delete the browser profile if needed
                             if self.task['cached'] or self.job['fvonly']:
                                 browser.clear_profile(self.task)
                             browser = None
                             # Set up for the next run
-                            self.task = self.wpt.get_task(self.job)
+                            if self.options.warmpool and not self.task['done']:
+                                self.task = next_task
+                            else:
+                                self.task = self.wpt.get_task(self.job)
                 if self.job is not None:
                     self.job = None
+                    idle_start = monotonic.monotonic()
                 else:
-                    self.sleep(5)
+                    self.sleep(poll_delay)
             except BaseException as err:
                 logging.critical("Unhandled exception: %s", err.__str__())
                 traceback.print_exc(file=sys.stdout)
                 if browser is not None:
                     browser.on_stop_recording(None)
+                self.discard_warm_browser()
+                self.release_prefetched_job()
+
+    def prepare_dns(self, task):
+        """Give the run an empty DNS cache with its own setdns/blockdomains rules"""
+        if self.dns is not None:
+            self.dns.reset(task['dns_rules'] if 'dns_rules' in task else None)
+            # The shaping proxy resolves through the stub in-process, bypassing the OS
+            task['dns_stub_only'] = self.shaper.get_proxy() is not None
+
+    def start_prefetch(self):
+        """Get the next job from the server in the background"""
+        self.prefetch_thread = threading.Thread(target=self.prefetch_job)
+        self.prefetch_thread.start()
+
+    def prefetch_job(self):
+        """Lease the next job and stage its first run (script, directories and browser)"""
+        try:
+            job = self.wpt.get_test(prefetch=True)
+            if job is not None:
+                logging.debug("Prefetched job %s", job['Test ID'])
+                self.prefetched_job = job
+                self.prefetched_task = self.wpt.get_task(job)
+                self.staged_browser = self.browsers.get_browser(job['browser'], job)
+        except BaseException as err:
+            logging.critical("Error prefetching the next job: %s", err.__str__())
+
+    def claim_prefetched_job(self):
+        """Start the prefetched job (if there is one) and confirm the lease with the server"""
+        self.prefetch_thread.join()
+        self.prefetch_thread = None
+        self.job = self.prefetched_job
+        self.task = self.prefetched_task
+        self.prefetched_job = None
+        self.prefetched_task = None
+        if self.job is not None:
+            self.wpt.ack_test(self.job)
+
+    def release_prefetched_job(self):
+        """Hand a prefetched job that we will not be running back to the server"""
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+        if self.prefetched_job is not None:
+            self.wpt.ack_test(self.prefetched_job, release=True)
+            self.wpt.discard_job_files(self.prefetched_job['Test ID'])
+        self.prefetched_job = None
+        self.prefetched_task = None
+        self.staged_browser = None
+
+    def launch_browser(self, browser, task):
+        """Prepare the profile and start the browser for the given run"""
+        from internal.run_timing import span
+        if self.shaper.get_proxy() is not None:
+            task['proxy'] = self.shaper.get_proxy()
+        with span(task, 'prepare'):
+            self.prepare_dns(task)
+            browser.prepare(self.job, task)
+        with span(task, 'launch'):
+            browser.launch(self.job, task)
+
+    def start_warm_browser(self, task):
+        """Pre-launch the browser for the next run in the background (warm pool mode)"""
+        self.warm_browser = self.browsers.get_browser(self.job['browser'], self.job)
+        if self.warm_browser is not None and hasattr(self.warm_browser, 'warm_up'):
+            self.warm_thread = threading.Thread(target=self.warm_up_browser,
+                                                args=(self.warm_browser, task))
+            self.warm_thread.start()
+        else:
+            self.warm_browser = None
+
+    def warm_up_browser(self, browser, task):
+        """Launch the browser in a clean profile and wait for it to be connected and idle"""
+        from internal.run_timing import span
+        try:
+            if self.shaper.get_proxy() is not None:
+                task['proxy'] = self.shaper.get_proxy()
+            with span(task, 'prepare'):
+                self.prepare_dns(task)
+                browser.prepare(self.job, task)
+            # Never hand a first view a profile that was not freshly created at launch
+            if task['cached'] or 'profile' not in task or task['profile_clean']:
+                with span(task, 'launch'):
+                    browser.launch(self.job, task)
+                browser.warm_up(task)
+            else:
+                logging.critical("Profile %s was not clean, not pre-launching", task['profile'])
+        except BaseException as err:
+            logging.critical("Error pre-launching the browser: %s", err.__str__())
+
+    def claim_warm_browser(self, task):
+        """Hand over the pre-launched browser if it is ready and clean for the run"""
+        browser = None
+        if self.warm_thread is not None:
+            self.warm_thread.join()
+            self.warm_thread = None
+            if self.warm_browser is not None and self.warm_browser.is_warm(task):
+                logging.debug("Using the pre-launched browser")
+                browser = self.warm_browser
+            elif self.warm_browser is not None:
+                logging.debug("Pre-launched browser is not usable, launching a new one")
+                self.warm_browser.stop()
+            self.warm_browser = None
+        return browser
+
+    def discard_warm_browser(self):
+        """Shut down any pre-launched browser"""
+        if self.warm_thread is not None:
+            self.warm_thread.join()
+            self.warm_thread = None
+        if self.warm_browser is not None:
+            self.warm_browser.disconnect()
+            self.warm_browser.stop()
+            self.warm_browser = None
 
     def signal_handler(self, *_):
         """Ctrl+C handler"""
@@ -85,7 +264,15 @@ class WPTAgent(object):
 
     def cleanup(self):
         """Do any cleanup that needs to be run regardless of how we exit."""
+        self.discard_warm_browser()
+        self.release_prefetched_job()
         self.shaper.remove()
+        if self.dns is not None:
+            self.dns.stop()
+        if self.wpt.spool is not None:
+            self.wpt.spool.stop()
+        if self.metrics is not None:
+            self.metrics.stop()
         if self.xvfb is not None:
             self.xvfb.stop()
 
@@ -167,6 +354,32 @@ class WPTAgent(object):
             print "Error configuring traffic shaping, make sure it is installed."
             ret = False
 
+        if self.dns is not None:
+            if self.dns.start():
+                self.shaper.set_resolver(self.dns)
+                # Without the proxy the browser resolves through the OS so it has to be
+                # pointed at the stub
+                if self.shaper.get_proxy() is None and not self.dns.check_system_resolver():
+                    print "The system resolver is not using the DNS stub. Point it at " \
+                          "{0}:{1:d} or run without --dnsstub.".format(self.dns.address,
+                                                                      self.dns.port)
+                    ret = False
+            elif self.dns.port < 1024 and platform.system() != "Windows" and os.geteuid() != 0:
+                print "The DNS stub needs root to listen on port {0:d}. Run as root or use " \
+                      "--dnsstub ADDRESS:PORT with a port above 1023.".format(self.dns.port)
+                ret = False
+            else:
+                print "Error starting the DNS stub, make sure the address is available."
+                ret = False
+
+        if self.wpt.spool is not None and not self.wpt.spool.start():
+            print "Error creating the result spool directory."
+            ret = False
+
+        if self.metrics is not None and not self.metrics.start():
+            print "Error starting the metrics server, make sure the port is available."
+            ret = False
+
         return ret
 
 
@@ -187,6 +400,17 @@ def parse_ini(ini):
     return ret
 
 
+def upload_codec_setting(value):
+    """argparse type for --uploadcodec (rejects unknown codecs and levels)"""
+    import argparse
+    from internal.upload_codec import parse_setting
+    try:
+        parse_setting(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(err.__str__())
+    return value
+
+
 def main():
     """Startup and initialization"""
     import argparse
@@ -194,9 +418,9 @@ def main():
     parser.add_argument('-v', '--verbose', action='count',
                         help="Increase verbosity (specify multiple times for more)."
                         " -vvvv for full debug output.")
-    parser.add_argument('--server', required=True,
+    parser.add_argument('--server',
                         help="URL for WebPageTest work (i.e. http://www.webpagetest.org/work/).")
-    parser.add_argument('--location', required=True,
+    parser.add_argument('--location',
                         help="Location ID (as configured in locations.ini on the server).")
     parser.add_argument('--key', help="Location key (optional).")
     parser.add_argument('--chrome', help="Path to Chrome executable (if configured).")
@@ -204,7 +428,56 @@ def main():
     parser.add_argument('--name', help="Agent name (for the work directory).")
     parser.add_argument('--xvfb', action='store_true', default=False,
                         help="Use an xvfb virtual display (Linux only)")
+    parser.add_argument('--warmpool', action='store_true', default=False,
+                        help="Pre-launch the browser for the next run while the current run "
+                        "is uploading.")
+    parser.add_argument('--profiletemplate', action='store_true', default=False,
+                        help="Clone first-view browser profiles from a pre-initialized template.")
+    parser.add_argument('--prefetch', action='store_true', default=False,
+                        help="Lease the next job from the server while the last run of the "
+                        "current job is uploading.")
+    parser.add_argument('--longpoll', type=int,
+                        help="Ask the server to hold getwork requests open for up to this many "
+                        "seconds until work is available.")
+    parser.add_argument('--dnsstub', nargs='?', const='127.0.0.1:53',
+                        help="Resolve DNS through a built-in stub resolver listening on "
+                        "ADDRESS:PORT (defaults to 127.0.0.1:53, which needs root) with a "
+                        "fresh cache and DNS timings for every run. The system resolver (or "
+                        "the shaping proxy) needs to use it.")
+    parser.add_argument('--metrics', nargs='?', const='127.0.0.1:9440',
+                        help="Serve agent health and throughput metrics in the Prometheus "
+                        "text format on [ADDRESS:]PORT (defaults to 127.0.0.1:9440, give "
+                        "an address such as 0.0.0.0:9440 to expose it to the network).")
+    parser.add_argument('--spoolsize', type=int, default=1024,
+                        help="Disk space (in MB) for keeping results that can't be uploaded "
+                        "until the server is reachable again (defaults to 1024, 0 to disable).")
+    parser.add_argument('--uploadcodec', default='auto', type=upload_codec_setting,
+                        help="Compression for uploads the server accepts: auto (picked per "
+                        "artifact type from measured ratio and CPU cost), none, gzip[:LEVEL] or "
+                        "zstd[:LEVEL].")
+    parser.add_argument('--loggzip', type=int, choices=range(1, 10),
+                        help="gzip compression level for the dev tools and trace logs "
+                        "(defaults to 2).")
+    parser.add_argument('--videocapture', choices=['trace', 'screencast', 'compare'],
+                        help="Where video frames come from: trace screenshots (the default), "
+                        "Page.startScreencast or both, recording how the visual metrics from "
+                        "the two compare.")
+    parser.add_argument('--screencastquality', type=int,
+                        help="JPEG quality for screencast frames (defaults to 70).")
+    parser.add_argument('--screencastsize', type=int,
+                        help="Maximum width/height for screencast frames (defaults to 1024).")
+    parser.add_argument('--samplerate', type=int,
+                        help="CPU/bandwidth/memory sampling rate while recording in Hz "
+                        "(10-100, defaults to 10).")
+    parser.add_argument('--shaper', choices=['proxy'],
+                        help="Traffic-shaping backend override. 'proxy' shapes through a local "
+                        "SOCKS proxy (no root or kernel modules needed).")
+    parser.add_argument('--testshaper', nargs='?', const='all',
+                        help="Check the traffic-shaping accuracy over a local veth pair and exit"
+                        " (Linux only). Optionally a comma-separated list of profiles.")
     options, _ = parser.parse_known_args()
+    if options.testshaper is None and (options.server is None or options.location is None):
+        parser.error("--server and --location are required.")
 
     # Make sure we are running python 2.7.11 or newer (required for Windows 8.1)
     if sys.version_info[0] != 2 or \
@@ -226,6 +499,14 @@ def main():
     logging.basicConfig(level=log_level, format="%(asctime)s.%(msecs)03d - %(message)s",
                         datefmt="%H:%M:%S")
 
+    if options.testshaper is not None:
+        from internal.shaping_benchmark import ShapingBenchmark
+        profiles = None
+        if options.testshaper != 'all':
+            profiles = options.testshaper.split(',')
+        ShapingBenchmark(backend=options.shaper).run(profiles)
+        exit(0)
+
     browsers = parse_ini(os.path.join(os.path.dirname(__file__), "browsers.ini"))
     if browsers is None:
         print "No browsers configured. Check that browsers.ini is present and correct."